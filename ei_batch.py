@@ -0,0 +1,227 @@
+"""Headless batch mode: evaluate many products from a manifest and write their reports to disk
+
+    python ei_batch.py products.csv batch_results/ -o reports/ --workers 8
+
+The manifest is a CSV or JSON list with one product per row:
+  product_name        required
+  daily_dose          required, g/day
+  route               oral, parenteral, inhalation or cutaneous (default parenteral)
+  control_percentage  control threshold as % of PDE (default 30)
+  elements            elements to evaluate, separated by spaces, commas or semicolons (default Class 1 + 2A)
+  batch_file          batch results file inside the batch directory (default <product_name>.csv/.xlsx/.xls)
+  product_form, actime_code  optional, printed on the ID card
+
+A product whose batch file has rows the validator rejects (negative, non-numeric or duplicate results,
+missing batch names) fails with the validation errors instead of being reported from the remaining rows.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ei_core
+
+default_elements = ["Cd", "Pb", "As", "Hg", "Co", "V", "Ni"]  # Class 1 + 2A
+batch_file_extensions = [".csv", ".xlsx", ".xls"]
+summary_columns = ["row", "product_name", "batches", "skipped", "situation", "compliant", "excel_report", "id_card",
+                   "seconds", "error"]
+
+def read_manifest(path):
+    """Read product rows from a CSV or JSON manifest"""
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows.get("products", [])
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            rows = list(csv.DictReader(f))
+    return [{k.strip(): v for k, v in row.items() if k is not None} if isinstance(row, dict) else {} for row in rows]
+
+def _safe_name(name):
+    """File-name friendly version of a product name"""
+    return re.sub(r"[^\w.-]+", "_", str(name).strip()) or "product"
+
+def _find_batch_file(batch_dir, row):
+    """Resolve the batch results file for a manifest row"""
+    if row.get("batch_file"):
+        return os.path.join(batch_dir, row["batch_file"])
+    for name in (str(row["product_name"]), _safe_name(row["product_name"])):
+        for extension in batch_file_extensions:
+            path = os.path.join(batch_dir, name + extension)
+            if os.path.exists(path):
+                return path
+    return None
+
+def build_jobs(manifest_rows, batch_dir, out_dir, streaming=False):
+    """Turn manifest rows into self-contained job dicts that can be sent to worker processes
+
+    Rows are checked in run_product, so one malformed row only fails its own product. Output files are
+    named after the product; names that collide (after _safe_name, ignoring case) get a _2, _3... suffix.
+    """
+    jobs = []
+    used_names = set()
+    for number, row in enumerate(manifest_rows, start=1):
+        safe_name = base_name = _safe_name(row.get("product_name") or f"product_{number}")
+        suffix = 1
+        while safe_name.lower() in used_names:
+            suffix += 1
+            safe_name = f"{base_name}_{suffix}"
+        used_names.add(safe_name.lower())
+        jobs.append({
+            "row": number,
+            "manifest_row": row,
+            "batch_dir": batch_dir,
+            "excel_path": os.path.join(out_dir, f"ICHQ3DReport_{safe_name}.xlsx"),
+            "id_card_path": os.path.join(out_dir, f"RD_MP_ID_Card_{safe_name}.docx"),
+            "streaming": streaming,
+        })
+    return jobs
+
+def parse_product(row, batch_dir):
+    """Check one manifest row and return its typed settings, raising ValueError for anything unusable"""
+    product_name = str(row.get("product_name") or "").strip()
+    if not product_name:
+        raise ValueError("Missing product_name")
+    try:
+        daily_dose = float(row.get("daily_dose"))
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid daily_dose: {row.get('daily_dose')!r}")
+    if not daily_dose > 0:
+        raise ValueError(f"daily_dose must be greater than 0, got {row.get('daily_dose')!r}")
+    route = str(row.get("route") or "parenteral").strip().lower()
+    if route not in ei_core.routes:
+        raise ValueError(f"Unknown route: {row.get('route')!r}")
+    try:
+        control_percentage = int(float(row.get("control_percentage") or 30))
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid control_percentage: {row.get('control_percentage')!r}")
+    if not 0 < control_percentage <= 100:
+        raise ValueError(f"control_percentage must be between 1 and 100, got {control_percentage}")
+    elements = row.get("elements") or default_elements
+    if isinstance(elements, str):
+        elements = [element for element in re.split(r"[\s,;]+", elements) if element]
+    unknown_elements = [element for element in elements if element not in ei_core.elements_table]
+    if unknown_elements:
+        raise ValueError(f"Unknown elements: {', '.join(map(str, unknown_elements))}")
+    if not elements:
+        raise ValueError("No elements selected")
+    return {
+        "product_name": product_name,
+        "daily_dose": daily_dose,
+        "route": route,
+        "control_percentage": control_percentage,
+        "elements": list(elements),
+        "product_form": row.get("product_form") or "Drug Product",
+        "actime_code": row.get("actime_code") or "",
+        "batch_file": _find_batch_file(batch_dir, dict(row, product_name=product_name)),
+    }
+
+def run_product(job):
+    """Evaluate one product and write its Excel report and ID card; returns a summary row"""
+    start = time.time()
+    summary = {"row": job["row"], "product_name": job["manifest_row"].get("product_name") or "", "batches": 0,
+               "skipped": 0, "situation": "", "compliant": "", "excel_report": "", "id_card": "", "seconds": 0, "error": ""}
+    try:
+        product = parse_product(job["manifest_row"], job["batch_dir"])
+        if product["batch_file"] is None or not os.path.exists(product["batch_file"]):
+            raise FileNotFoundError(f"No batch results file found for {product['product_name']}")
+
+        with open(product["batch_file"], "rb") as f:
+            store, results, error = ei_core.stream_batch_upload_file(f, product["elements"])
+        if error:
+            raise ValueError(error)
+        # Like the app, rows rejected by validation fail the product rather than leave it out of the report
+        summary["skipped"] = results["skipped"]
+        if results["skipped"] or results["errors"]:
+            raise ValueError("; ".join(results["errors"]) or f"Skipped {results['skipped']} invalid row(s)")
+        if not len(store):
+            raise ValueError("No batches in the batch results file")
+
+        calculation_data = ei_core.calculate_limits(
+            {element: ei_core.elements_table[element] for element in product["elements"]},
+            product["daily_dose"], product["route"], product["control_percentage"]
+        )
+        compliance = ei_core.evaluate_compliance(store, calculation_data, product["route"], product["daily_dose"],
+                                                 product["control_percentage"], product["elements"])
+        situation = compliance["overall_situation"]
+
+        report_writer = ei_core.create_excel_report_streaming if job["streaming"] else ei_core.create_excel_report
+        excel_io = report_writer(product["product_name"], product["daily_dose"], product["route"], product["elements"],
+                                 calculation_data, store, product["control_percentage"], compliance=compliance)
+        with open(job["excel_path"], "wb") as f:
+            f.write(excel_io.getvalue())
+
+        form_data = {
+            "product_name": product["product_name"],
+            "actime_code": product["actime_code"],
+            "product_form": product["product_form"],
+            "daily_dose": product["daily_dose"],
+            "route_of_administration": product["route"],
+            "elements": {element: True for element in product["elements"]},
+        }
+        doc_io = ei_core.create_id_card_document(form_data, calculation_data, store, product["control_percentage"],
+                                                 compliance=compliance)
+        with open(job["id_card_path"], "wb") as f:
+            f.write(doc_io.getvalue())
+
+        # Same definition as the Excel report: every evaluated result below the control threshold
+        summary.update({"batches": len(store), "situation": situation,
+                        "compliant": bool(compliance["compliant"].all()),
+                        "excel_report": job["excel_path"], "id_card": job["id_card_path"]})
+    except Exception as e:
+        summary["error"] = str(e)
+    summary["seconds"] = round(time.time() - start, 2)
+    return summary
+
+def run_jobs(jobs, workers=None):
+    """Run jobs across a process pool, yielding summary rows as products finish"""
+    if workers == 1:
+        for job in jobs:
+            yield run_product(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_product, job) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+def write_summary(path, summaries):
+    """Write one summary row per product, in manifest order"""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=summary_columns)
+        writer.writeheader()
+        writer.writerows(summaries)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate elemental impurities for many products without the web UI")
+    parser.add_argument("manifest", help="CSV or JSON product manifest")
+    parser.add_argument("batch_dir", help="Directory holding the batch results files")
+    parser.add_argument("-o", "--out-dir", default="reports", help="Output directory (default: reports)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Worker processes (default: number of CPUs; 1 runs in this process)")
+    parser.add_argument("--streaming", action="store_true", help="Use the constant-memory Excel writer")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    jobs = build_jobs(read_manifest(args.manifest), args.batch_dir, args.out_dir, args.streaming)
+
+    start = time.time()
+    summaries = []
+    for summary in run_jobs(jobs, args.workers):
+        summaries.append(summary)
+        status = f"situation {summary['situation']}" if not summary["error"] else f"FAILED: {summary['error']}"
+        print(f"[{len(summaries)}/{len(jobs)}] {summary['product_name']}: {status}", file=sys.stderr)
+
+    summaries.sort(key=lambda summary: summary["row"])
+    write_summary(os.path.join(args.out_dir, "summary.csv"), summaries)
+    failed = sum(1 for summary in summaries if summary["error"])
+    print(f"{len(jobs) - failed} of {len(jobs)} products done in {time.time() - start:.1f} s, "
+          f"summary in {os.path.join(args.out_dir, 'summary.csv')}", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
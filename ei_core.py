@@ -0,0 +1,3702 @@
+"""Elemental impurities (ICH Q3D) calculation and reporting core, importable without Streamlit
+
+Word and Excel libraries are imported inside the functions that build documents, so importing this module
+only pulls in numpy and pandas.
+"""
+import pandas as pd
+import numpy as np
+import io
+import os
+import hashlib
+import copy
+import pickle
+import re
+import threading
+import sqlite3
+import tempfile
+import functools
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from xml.sax.saxutils import escape as xml_escape, unescape as xml_unescape
+
+logger = logging.getLogger(__name__)
+
+# Predefined elements table with PDE values (ICH Q3D R2)
+elements_table = {
+    "Cd": {"Class": "1", "If intentionally added": True, "If not intentionally added": True, 
+           "PDE_oral": 5, "PDE_parenteral": 2, "PDE_inhalation": 3, "PDE_cutaneous": 20},
+    "Pb": {"Class": "1", "If intentionally added": True, "If not intentionally added": True,
+           "PDE_oral": 5, "PDE_parenteral": 5, "PDE_inhalation": 5, "PDE_cutaneous": 50},
+    "As": {"Class": "1", "If intentionally added": True, "If not intentionally added": True,
+           "PDE_oral": 15, "PDE_parenteral": 15, "PDE_inhalation": 2, "PDE_cutaneous": 30},
+    "Hg": {"Class": "1", "If intentionally added": True, "If not intentionally added": True,
+           "PDE_oral": 30, "PDE_parenteral": 3, "PDE_inhalation": 1, "PDE_cutaneous": 30},
+    "Co": {"Class": "2A", "If intentionally added": True, "If not intentionally added": True,
+           "PDE_oral": 50, "PDE_parenteral": 5, "PDE_inhalation": 3, "PDE_cutaneous": 50},
+    "V": {"Class": "2A", "If intentionally added": True, "If not intentionally added": True,
+          "PDE_oral": 100, "PDE_parenteral": 10, "PDE_inhalation": 1, "PDE_cutaneous": 100},
+    "Ni": {"Class": "2A", "If intentionally added": True, "If not intentionally added": True,
+           "PDE_oral": 200, "PDE_parenteral": 20, "PDE_inhalation": 6, "PDE_cutaneous": 200},
+    "Tl": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 8, "PDE_parenteral": 8, "PDE_inhalation": 8, "PDE_cutaneous": 8},
+    "Au": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 300, "PDE_parenteral": 300, "PDE_inhalation": 3, "PDE_cutaneous": 3000},
+    "Pd": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 100, "PDE_parenteral": 10, "PDE_inhalation": 1, "PDE_cutaneous": 100},
+    "Ir": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 100, "PDE_parenteral": 10, "PDE_inhalation": 1, "PDE_cutaneous": 100},
+    "Os": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 100, "PDE_parenteral": 10, "PDE_inhalation": 1, "PDE_cutaneous": 100},
+    "Rh": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 100, "PDE_parenteral": 10, "PDE_inhalation": 1, "PDE_cutaneous": 100},
+    "Ru": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 100, "PDE_parenteral": 10, "PDE_inhalation": 1, "PDE_cutaneous": 100},
+    "Se": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 150, "PDE_parenteral": 80, "PDE_inhalation": 130, "PDE_cutaneous": 800},
+    "Ag": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 150, "PDE_parenteral": 15, "PDE_inhalation": 7, "PDE_cutaneous": 150},
+    "Pt": {"Class": "2B", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 100, "PDE_parenteral": 10, "PDE_inhalation": 1, "PDE_cutaneous": 100},
+    "Li": {"Class": "3", "If intentionally added": True, "If not intentionally added": True,
+           "PDE_oral": 550, "PDE_parenteral": 250, "PDE_inhalation": 25, "PDE_cutaneous": 2500},
+    "Sb": {"Class": "3", "If intentionally added": True, "If not intentionally added": True,
+           "PDE_oral": 1200, "PDE_parenteral": 90, "PDE_inhalation": 20, "PDE_cutaneous": 900},
+    "Ba": {"Class": "3", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 1400, "PDE_parenteral": 700, "PDE_inhalation": 300, "PDE_cutaneous": 7000},
+    "Mo": {"Class": "3", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 3000, "PDE_parenteral": 1500, "PDE_inhalation": 10, "PDE_cutaneous": 15000},
+    "Cu": {"Class": "3", "If intentionally added": True, "If not intentionally added": True,
+           "PDE_oral": 3000, "PDE_parenteral": 300, "PDE_inhalation": 30, "PDE_cutaneous": 3000},
+    "Sn": {"Class": "3", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 6000, "PDE_parenteral": 600, "PDE_inhalation": 60, "PDE_cutaneous": 6000},
+    "Cr": {"Class": "3", "If intentionally added": True, "If not intentionally added": False,
+           "PDE_oral": 11000, "PDE_parenteral": 1100, "PDE_inhalation": 3, "PDE_cutaneous": 11000},
+    "Fe": {"Class": "4", "If intentionally added": False, "If not intentionally added": False,
+           "PDE_oral": None, "PDE_parenteral": 13000, "PDE_inhalation": None, "PDE_cutaneous": None},
+    "Mn": {"Class": "3", "If intentionally added": False, "If not intentionally added": False,
+           "PDE_oral": 2500, "PDE_parenteral": 250, "PDE_inhalation": 25, "PDE_cutaneous": None},
+    "Zn": {"Class": "3", "If intentionally added": False, "If not intentionally added": False,
+           "PDE_oral": 13000, "PDE_parenteral": 1300, "PDE_inhalation": 130, "PDE_cutaneous": None},
+}
+
+# Routes of administration in PDE column order
+routes = ["oral", "parenteral", "inhalation", "cutaneous"]
+
+def build_pde_reference(elements):
+    """Build an array-backed PDE reference store indexed by element and route"""
+    element_names = list(elements.keys())
+    pde = np.array(
+        [[np.nan if properties[f"PDE_{route}"] is None else properties[f"PDE_{route}"] for route in routes]
+         for properties in elements.values()],
+        dtype=float
+    ).reshape(len(element_names), len(routes))
+    reference = {
+        "elements": element_names,
+        "element_index": {element: i for i, element in enumerate(element_names)},
+        "routes": list(routes),
+        "route_index": {route: j for j, route in enumerate(routes)},
+        "pde": pde,
+        "classes": np.array([properties["Class"] for properties in elements.values()]),
+        "intentionally_added": np.array([properties["If intentionally added"] for properties in elements.values()], dtype=bool),
+        "not_intentionally_added": np.array([properties["If not intentionally added"] for properties in elements.values()], dtype=bool),
+    }
+    for key in ("pde", "classes", "intentionally_added", "not_intentionally_added"):
+        reference[key].setflags(write=False)
+    # Content hash of the reference data, so cached results are invalidated when the table changes
+    reference["version"] = hashlib.sha256(repr(sorted(elements.items())).encode()).hexdigest()[:16]
+    return reference
+
+# PDE reference store, built once at import
+pde_reference = build_pde_reference(elements_table)
+
+def get_pde(element, route, reference=None):
+    """Get the PDE (µg/day) of one element for one route, NaN if not established"""
+    reference = pde_reference if reference is None else reference
+    i = reference["element_index"].get(element)
+    if i is None:
+        return np.nan
+    return reference["pde"][i, reference["route_index"][route]]
+
+def get_route_pdes(route, elements=None, reference=None):
+    """Get the PDE column (µg/day) for a route, optionally restricted to the given elements (NaN if unknown)"""
+    reference = pde_reference if reference is None else reference
+    column = reference["pde"][:, reference["route_index"][route]]
+    if elements is None:
+        return column
+    indexes = np.array([reference["element_index"].get(element, -1) for element in elements], dtype=int)
+    return np.where(indexes >= 0, column[indexes], np.nan)
+
+def _limit_rows(elements, daily_dose, route, control_percentage):
+    """One limit row per element that has a PDE for the route, in input order, with PDEs as floats"""
+    element_names = [element for element in elements if element in pde_reference["element_index"]]
+    indexes = np.array([pde_reference["element_index"][element] for element in element_names], dtype=int)
+    pdes = get_route_pdes(route)[indexes]
+    available = ~np.isnan(pdes)
+    indexes, pdes = indexes[available], pdes[available]
+    mpcs = pdes / daily_dose
+    control_limits = mpcs * (control_percentage / 100)
+    
+    results = []
+    for i, pde, mpc, control_limit in zip(indexes.tolist(), pdes.tolist(), mpcs.tolist(), control_limits.tolist()):
+        # Round values appropriately
+        if mpc < 1:
+            mpc_rounded = round(mpc, 2)
+            control_limit_rounded = round(control_limit, 2)
+        elif mpc < 10:
+            mpc_rounded = round(mpc, 1)
+            control_limit_rounded = round(control_limit, 1)
+        else:
+            mpc_rounded = round(mpc)
+            control_limit_rounded = round(control_limit)
+        
+        results.append({
+            "Element": pde_reference["elements"][i],
+            "Class": pde_reference["classes"][i],
+            f"PDE ({route}) µg/day": pde,
+            "MPC µg/g": mpc_rounded,
+            f"Control Strategy Limit ({control_percentage}%) µg/g": control_limit_rounded,
+            "MPC ng/mL": mpc_rounded * 1000,
+            f"Control Strategy Limit ({control_percentage}%) ng/mL": control_limit_rounded * 1000
+        })
+    return results
+
+def _whole_pdes(rows, route):
+    """PDEs are tabulated as whole µg/day; show them as integers when every row has a whole PDE"""
+    column = f"PDE ({route}) µg/day"
+    if all(float(row[column]).is_integer() for row in rows):
+        return [dict(row, **{column: int(row[column])}) for row in rows]
+    return rows
+
+def calculate_limits(elements, daily_dose, route="parenteral", control_percentage=30):
+    """Calculate Maximum Permitted Concentration (MPC) and control strategy limits"""
+    if daily_dose <= 0:
+        logger.warning("Daily dose must be greater than 0")
+        return pd.DataFrame()
+    return pd.DataFrame(_whole_pdes(_limit_rows(elements, daily_dose, route, control_percentage), route))
+
+def calculate_element_results(measured_value, daily_dose, pde, control_percentage=30):
+    """Calculate element results based on measured values and parameters"""
+    try:
+        mpc = pde / daily_dose
+        control_limit = mpc * (control_percentage / 100)
+        exposure = measured_value * daily_dose
+        control_threshold = pde * (control_percentage / 100)
+        is_compliant = exposure <= control_threshold
+        
+        # Round values appropriately
+        if mpc < 1:
+            mpc_rounded = round(mpc, 4)
+            control_limit_rounded = round(control_limit, 4)
+        elif mpc < 10:
+            mpc_rounded = round(mpc, 2)
+            control_limit_rounded = round(control_limit, 2)
+        else:
+            mpc_rounded = round(mpc, 1)
+            control_limit_rounded = round(control_limit, 1)
+        
+        exposure_rounded = round(exposure, 4)
+        
+        return {
+            'measured_value': measured_value,
+            'exposure': exposure_rounded,
+            'mpc': mpc_rounded,
+            'control_limit': control_limit_rounded,
+            'control_threshold': control_threshold,
+            'is_compliant': is_compliant
+        }
+    except Exception as e:
+        logger.error(f"Calculation error: {str(e)}")
+        return None
+
+_placeholder_pattern = re.compile(r"\{\{(\w+)\}\}")
+_anchor_pattern = re.compile(r"^\[\[(\w+)\]\]$")
+
+def _new_template_document():
+    """Blank document with the margins shared by all generated documents"""
+    from docx import Document
+    from docx.shared import Inches
+    
+    doc = Document()
+    
+    # Set margins
+    sections = doc.sections
+    for section in sections:
+        section.top_margin = Inches(0.75)
+        section.bottom_margin = Inches(0.75)
+        section.left_margin = Inches(0.75)
+        section.right_margin = Inches(0.75)
+    return doc
+
+def _build_analysis_request_template():
+    """Build the Inorganic Analysis Request layout with placeholders for the form fields"""
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    
+    doc = _new_template_document()
+    
+    # Title
+    title = doc.add_heading('Inorganic Analysis Request', 0)
+    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    # BioA-Elemental Analysis section
+    subtitle = doc.add_heading('BioA-Elemental Analysis', level=1)
+    subtitle.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    p = doc.add_paragraph('(Elemental Analysis Laboratory – Vitry Lavoisier Building L304)')
+    p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    p = doc.add_paragraph('Jean-francois.rameau@sanofi.com / Sylvie.monget@sanofi.com')
+    p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    # Add some space
+    doc.add_paragraph()
+    
+    # Requestor Information section
+    doc.add_heading('REQUESTOR INFORMATION', level=1)
+    
+    # Create a table for requestor info
+    rows = [
+        ("Requestor Site:", "{{requestor_site}}"),
+        ("Requestor Name/Phone/E.mail:", "{{requestor_name}} / {{requestor_phone}} / {{requestor_email}}"),
+        ("Request Date:", "{{request_date}}"),
+    ]
+    table = doc.add_table(rows=len(rows), cols=2)
+    table.style = 'Table Grid'
+    for i, (label, value) in enumerate(rows):
+        table.cell(i, 0).text = label
+        table.cell(i, 1).text = value
+    
+    # Add some space
+    doc.add_paragraph()
+    
+    # Sample Information section
+    doc.add_heading('SAMPLE INFORMATION', level=1)
+    
+    # Create a table for sample info
+    rows = [
+        ("PRODUCT Name:", "{{product_name}}"),
+        ("Actime Code:", "{{actime_code}}"),
+        ("PRODUCT Form (Drug Product, Drug substance, other):", "{{product_form}}"),
+        ("Batch number (provide a list in attachment in case of several samples):", "{{batch_number}}"),
+        ("Sample quantity (volume or weight):", "{{sample_quantity}} {{sample_unit}}"),
+        ("Number of vials:", "{{number_of_vials}}"),
+        ("Safety risk (Safety data sheet to be provided by the requestor):", "{{safety_risk}}"),
+        ("Shipment conditions:", "{{shipment_conditions}}"),
+        ("Storage conditions:", "{{storage_conditions}}"),
+    ]
+    table = doc.add_table(rows=len(rows), cols=2)
+    table.style = 'Table Grid'
+    for i, (label, value) in enumerate(rows):
+        table.cell(i, 0).text = label
+        table.cell(i, 1).text = value
+    
+    # Add some space
+    doc.add_paragraph()
+    
+    # Analysis Information section
+    doc.add_heading('ANALYSIS INFORMATION', level=1)
+    
+    # GMP Analysis
+    doc.add_paragraph('[[gmp_analysis]]')
+    
+    # Analysis Type
+    doc.add_paragraph("Quantitative Analysis {{quantitative_box}}  Qualitative Analysis (Screening) {{qualitative_box}}")
+    
+    # Elements to be determined
+    p = doc.add_paragraph()
+    p.add_run("Element(s) to be determined (quantitative analysis):").bold = True
+    doc.add_paragraph("{{elements}}")
+    
+    # ICHQ3D Analysis - separate section
+    p = doc.add_paragraph()
+    p.add_run("ICHQ3D Analysis:").bold = True
+    p.add_run(" {{ichq3d_analysis}}")
+    doc.add_paragraph('[[ichq3d_documents]]')
+    
+    # Method reference
+    p = doc.add_paragraph()
+    p.add_run("Method reference and/or specification to be applied if relevant (Veeva Vault or Pharmacopoeia reference):").bold = True
+    doc.add_paragraph("{{method_reference}}")
+    
+    # Calculation data, if available
+    doc.add_paragraph('[[calculation]]')
+    
+    # Add some space
+    doc.add_paragraph()
+    
+    # Request reference section
+    p = doc.add_paragraph()
+    p.add_run("(Completed by the BioA/AE Laboratory)").italic = True
+    p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    p = doc.add_paragraph()
+    p.add_run("Request reference (Steel or iLab): ").bold = True
+    p.add_run("_____________________")
+    return doc
+
+# Maximum number of batch result columns per ID card table before the batches are split over several tables
+id_card_batch_columns = 8
+
+def _batch_column_chunks(n_batches, batch_columns):
+    """Split batch column positions into (start, stop) ranges of at most batch_columns each"""
+    if not batch_columns or n_batches <= batch_columns:
+        return [(0, n_batches)]
+    return [(start, min(start + batch_columns, n_batches)) for start in range(0, n_batches, batch_columns)]
+
+def _cell_xml(value, bold=False):
+    """WordprocessingML for one table cell paragraph, matching what cell.text produces"""
+    if value is None or value == "":
+        return "<w:p/>"
+    pieces = []
+    for k, line in enumerate(str(value).split("\n")):
+        if k:
+            pieces.append("<w:br/>")
+        for m, segment in enumerate(line.split("\t")):
+            if m:
+                pieces.append("<w:tab/>")
+            if segment:
+                space = ' xml:space="preserve"' if segment != segment.strip() else ''
+                pieces.append(f"<w:t{space}>{xml_escape(segment)}</w:t>")
+    run_properties = "<w:rPr><w:b/></w:rPr>" if bold else ""
+    return f"<w:p><w:r>{run_properties}{''.join(pieces)}</w:r></w:p>"
+
+def _insert_bulk_table_before(doc, anchor, rows, bold_header=True, style='Table Grid'):
+    """Build a table from a list of row values as one XML string and place it in front of an anchor paragraph
+
+    Filling cells through table.cell(i, j) re-resolves the whole grid on every call, which makes large tables
+    quadratic; emitting the rows in one pass keeps the build time linear in the number of cells.
+    """
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+    from docx.shared import Emu
+    from docx.table import Table
+    
+    cols = len(rows[0])
+    section = doc.sections[-1]
+    block_width = section.page_width - section.left_margin - section.right_margin
+    col_width = Emu(block_width // cols).twips
+    cell_start = f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{col_width}"/></w:tcPr>'
+    parts = [f'<w:tbl {nsdecls("w")}><w:tblPr><w:tblStyle w:val="{doc.styles[style].style_id}"/>'
+             '<w:tblW w:type="auto" w:w="0"/><w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" '
+             'w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr><w:tblGrid>',
+             f'<w:gridCol w:w="{col_width}"/>' * cols, '</w:tblGrid>']
+    for i, row in enumerate(rows):
+        bold = bold_header and i == 0
+        parts.append('<w:tr>')
+        parts.extend(f'{cell_start}{_cell_xml(value, bold)}</w:tc>' for value in row)
+        parts.append('</w:tr>')
+    parts.append('</w:tbl>')
+    tbl = parse_xml(''.join(parts))
+    anchor._p.addprevious(tbl)
+    return Table(tbl, anchor._parent)
+
+def create_word_document(form_data, calculation_data=None):
+    """Function to create Word document"""
+    from docx.shared import Inches
+    
+    def fill_gmp_analysis(doc, anchor):
+        if form_data['gmp_analysis'] == 'Yes':
+            release_box = "☒" if form_data['gmp_purpose'] == "For Release" else "☐"
+            information_box = "☐" if form_data['gmp_purpose'] == "For Release" else "☒"
+            anchor.insert_paragraph_before(
+                f"GMP Analysis: {form_data['gmp_analysis']}  For release {release_box}  For information {information_box}")
+        else:
+            p = anchor.insert_paragraph_before()
+            p.add_run("GMP Analysis: ").bold = True
+            p.add_run(f"{form_data['gmp_analysis']}")
+    
+    def fill_ichq3d_documents(doc, anchor):
+        if form_data['ichq3d_analysis']:
+            p = anchor.insert_paragraph_before()
+            p.add_run("For ICHQ3D request, documents to be provided:").bold = True
+            
+            p = anchor.insert_paragraph_before("Phase 1 and 2: R&D Medecinal product ID Card (SD-000133)")
+            p.paragraph_format.left_indent = Inches(0.5)
+            
+            p = anchor.insert_paragraph_before("Phase 3: Medicinal Product ID Card (SD-000134) and Risk Assessment (SD-000131)")
+            p.paragraph_format.left_indent = Inches(0.5)
+    
+    def fill_calculation(doc, anchor):
+        if calculation_data is not None and form_data['ichq3d_analysis']:
+            anchor.insert_paragraph_before()
+            anchor.insert_paragraph_before('ELEMENTAL IMPURITIES CALCULATION', style='Heading 1')
+            
+            p = anchor.insert_paragraph_before()
+            p.add_run(f"Daily dose: {form_data['daily_dose']} g").bold = True
+            p.add_run(f" ({form_data['route_of_administration']} administration)")
+            
+            # Add calculation table
+            rows = [["Element", "Class", "PDE (µg/day)", "MPC (µg/g)", "Control Strategy Limit (ng/mL)"]]
+            for row in calculation_data.itertuples():
+                rows.append([row.Element, row.Class, str(row._3),  # PDE column
+                             str(row._4),  # MPC column
+                             str(row._7)])  # Control Strategy Limit column
+            _insert_bulk_table_before(doc, anchor, rows)
+    
+    analysis_type = form_data['analysis_type']
+    fields = {
+        'requestor_site': form_data['requestor_site'],
+        'requestor_name': form_data['requestor_name'],
+        'requestor_phone': form_data['requestor_phone'],
+        'requestor_email': form_data['requestor_email'],
+        'request_date': form_data['request_date'],
+        'product_name': form_data['product_name'],
+        'actime_code': form_data['actime_code'],
+        'product_form': form_data['product_form'],
+        'batch_number': form_data['batch_number'],
+        'sample_quantity': form_data['sample_quantity'],
+        'sample_unit': form_data['sample_unit'],
+        'number_of_vials': form_data['number_of_vials'],
+        'safety_risk': form_data['safety_risk'],
+        'shipment_conditions': form_data['shipment_conditions'],
+        'storage_conditions': form_data['storage_conditions'],
+        'quantitative_box': "☒" if analysis_type == "Quantitative Analysis" else "☐",
+        'qualitative_box': "☐" if analysis_type == "Quantitative Analysis" else "☒",
+        'elements': ", ".join(element for element, checked in form_data['elements'].items() if checked),
+        'ichq3d_analysis': "Yes" if form_data['ichq3d_analysis'] else "No",
+        'method_reference': form_data['method_reference'],
+    }
+    doc = render_docx_template(load_docx_template('analysis_request'), fields, {
+        'gmp_analysis': fill_gmp_analysis,
+        'ichq3d_documents': fill_ichq3d_documents,
+        'calculation': fill_calculation,
+    })
+    
+    # Save to BytesIO
+    doc_io = io.BytesIO()
+    doc.save(doc_io)
+    doc_io.seek(0)
+    return doc_io
+
+def _index_by_element(calculation_data):
+    """Index calculation data by element for direct per-element lookups"""
+    if calculation_data.empty:
+        return pd.DataFrame()
+    return calculation_data.drop_duplicates('Element').set_index('Element')
+
+def exposure_ratio_table(batch_results, route, daily_dose, elements):
+    """Control-%-independent part of the compliance evaluation: exposures, PDEs and exposure/PDE ratios
+
+    Computed once per dataset, route and dose; classify_compliance then answers any control % from it.
+    """
+    elements = list(elements)
+    if isinstance(batch_results, dict):
+        batch_results = BatchResultStore.from_dict(batch_results, elements)
+    measured, missing = batch_results.matrix(elements)
+    pde = get_route_pdes(route, elements)
+    exposure = measured * daily_dose
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = exposure / pde
+    return {
+        'batches': list(batch_results.batch_ids),
+        'elements': elements,
+        'measured': measured,
+        'missing': missing,
+        'exposure': exposure,
+        'pde': pde,
+        'ratio': ratio,
+    }
+
+def classify_compliance(ratio_table, control_percentage=30):
+    """Classify a precomputed ratio table against one control %, returning the evaluate_compliance layout
+
+    Situation codes per cell: 1 = below control threshold, 2 = between control threshold and PDE,
+    3 = above PDE, 0 = not evaluated (no PDE for this route).
+    """
+    pde = ratio_table['pde']
+    exposure = ratio_table['exposure']
+    control_threshold = pde * (control_percentage / 100)
+    situation = np.where(exposure > pde, 3, np.where(exposure > control_threshold, 2, 1)).astype(np.int8)
+    situation[:, np.isnan(pde)] = 0
+    return dict(ratio_table, control_threshold=control_threshold, situation=situation,
+                compliant=situation < 2, overall_situation=int(situation.max(initial=1)))
+
+def classify_tiers(ratio_table, control_percentages):
+    """Classify one ratio table against several control % tiers, e.g. [30, 50]"""
+    return {control_percentage: classify_compliance(ratio_table, control_percentage)
+            for control_percentage in control_percentages}
+
+def tier_summary(ratio_table, control_percentages):
+    """Per-element worst case as % of PDE, with the worst situation at each control % tier side by side"""
+    with np.errstate(invalid='ignore'):
+        worst_ratio = np.fmax.reduce(ratio_table['ratio'], axis=0, initial=-np.inf)
+    worst_ratio[np.isnan(ratio_table['pde'])] = np.nan
+    summary = pd.DataFrame({
+        'Element': ratio_table['elements'],
+        'Max % of PDE': np.where(np.isinf(worst_ratio), np.nan, worst_ratio * 100),
+    })
+    for control_percentage, compliance in classify_tiers(ratio_table, control_percentages).items():
+        summary[f'Situation at {control_percentage}%'] = compliance['situation'].max(axis=0, initial=0)
+    return summary
+
+def evaluate_compliance(batch_results, calculation_data, route, daily_dose, control_percentage=30, elements=None):
+    """Evaluate every batch × element result against its PDE and control threshold in one vectorized pass
+
+    batch_results is a BatchResultStore or a {batch: {element: value}} dict; see classify_compliance for the
+    situation codes.
+    """
+    if elements is None:
+        elements = calculation_data['Element'].tolist() if not calculation_data.empty else []
+    return classify_compliance(exposure_ratio_table(batch_results, route, daily_dose, elements), control_percentage)
+
+def _elements_with_situation(compliance, situation):
+    """Get elements having at least one batch in the given situation"""
+    flagged = (compliance['situation'] == situation).any(axis=0)
+    return [element for element, is_flagged in zip(compliance['elements'], flagged) if is_flagged]
+
+def determine_compliance_situation(batch_results, calculation_data, route, daily_dose, control_percentage=30,
+                                   compliance=None):
+    """Determine compliance situation (1, 2, or 3) based on batch results"""
+    if compliance is None:
+        compliance = evaluate_compliance(batch_results, calculation_data, route, daily_dose, control_percentage)
+    return compliance['overall_situation']
+
+def get_elements_above_threshold(batch_results, calculation_data, route, daily_dose, control_percentage=30,
+                                 compliance=None):
+    """Get list of elements with levels between 30% and 100% PDE"""
+    if compliance is None:
+        compliance = evaluate_compliance(batch_results, calculation_data, route, daily_dose, control_percentage)
+    return _elements_with_situation(compliance, 2)
+
+def get_elements_above_pde(batch_results, calculation_data, route, daily_dose, compliance=None):
+    """Get list of elements with levels above PDE"""
+    if compliance is None:
+        compliance = evaluate_compliance(batch_results, calculation_data, route, daily_dose)
+    return _elements_with_situation(compliance, 3)
+
+
+def dose_sensitivity(batch_results, route, elements, control_percentage=30):
+    """Solve, for every batch × element, the daily doses at which the compliance situation changes
+
+    Exposure is measured * daily_dose, so a result moves to Situation 2 above control_threshold / measured g/day
+    and to Situation 3 above PDE / measured g/day. Results of 0 never change situation (inf); elements without a
+    PDE for the route are NaN. max_dose_situation_1 and max_dose_below_pde are the highest daily doses keeping
+    every batch in Situation 1, and every batch at or below the PDE.
+    """
+    elements = list(elements)
+    if isinstance(batch_results, dict):
+        batch_results = BatchResultStore.from_dict(batch_results, elements)
+    measured, _ = batch_results.matrix(elements)
+    pde = get_route_pdes(route, elements)
+    control_threshold = pde * (control_percentage / 100)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        control_dose = np.where(measured > 0, control_threshold / measured, np.inf)
+        pde_dose = np.where(measured > 0, pde / measured, np.inf)
+    control_dose[:, np.isnan(pde)] = np.nan
+    pde_dose[:, np.isnan(pde)] = np.nan
+    
+    def limit(doses):
+        if doses.size == 0 or np.isnan(doses).all():
+            return np.inf, None, None
+        batch, element = np.unravel_index(np.nanargmin(doses), doses.shape)
+        return float(doses[batch, element]), batch_results.batch_ids[batch], elements[element]
+    
+    max_dose_situation_1, situation_1_batch, situation_1_element = limit(control_dose)
+    max_dose_below_pde, below_pde_batch, below_pde_element = limit(pde_dose)
+    element_control_dose = np.fmin.reduce(control_dose, axis=0, initial=np.inf)
+    element_pde_dose = np.fmin.reduce(pde_dose, axis=0, initial=np.inf)
+    element_control_dose[np.isnan(pde)] = np.nan
+    element_pde_dose[np.isnan(pde)] = np.nan
+    return {
+        'batches': list(batch_results.batch_ids),
+        'elements': elements,
+        'control_dose': control_dose,
+        'pde_dose': pde_dose,
+        'element_control_dose': element_control_dose,
+        'element_pde_dose': element_pde_dose,
+        'max_dose_situation_1': max_dose_situation_1,
+        'situation_1_limited_by': (situation_1_batch, situation_1_element),
+        'max_dose_below_pde': max_dose_below_pde,
+        'below_pde_limited_by': (below_pde_batch, below_pde_element),
+    }
+
+def dose_sweep(batch_results, route, doses, elements, control_percentage=30):
+    """Evaluate the situation of every batch × element over a grid of daily doses in one broadcasted pass
+
+    Returns situation codes shaped (doses, batches, elements), with the same rules as evaluate_compliance,
+    and the overall situation per dose.
+    """
+    elements = list(elements)
+    if isinstance(batch_results, dict):
+        batch_results = BatchResultStore.from_dict(batch_results, elements)
+    doses = np.asarray(doses, dtype=float)
+    measured, _ = batch_results.matrix(elements)
+    pde = get_route_pdes(route, elements)
+    control_threshold = pde * (control_percentage / 100)
+    
+    exposure = measured[np.newaxis, :, :] * doses[:, np.newaxis, np.newaxis]
+    situation = np.where(exposure > pde, 3, np.where(exposure > control_threshold, 2, 1)).astype(np.int8)
+    situation[:, :, np.isnan(pde)] = 0
+    return {
+        'doses': doses,
+        'batches': list(batch_results.batch_ids),
+        'elements': elements,
+        'situation': situation,
+        'element_situation': situation.max(axis=1, initial=1),
+        'overall_situation': situation.reshape(len(doses), -1).max(axis=1, initial=1),
+    }
+
+def evaluate_portfolio(products, measurements, reference=None):
+    """Evaluate many products against their batch results in one broadcasted pass
+
+    products has one row per product with columns 'product', 'daily_dose', 'route', and optionally
+    'control_percentage' (default 30) and 'elements' (list or space/comma separated string; default: every
+    measured element). measurements is long-format with columns 'product', 'batch', 'element', 'value';
+    missing values count as 0 like in the batch store. Rows for unknown products, unknown elements or
+    elements outside the product's element set are dropped.
+
+    Returns a dict with 'results' (one row per product × batch × element with PDE, MPC, control limit,
+    exposure, ratio and situation code as in evaluate_compliance) and 'products' (one row per product with
+    batch count, overall situation, 'compliant' (every result below the control threshold, as in the reports)
+    and 'below_pde').
+    """
+    reference = pde_reference if reference is None else reference
+    products = pd.DataFrame(products).reset_index(drop=True)
+    if 'control_percentage' not in products.columns:
+        products['control_percentage'] = 30
+    products['control_percentage'] = products['control_percentage'].fillna(30)
+    product_index = pd.Index(products['product'])
+    if not product_index.is_unique:
+        raise ValueError("Duplicate products in the portfolio")
+    route_indexes = products['route'].map(reference['route_index'])
+    if route_indexes.isna().any():
+        unknown = sorted(set(products.loc[route_indexes.isna(), 'route'].map(str)))
+        raise ValueError(f"Unknown route(s): {', '.join(unknown)}")
+    route_indexes = route_indexes.to_numpy(dtype=int)
+    daily_doses = products['daily_dose'].to_numpy(dtype=float)
+    control_percentages = products['control_percentage'].to_numpy(dtype=float)
+    n_elements = len(reference['elements'])
+    
+    measurements = pd.DataFrame(measurements)
+    product_positions = product_index.get_indexer(measurements['product'])
+    element_positions = measurements['element'].map(reference['element_index']).fillna(-1).to_numpy(dtype=int)
+    keep = (product_positions >= 0) & (element_positions >= 0)
+    
+    # Restrict each product to its own element set through (product, element) pair codes
+    if 'elements' in products.columns:
+        element_sets = products['elements'].map(
+            lambda elements: re.split(r"[\s,;]+", elements.strip()) if isinstance(elements, str)
+            else (elements if isinstance(elements, (list, tuple, set)) else None))
+        pair_codes = [i * n_elements + reference['element_index'][element]
+                      for i, elements in enumerate(element_sets) if elements is not None
+                      for element in elements if element in reference['element_index']]
+        unrestricted = np.array([elements is None for elements in element_sets], dtype=bool)
+        codes = product_positions * n_elements + element_positions
+        keep &= np.isin(codes, pair_codes) | unrestricted[np.maximum(product_positions, 0)]
+    
+    measurements = measurements.loc[keep]
+    product_positions = product_positions[keep]
+    element_positions = element_positions[keep]
+    
+    measured = np.nan_to_num(measurements['value'].to_numpy(dtype=float), nan=0.0)
+    daily_dose = daily_doses[product_positions]
+    control_percentage = control_percentages[product_positions]
+    pde = reference['pde'][element_positions, route_indexes[product_positions]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mpc = pde / daily_dose
+        control_limit = mpc * (control_percentage / 100)
+        control_threshold = pde * (control_percentage / 100)
+        exposure = measured * daily_dose
+        ratio = exposure / pde
+    situation = np.where(exposure > pde, 3, np.where(exposure > control_threshold, 2, 1)).astype(np.int8)
+    situation[np.isnan(pde)] = 0
+    
+    results = pd.DataFrame({
+        'product': measurements['product'].to_numpy(),
+        'batch': measurements['batch'].to_numpy(),
+        'element': measurements['element'].to_numpy(),
+        'measured': measured,
+        'daily_dose': daily_dose,
+        'route': products['route'].to_numpy()[product_positions],
+        'control_percentage': control_percentage,
+        'pde': pde,
+        'mpc': mpc,
+        'control_limit': control_limit,
+        'exposure': exposure,
+        'control_threshold': control_threshold,
+        'ratio': ratio,
+        'situation': situation,
+    })
+    
+    overall_situation = np.ones(len(products), dtype=np.int8)
+    np.maximum.at(overall_situation, product_positions, situation)
+    batch_counts = results.groupby(product_positions)['batch'].nunique()
+    summary = products[['product', 'daily_dose', 'route', 'control_percentage']].copy()
+    summary['batches'] = batch_counts.reindex(range(len(products)), fill_value=0).to_numpy()
+    summary['overall_situation'] = overall_situation
+    summary['compliant'] = overall_situation < 2  # As in evaluate_compliance and the reports
+    summary['below_pde'] = overall_situation < 3
+    return {'results': results, 'products': summary}
+
+def component_exposure_table(concentrations, masses, route, elements=None):
+    """ICH Q3D Option 2b exposure: daily amount of each element summed over the drug product components
+
+    concentrations is a component × element frame of measured or expected levels (µg/g; NaN counts as 0) and
+    masses a formulation × component frame of component mass per daily dose (g/day; NaN counts as 0). Every
+    formulation is evaluated with one matrix product, exposure = masses @ concentrations (µg/day). Components
+    missing from concentrations are an error; components not in masses are simply not used. Returns the
+    exposure_ratio_table layout keyed by 'formulations' and 'components' instead of batches, so
+    classify_compliance can classify it.
+    """
+    concentrations = pd.DataFrame(concentrations)
+    masses = pd.DataFrame(masses)
+    if elements is None:
+        elements = list(concentrations.columns)
+    elements = list(elements)
+    unknown = [component for component in masses.columns if component not in concentrations.index]
+    if unknown:
+        raise ValueError(f"No concentrations for component(s): {', '.join(map(str, unknown))}")
+    if not concentrations.index.is_unique:
+        raise ValueError("Duplicate components in the concentration matrix")
+    
+    concentration_matrix = np.nan_to_num(
+        concentrations.reindex(index=masses.columns, columns=elements).to_numpy(dtype=float), nan=0.0)
+    mass_matrix = np.nan_to_num(masses.to_numpy(dtype=float), nan=0.0)
+    exposure = mass_matrix @ concentration_matrix
+    pde = get_route_pdes(route, elements)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = exposure / pde
+    return {
+        'formulations': list(masses.index),
+        'components': list(masses.columns),
+        'elements': elements,
+        'masses': mass_matrix,
+        'concentrations': concentration_matrix,
+        'exposure': exposure,
+        'pde': pde,
+        'ratio': ratio,
+    }
+
+def evaluate_components(concentrations, masses, route, control_percentage=30, elements=None):
+    """Classify every formulation × element Option 2b exposure against its PDE and control threshold
+
+    Returns the classify_compliance layout (situation codes per formulation × element) plus
+    'formulation_situation' and a 'summary' frame with one row per formulation: total mass, worst situation,
+    the element closest to its PDE and the component contributing most of it.
+    """
+    table = component_exposure_table(concentrations, masses, route, elements)
+    compliance = classify_compliance(table, control_percentage)
+    formulation_situation = compliance['situation'].max(axis=1, initial=1)
+    
+    # Element closest to its PDE per formulation, and which component brings most of that element
+    with np.errstate(invalid='ignore'):
+        ratio = np.where(np.isnan(table['ratio']), -np.inf, table['ratio'])
+    n = len(table['formulations'])
+    worst = ratio.argmax(axis=1) if ratio.shape[1] else np.zeros(n, dtype=int)
+    worst_ratio = ratio[np.arange(n), worst] if ratio.shape[1] else np.full(n, -np.inf)
+    has_worst = np.isfinite(worst_ratio)
+    contributions = table['masses'] * table['concentrations'][:, worst].T if table['components'] else np.zeros((n, 0))
+    main = contributions.argmax(axis=1) if contributions.shape[1] else np.zeros(n, dtype=int)
+    main_share = contributions[np.arange(n), main] if contributions.shape[1] else np.zeros(n)
+    has_main = has_worst & (main_share > 0)
+    
+    elements = np.array(table['elements'] + [None], dtype=object)
+    components = np.array(table['components'] + [None], dtype=object)
+    compliance['formulation_situation'] = formulation_situation
+    compliance['summary'] = pd.DataFrame({
+        'Formulation': table['formulations'],
+        'Total mass (g/day)': table['masses'].sum(axis=1),
+        'Situation': formulation_situation,
+        'Worst element': elements[np.where(has_worst, worst, -1)],
+        'Max % of PDE': np.where(has_worst, worst_ratio * 100, np.nan),
+        'Main contributor': components[np.where(has_main, main, -1)],
+    })
+    return compliance
+
+def _exceedance_counts(measured, sd, control_limit, pde_limit, draws, seed_sequence):
+    """Draw measured values for one chunk and count, per batch × element and per batch, the draws above the
+    control limit and above the PDE limit (concentrations, µg/g)"""
+    noise = np.random.default_rng(seed_sequence).standard_normal((draws,) + measured.shape, dtype=np.float32)
+    noise *= sd
+    noise += measured
+    above_control = noise > control_limit
+    above_pde = noise > pde_limit
+    return (above_control.sum(axis=0), above_pde.sum(axis=0),
+            above_control.any(axis=2).sum(axis=0), above_pde.any(axis=2).sum(axis=0))
+
+def simulate_exceedance(batch_results, route, daily_dose, elements, control_percentage=30, relative_uncertainty=0.0,
+                        sd=None, coverage_factor=2, draws=100000, seed=0, chunk_draws=None, workers=None,
+                        max_chunk_bytes=64 * 1024 * 1024):
+    """Monte Carlo probability that each batch result exceeds the control threshold and the PDE
+
+    Measured values are drawn as normal(measured, sd) in batch × element × draw blocks of float32. sd comes from the
+    per-batch standard deviations where given (a batch × element array in elements order, or a frame indexed
+    by batch with element columns; µg/g) and otherwise from the relative expanded uncertainty (a fraction, one
+    value or a {element: fraction} dict) divided by the coverage factor. Draws are split into chunks of at
+    most max_chunk_bytes of samples, each with its own child of the seed, so results depend only on seed and
+    chunk size; with workers > 1 the chunks run in a process pool. Missing and below-LOD results are taken
+    as 0 with no uncertainty, as in the batch store.
+
+    Returns 'p_above_control' and 'p_above_pde' (batch × element; NaN where the element has no PDE),
+    'batch_p_above_control' and 'batch_p_above_pde' (any element of the batch) and the 'sd' used.
+    """
+    elements = list(elements)
+    if isinstance(batch_results, dict):
+        batch_results = BatchResultStore.from_dict(batch_results, elements)
+    measured, missing = batch_results.matrix(elements)
+    measured = np.where(missing, 0.0, measured)
+    
+    if isinstance(relative_uncertainty, dict):
+        relative_uncertainty = np.array([relative_uncertainty.get(element, 0.0) for element in elements], dtype=float)
+    standard_deviation = measured * (np.asarray(relative_uncertainty, dtype=float) / coverage_factor)
+    if sd is not None:
+        if isinstance(sd, pd.DataFrame):
+            sd = sd.reindex(index=batch_results.batch_ids, columns=elements).to_numpy(dtype=float)
+        sd = np.broadcast_to(np.asarray(sd, dtype=float), measured.shape)
+        standard_deviation = np.where(np.isnan(sd), standard_deviation, sd)
+    standard_deviation = np.where(missing, 0.0, standard_deviation)
+    
+    pde = get_route_pdes(route, elements)
+    pde_limit = pde / daily_dose
+    control_limit = pde_limit * (control_percentage / 100)
+    
+    if chunk_draws is None:
+        chunk_draws = max_chunk_bytes // max(measured.size * 4, 1)
+    chunk_draws = int(max(1, min(chunk_draws, draws)))
+    chunk_sizes = [chunk_draws] * (draws // chunk_draws) + ([draws % chunk_draws] if draws % chunk_draws else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    jobs = [(measured, standard_deviation, control_limit, pde_limit, size, seed_sequence)
+            for size, seed_sequence in zip(chunk_sizes, seeds)]
+    
+    counts = [np.zeros(measured.shape, dtype=np.int64), np.zeros(measured.shape, dtype=np.int64),
+              np.zeros(len(measured), dtype=np.int64), np.zeros(len(measured), dtype=np.int64)]
+    if workers is not None and workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunk_counts = pool.map(_exceedance_counts, *zip(*jobs))
+            for chunk in chunk_counts:
+                for total, count in zip(counts, chunk):
+                    total += count
+    else:
+        for job in jobs:
+            for total, count in zip(counts, _exceedance_counts(*job)):
+                total += count
+    
+    no_pde = np.isnan(pde)
+    p_above_control, p_above_pde = (np.where(no_pde, np.nan, count / draws) for count in counts[:2])
+    return {
+        'batches': list(batch_results.batch_ids),
+        'elements': elements,
+        'draws': draws,
+        'seed': seed,
+        'sd': standard_deviation,
+        'p_above_control': p_above_control,
+        'p_above_pde': p_above_pde,
+        'batch_p_above_control': counts[2] / draws,
+        'batch_p_above_pde': counts[3] / draws,
+    }
+
+def _build_id_card_template():
+    """Build the R&D Medicinal Product ID Card (Sections 2-4) layout with placeholders for product data"""
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    
+    doc = _new_template_document()
+    
+    # Title
+    title = doc.add_heading('R&D Medicinal product ID card', 0)
+    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    subtitle = doc.add_paragraph('- -  Formula reference: {{actime_code}}  Evaluation of elemental impurities (ICH Q3D) for Phase 1 & 2')
+    subtitle.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    p = doc.add_paragraph('For Investigational Medicinal Product (IMP) in Phase 1 and 2\n'
+                         'This document (following the requirements of STD000040 and SD000133) is the only document to be filled out during early development phases, '
+                         'in order to perform an evaluation of the elemental impurities to be tested in the drug product and to justify the control strategy.\n'
+                         'This evaluation must be carried out by the site producing the R&D drug product.')
+    
+    # Add some space
+    doc.add_paragraph()
+    
+    # SECTION 2: RESULT OF DRUG PRODUCT TESTING
+    doc.add_heading('2 RESULT OF DRUG PRODUCT TESTING', level=1)
+    
+    # 2.1 Elemental impurities tested
+    doc.add_heading('2.1 Elemental impurities tested', level=2)
+    
+    p = doc.add_paragraph('The elemental impurities as listed in the guideline: STD-00040, must be tested. '
+                         'In case of elemental impurities exclusion, the justification should be attached in appendix of this risk assessment.')
+    
+    p = doc.add_paragraph('ICH classification:\n'
+                         'Class 1: As, Cd, Hg, Pb\n'
+                         'Class 2A: Co, Ni, V\n'
+                         'Class 2B: Ag, Au, Ir, Os, Pd, Pt, Rh, Ru, Se, Tl\n'
+                         'Class 3: Ba, Cr, Cu, Li, Mo, Sb, Sn\n'
+                         'other: Al, B, Ca, Fe, K, Mg, Mn, Na, W, Zn')
+    
+    p = doc.add_paragraph('For the elemental impurities (EI) tested are:')
+    
+    # Create a table for EI tested, ticked according to the route
+    rows = [
+        ("{{oral_box}}", "Class 1 and 2a EI (if for oral route)"),
+        ("{{parenteral_box}}", "Class 1, 2a and partially 3 EI (Li, Sb, Cu) (if for parenteral route)"),
+        ("{{inhalation_box}}", "Class 1, 2a and 3 EI (if for inhalation route)"),
+        ("☐", "Other potential EI identified on the R&D MP ID Card\nif yes, which?"),
+        ("☐", "Intentionally added EI\nif yes, which?"),
+    ]
+    table = doc.add_table(rows=len(rows), cols=2)
+    table.style = 'Table Grid'
+    for i, (box, label) in enumerate(rows):
+        table.cell(i, 0).text = box
+        table.cell(i, 1).text = label
+    
+    # Add EI limits table
+    doc.add_paragraph()
+    p = doc.add_paragraph()
+    p.add_run("Elemental impurities limits in {{product_name}} {{product_form}} (ICH Q3D option 3) with daily dose of {{daily_dose}} g").bold = True
+    doc.add_paragraph('[[limits_table]]')
+    
+    # 2.2 Drug product analyses
+    doc.add_heading('2.2 Drug product analyses', level=2)
+    
+    doc.add_paragraph("{{batch_count}} batch(es) of {{product_name}} intended for human administration was tested by ICP/MS or other appropriate method:")
+    doc.add_paragraph("Batch no.: {{batch_text}}")
+    
+    # 2.3 Elemental impurities results and Analysis of data
+    doc.add_heading('2.3 Elemental impurities results and Analysis of data', level=2)
+    
+    p = doc.add_paragraph("Batches were tested by ICP/MS or other appropriate method. The EI results obtained for each batch are included below and the complete report is attached in Appendix 1 of this R&D MP ID Card.")
+    
+    p = doc.add_paragraph("(Please attach report or CoA as Appendix 1)")
+    doc.add_paragraph('[[batch_results_table]]')
+    
+    # 2.3.1 Checking compliance with the maximum permitted concentration
+    doc.add_heading('2.3.1 Checking compliance with the maximum permitted concentration for the finished product', level=3)
+    
+    p = doc.add_paragraph("The next step in the risk assessment was to compare, for each elemental impurity, the measured concentration in the finished product to the maximum permitted concentration.")
+    
+    p = doc.add_paragraph("The maximum permitted concentration of each elemental impurity was set according to Appendix 7.4 of the STD-000040, if the dose is below 10 g/day.")
+    doc.add_paragraph('[[high_dose_note]]')
+    
+    # 2.3.2 Defining control strategy
+    doc.add_heading('2.3.2 Defining control strategy for the drug product', level=3)
+    
+    p = doc.add_paragraph("A limit was also applied during the assessment of elemental impurities to determine if additional control elements may be required to ensure that the PDE is not exceeded in the drug product.")
+    
+    p = doc.add_paragraph("This limit (called control threshold), was defined as {{control_percentage}}% of the PDE of the specific elemental impurity under consideration, according to Option 3 ICH Q3D guideline.")
+    
+    p = doc.add_paragraph("Each elemental impurity will be classified according to their level (see table below):")
+    
+    # Create table for control strategy
+    table = doc.add_table(rows=5, cols=2)
+    table.style = 'Table Grid'
+    
+    # Header row
+    cell = table.cell(0, 0)
+    cell.text = "Elemental impurities level"
+    cell.paragraphs[0].runs[0].bold = True
+    
+    cell = table.cell(0, 1)
+    cell.text = "Actions and/or control strategy"
+    cell.paragraphs[0].runs[0].bold = True
+    
+    # Row 1
+    cell = table.cell(1, 0)
+    cell.text = "Elements that are not likely to be present:\n* Class 2B that have not been intentionally added\n* Class 3 for oral route\n* Elements not identified as likely to be present in the risk assessment"
+    
+    cell = table.cell(1, 1)
+    cell.text = "No further action required"
+    
+    # Row 2
+    cell = table.cell(2, 0)
+    cell.text = "Elements <30% PDE (below control threshold)"
+    
+    cell = table.cell(2, 1)
+    cell.text = "No further action required – existing controls to be considered as adequate"
+    
+    # Row 3
+    cell = table.cell(3, 0)
+    cell.text = "Elements from 30% up to 100% of PDE"
+    
+    cell = table.cell(3, 1)
+    cell.text = "Define additional controls:\n* limits on DP or components\n* Define upstream control and impact on elemental impurities level"
+    
+    # Row 4
+    cell = table.cell(4, 0)
+    cell.text = "Elements > PDE"
+    
+    cell = table.cell(4, 1)
+    cell.text = "If higher level justified, establish limits on DP or components\nOR\nIf not justified, define upstream control and impact on elemental impurities level\nOR\nIdentify the source of the EI and replace the source\nEvaluate safety assessment and rationale to support levels higher than the PDE for specific elements."
+    
+    # SECTION 3: SUMMARY AND FINAL CONCLUSION
+    doc.add_heading('3 SUMMARY AND FINAL CONCLUSION', level=1)
+    
+    p = doc.add_paragraph("To support this risk assessment, the following batch(es) of {{product_name}} was tested: {{batch_text}}")
+    
+    p = doc.add_paragraph("The tested EI were selected based on the information provided in this R&D MP ID card.")
+    
+    p = doc.add_paragraph("The risk assessment carried out for {{product_name}} demonstrated that:")
+    doc.add_paragraph('[[situation]]')
+    
+    # SECTION 4: APPENDICES
+    doc.add_heading('4 APPENDICES', level=1)
+    
+    p = doc.add_paragraph()
+    p.add_run("Appendix 1").bold = True
+    p = doc.add_paragraph("Copy/paste complete analytical report")
+    return doc
+
+def create_id_card_document(form_data, calculation_data, batch_results, control_percentage=30, compliance=None,
+                            batch_columns=id_card_batch_columns):
+    """Function to create R&D Medicinal Product ID Card document for Sections 2, 3, and 4"""
+    route = form_data.get('route_of_administration', 'parenteral')
+    daily_dose = form_data.get('daily_dose', 0)
+    selected_elements = [element for element, checked in form_data.get('elements', {}).items() if checked]
+    if compliance is None:
+        compliance = evaluate_compliance(batch_results, calculation_data, route, daily_dose,
+                                         control_percentage, selected_elements)
+    element_index = {element: j for j, element in enumerate(compliance['elements'])}
+    limits = _index_by_element(calculation_data)
+    
+    # Get batch numbers
+    batch_names = compliance['batches']
+    batch_text = ", ".join(batch_names) if batch_names else "N/A"
+    
+    def fill_limits_table(doc, anchor):
+        # Header row
+        rows = [["Elemental impurity tested", "Permitted Daily Exposure (μg/day)",
+                 "Maximum permitted concentration (μg/g)", f"{control_percentage}% PDE (μg/g)", "Reporting limit (μg/g)"]]
+        
+        # Data rows
+        for element in selected_elements:
+            if element in limits.index:
+                pde = limits.at[element, f'PDE ({route}) µg/day']
+                mpc = limits.at[element, 'MPC µg/g']
+                control_limit = limits.at[element, f'Control Strategy Limit ({control_percentage}%) µg/g']
+                rows.append([element, str(pde), str(mpc), str(control_limit),
+                             str(round(control_limit / 3, 3))])  # Typical reporting limit is 1/3 of control limit
+            else:
+                rows.append([None] * 5)
+        _insert_bulk_table_before(doc, anchor, rows)
+    
+    def fill_batch_results_table(doc, anchor):
+        # Element and reporting limit columns, repeated at the start of every table chunk
+        label_rows = []
+        batch_rows = []
+        for element in selected_elements:
+            if element in limits.index:
+                control_limit = limits.at[element, f'Control Strategy Limit ({control_percentage}%) µg/g']
+                reporting_limit = round(control_limit / 3, 3)  # Typical reporting limit is 1/3 of control limit
+                label_rows.append([element, str(reporting_limit)])
+                
+                # Batch results
+                measured_column = compliance['measured'][:, element_index[element]]
+                censored_column = compliance['missing'][:, element_index[element]]
+                batch_rows.append([f"< {reporting_limit}" if censored or measured == 0 else f"{measured:.3f}"
+                                   for measured, censored in zip(measured_column.tolist(), censored_column.tolist())])
+            else:
+                label_rows.append([element, None])
+                batch_rows.append([None] * len(batch_names))
+        
+        # Split the batches into tables of at most batch_columns result columns so wide series stay on the page
+        chunks = _batch_column_chunks(len(batch_names), batch_columns)
+        for k, (start, stop) in enumerate(chunks):
+            if len(chunks) > 1:
+                p = anchor.insert_paragraph_before()
+                p.add_run(f"Batch results {start + 1} to {stop} of {len(batch_names)}").italic = True
+            rows = [["Elemental impurity tested", "Reporting limit (µg/g)"] +
+                    [f"Batch {batch_name} result (µg/g)" for batch_name in batch_names[start:stop]]]
+            for label_row, batch_row in zip(label_rows, batch_rows):
+                rows.append(label_row + batch_row[start:stop])
+            _insert_bulk_table_before(doc, anchor, rows)
+    
+    def fill_high_dose_note(doc, anchor):
+        if daily_dose > 10:
+            anchor.insert_paragraph_before("Note: If a dose higher than 10g/day is used or if a specified daily intake is set, the maximum permitted concentration of each elemental impurity must be calculated using the daily intake of drug product and the PDE of the elemental impurity using the following formula:")
+            anchor.insert_paragraph_before("Maximum permitted concentration (µg/g) = PDE (µg/day) / Maximum daily dose (g/day)")
+    
+    def fill_situation(doc, anchor):
+        # Determine compliance situation based on batch results
+        situation = determine_compliance_situation(batch_results, calculation_data, route, daily_dose, control_percentage,
+                                                   compliance=compliance)
+        add_paragraph = anchor.insert_paragraph_before
+        
+        if situation == 1:
+            # Situation 1: All elements < 30% PDE
+            p = add_paragraph()
+            p.add_run("Situation 1").bold = True
+            
+            add_paragraph("The drug product complies with the ICH Q3D requirements.")
+            
+            add_paragraph("For the tested elements, the EI level is in a range of less than the limit of quantitation to the control threshold (30% of the PDE).")
+            
+            add_paragraph("As a consequence,")
+            add_paragraph("• The safety risk associated to the presence of EI in the drug product can be considered as negligible, close to nil. There is no risk for the patients.")
+            add_paragraph("• No additional controls (other than those implicit in the process and material controls already in place) are required to ensure that the drug product meets the requirements of ICH Q3D. Existing controls are adequate.")
+        
+        elif situation == 2:
+            # Situation 2: Some elements between 30% and 100% PDE
+            p = add_paragraph()
+            p.add_run("Situation 2").bold = True
+            
+            add_paragraph("The drug product complies with the ICH Q3D requirements.")
+            
+            # Get elements between 30% and 100% PDE
+            elements_above_threshold = get_elements_above_threshold(batch_results, calculation_data, route, daily_dose,
+                                                                    control_percentage, compliance=compliance)
+            
+            if elements_above_threshold:
+                add_paragraph("For the following elements, the EI level in the drug product is greater than the control threshold (30% of the PDE) and less than the PDE:")
+                for element in elements_above_threshold:
+                    add_paragraph(f"• {element}")
+                add_paragraph("Other observed EI levels are below the control threshold.")
+            else:
+                add_paragraph("For the tested elements, the EI level in the drug product is greater than the control threshold (30% of the PDE) and less than the PDE.")
+            
+            add_paragraph("As a consequence,")
+            add_paragraph("• The EI levels determined in the drug product, do not pose any safety risk for the patients.")
+            add_paragraph("• The current controls may be sufficient to ensure the requirements are met. However, to ensure the PDE(s) will not be exceeded, it is required")
+            add_paragraph("  - to determine source of impurity(ies) and define an action plan to reduce its(their) content(s)")
+            add_paragraph("  - to establish limits on the identified impurity(ies) in the drug product or component.")
+        
+        elif situation == 3:
+            # Situation 3: Some elements > PDE
+            p = add_paragraph()
+            p.add_run("Situation 3").bold = True
+            
+            add_paragraph("The drug product does not comply with the ICH Q3D requirements")
+            
+            # Get elements above PDE
+            elements_above_pde = get_elements_above_pde(batch_results, calculation_data, route, daily_dose,
+                                                        compliance=compliance)
+            
+            add_paragraph("For the following elements, the EI level exceeds the PDE:")
+            for element in elements_above_pde:
+                add_paragraph(f"• {element}")
+            
+            add_paragraph("As a consequence,")
+            add_paragraph("• The safety risk could not be fully assessed. Additional information is needed, to properly evaluate the situation.")
+            add_paragraph("• Based on the output of this additional assessment,")
+            add_paragraph("  - the EI level(s) higher than established PDE(s) could be justified through a strong scientific rationale. And limit should be established to control the identified impurity(ies) in the drug product or component.")
+            add_paragraph("  - or the EI level(s) cannot be justified. In this case, it is required to identify the source of the impurity(ies) and to define an action plan to reduce the level(s) in the drug product. Define upstream control or replace the source and impact on elemental impurities level.")
+            
+            add_paragraph("For situation 3/ and sometimes 2/, you need to perform an additional assessment. This assessment and its conclusion should be attached to your Risk Assessment Report, and a Final risk Assessment conclusion should be provided.")
+    
+    fields = {
+        'actime_code': form_data.get('actime_code', 'N/A'),
+        'oral_box': "☒" if route == 'oral' else "☐",
+        'parenteral_box': "☒" if route == 'parenteral' else "☐",
+        'inhalation_box': "☒" if route == 'inhalation' else "☐",
+        'product_name': form_data.get('product_name', 'Product'),
+        'product_form': form_data.get('product_form', 'injectable form'),
+        'daily_dose': daily_dose,
+        'batch_count': len(batch_names),
+        'batch_text': batch_text,
+        'control_percentage': control_percentage,
+    }
+    doc = render_docx_template(load_docx_template('id_card'), fields, {
+        'limits_table': fill_limits_table,
+        'batch_results_table': fill_batch_results_table,
+        'high_dose_note': fill_high_dose_note,
+        'situation': fill_situation,
+    })
+    
+    # Save to BytesIO
+    doc_io = io.BytesIO()
+    doc.save(doc_io)
+    doc_io.seek(0)
+    return doc_io
+
+# Document templates built in memory by name; any other template name is read as a .docx path
+docx_template_builders = {
+    'analysis_request': _build_analysis_request_template,
+    'id_card': _build_id_card_template,
+}
+
+@functools.lru_cache(maxsize=None)
+def load_docx_template(name):
+    """Parse a document template once and keep the parsed package in memory for the life of the process"""
+    from docx import Document
+    
+    if name in docx_template_builders:
+        return docx_template_builders[name]()
+    return Document(name)
+
+def render_docx_template(template, fields=None, blocks=None):
+    """Clone a parsed template and fill its placeholders
+
+    Every "{{name}}" inside a run is replaced by str(fields[name]). A paragraph whose whole text is
+    "[[name]]" is an anchor for dynamic content: blocks[name](doc, anchor) inserts paragraphs or tables
+    before it, then the anchor is removed. The cached template itself is never modified.
+    """
+    from docx.document import Document as DocxDocument
+    from docx.text.run import Run
+    
+    fields = fields or {}
+    blocks = blocks or {}
+    # lxml does not share copies between references, so wrap the cloned part in a fresh Document
+    # rather than reuse the copied wrapper and its stale cached body
+    part = copy.deepcopy(template.part)
+    doc = DocxDocument(part.element, part)
+    
+    def substitute(match):
+        name = match.group(1)
+        return str(fields[name]) if name in fields else match.group(0)
+    
+    for run_element in doc.element.body.xpath('.//w:r[w:t[contains(., "{{")]]'):
+        run = Run(run_element, None)
+        run.text = _placeholder_pattern.sub(substitute, run.text)
+    
+    anchors = [(paragraph, _anchor_pattern.match(paragraph.text)) for paragraph in doc.paragraphs]
+    for anchor, match in anchors:
+        if match is None:
+            continue
+        if match.group(1) in blocks:
+            blocks[match.group(1)](doc, anchor)
+        anchor._p.getparent().remove(anchor._p)
+    return doc
+
+def _tier_rows(compliance, control_tiers):
+    """Rows of the control % tier table: worst % of PDE, then the worst situation at each tier
+
+    Each row is (label, [(text, compliant)]) per element; compliant is None for cells without a PDE.
+    """
+    summary = tier_summary(compliance, control_tiers)
+    rows = [("Max % of PDE", [("-", None) if np.isnan(value) else (f"{value:.1f}%", None)
+                              for value in summary['Max % of PDE'].tolist()])]
+    for control_tier in control_tiers:
+        rows.append((f"Situation at {control_tier}% of the PDE",
+                     [("-", None) if situation == 0 else (str(situation), situation < 2)
+                      for situation in summary[f'Situation at {control_tier}%'].tolist()]))
+    return rows
+
+def _prepare_report_data(daily_dose, route, selected_elements, mpc_data, batch_results, control_percentage=30,
+                         compliance=None, control_tiers=None):
+    """Gather the per-element limits and compliance flags shared by the Excel report writers"""
+    if compliance is None:
+        compliance = evaluate_compliance(batch_results, mpc_data, route, daily_dose, control_percentage, selected_elements)
+    
+    limits = _index_by_element(mpc_data)
+    mpcs, pdes, detection_limits = [], [], []
+    for element in selected_elements:
+        if element in limits.index:
+            mpcs.append(limits.at[element, 'MPC µg/g'])
+            pdes.append(limits.at[element, f'PDE ({route}) µg/day'])
+            control_limit = limits.at[element, f'Control Strategy Limit ({control_percentage}%) µg/g']
+            detection_limits.append(f"< {control_limit / 3:.3f}")  # Typical detection limit is 1/3 of control limit
+        else:
+            mpcs.append(None)
+            pdes.append(None)
+            detection_limits.append("< LOD")
+    
+    return {
+        'compliance': compliance,
+        'mpcs': mpcs,
+        'pdes': pdes,
+        'detection_limits': detection_limits,
+        'element_compliance': compliance['compliant'].all(axis=0),
+        'all_compliant': bool(compliance['compliant'].all()),
+        'tier_rows': _tier_rows(compliance, sorted(control_tiers)) if control_tiers else [],
+    }
+
+def _format_measured_row(row_values, detection_limits, row_censored=None):
+    """Format one batch row of results, showing the detection limit where censored, missing or zero"""
+    if row_censored is None:
+        row_censored = [False] * len(row_values)
+    return [detection_limits[j] if censored or measured == 0 else f"{measured:.3f}"
+            for j, (measured, censored) in enumerate(zip(row_values, row_censored))]
+
+def create_excel_report(product_name, daily_dose, route, selected_elements, mpc_data, batch_results, control_percentage=30,
+                        compliance=None, control_tiers=None):
+    """Create an Excel report with three tables matching the format
+
+    With control_tiers (e.g. [30, 50]) Section 3 also gets a table with each element's worst % of PDE and its
+    situation at every tier side by side.
+    """
+    import openpyxl
+    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+    from openpyxl.utils import get_column_letter
+    
+    # Create a new workbook
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Elemental Impurities Report"
+    
+    # Define styles
+    title_font = Font(name='Arial', size=12, bold=True)
+    header_font = Font(name='Arial', size=11, bold=True)
+    normal_font = Font(name='Arial', size=10)
+    
+    # Define fills
+    header_fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
+    compliant_fill = PatternFill(start_color="90EE90", end_color="90EE90", fill_type="solid")
+    non_compliant_fill = PatternFill(start_color="FFB6C1", end_color="FFB6C1", fill_type="solid")
+    
+    # Define borders
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    
+    # Define alignment
+    center_align = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    left_align = Alignment(horizontal='left', vertical='center', wrap_text=True)
+    
+    # Check compliance for all batches and elements
+    report_data = _prepare_report_data(daily_dose, route, selected_elements, mpc_data, batch_results,
+                                       control_percentage, compliance, control_tiers)
+    compliance = report_data['compliance']
+    measured_values = compliance['measured']
+    censored_values = compliance['missing']
+    compliance_status = compliance['compliant']
+    all_compliant = report_data['all_compliant']
+    detection_limits = report_data['detection_limits']
+    
+    # Add title
+    ws['A1'] = f"Table 8: Summary of (i) The Maximum Permitted Concentration (µg/g) (Section1), (ii) The analytical results (Section2), and (iii) The Control strategy decisions (Section3), regarding the Elemental Impurities examined in the current risk assessment study"
+    ws.merge_cells('A1:L1')
+    ws['A1'].font = title_font
+    ws['A1'].alignment = left_align
+    
+    # Add Section 1 title
+    row = 3
+    ws[f'A{row}'] = "Section1 Maximum permitted concentration (µg/g) of each Elemental impurity"
+    ws.merge_cells(f'A{row}:L{row}')
+    ws[f'A{row}'].font = header_font
+    ws[f'A{row}'].alignment = left_align
+    
+    # Add Section 1 table headers
+    row += 2
+    headers = ["", "Max Daily Amount of MP (g/patient)"] + selected_elements
+    for col, header in enumerate(headers, 1):
+        ws.cell(row=row, column=col).value = header
+        ws.cell(row=row, column=col).font = header_font
+        ws.cell(row=row, column=col).alignment = center_align
+        ws.cell(row=row, column=col).fill = header_fill
+        ws.cell(row=row, column=col).border = thin_border
+    
+    # Add Section 1 data
+    row += 1
+    ws.cell(row=row, column=1).value = product_name
+    ws.cell(row=row, column=1).font = normal_font
+    ws.cell(row=row, column=1).alignment = left_align
+    ws.cell(row=row, column=1).border = thin_border
+    
+    ws.cell(row=row, column=2).value = "-"
+    ws.cell(row=row, column=2).font = normal_font
+    ws.cell(row=row, column=2).alignment = center_align
+    ws.cell(row=row, column=2).border = thin_border
+    
+    for col, element in enumerate(selected_elements, 3):
+        ws.cell(row=row, column=col).value = ""
+        ws.cell(row=row, column=col).font = normal_font
+        ws.cell(row=row, column=col).alignment = center_align
+        ws.cell(row=row, column=col).border = thin_border
+    
+    row += 1
+    ws.cell(row=row, column=1).value = "injectable form"
+    ws.cell(row=row, column=1).font = normal_font
+    ws.cell(row=row, column=1).alignment = left_align
+    ws.cell(row=row, column=1).border = thin_border
+    
+    ws.cell(row=row, column=2).value = f"{daily_dose} g/patient of MP"
+    ws.cell(row=row, column=2).font = normal_font
+    ws.cell(row=row, column=2).alignment = center_align
+    ws.cell(row=row, column=2).border = thin_border
+    
+    # Add MPC values
+    for col, mpc in enumerate(report_data['mpcs'], 3):
+        if mpc is not None:
+            ws.cell(row=row, column=col).value = mpc
+            ws.cell(row=row, column=col).font = normal_font
+            ws.cell(row=row, column=col).alignment = center_align
+            ws.cell(row=row, column=col).border = thin_border
+    
+    row += 1
+    ws.cell(row=row, column=1).value = ""
+    ws.cell(row=row, column=1).font = normal_font
+    ws.cell(row=row, column=1).alignment = left_align
+    ws.cell(row=row, column=1).border = thin_border
+    
+    ws.cell(row=row, column=2).value = f"Permitted Daily Exposure (µg/patient) according to Table A.2.1. in Appendix3"
+    ws.cell(row=row, column=2).font = normal_font
+    ws.cell(row=row, column=2).alignment = center_align
+    ws.cell(row=row, column=2).border = thin_border
+    
+    # Add PDE values
+    for col, pde in enumerate(report_data['pdes'], 3):
+        if pde is not None:
+            ws.cell(row=row, column=col).value = pde
+            ws.cell(row=row, column=col).font = normal_font
+            ws.cell(row=row, column=col).alignment = center_align
+            ws.cell(row=row, column=col).border = thin_border
+    
+    # Add footnote
+    row += 2
+    ws.cell(row=row, column=1).value = "(1) Calculated Max permitted concentration (µg/g) = Permitted Daily Exposure (µg/day)/ Max Daily Amount of MP (g/day)"
+    ws.merge_cells(f'A{row}:L{row}')
+    ws.cell(row=row, column=1).font = normal_font
+    ws.cell(row=row, column=1).alignment = left_align
+    
+    # Add Section 2 title
+    row += 2
+    ws.cell(row=row, column=1).value = "Section2 Analytical results (µg/g) and checking of compliance with ICH Q3D"
+    ws.merge_cells(f'A{row}:L{row}')
+    ws.cell(row=row, column=1).font = header_font
+    ws.cell(row=row, column=1).alignment = left_align
+    
+    # Add Section 2 table headers
+    row += 2
+    headers = ["", ""] + selected_elements
+    for col, header in enumerate(headers, 1):
+        ws.cell(row=row, column=col).value = header
+        ws.cell(row=row, column=col).font = header_font
+        ws.cell(row=row, column=col).alignment = center_align
+        ws.cell(row=row, column=col).fill = header_fill
+        ws.cell(row=row, column=col).border = thin_border
+    
+    # Add batch results
+    batch_names = compliance['batches']
+    for i, batch_name in enumerate(batch_names):
+        row += 1
+        ws.cell(row=row, column=1).value = f"PPQ {i+1}"
+        ws.cell(row=row, column=1).font = normal_font
+        ws.cell(row=row, column=1).alignment = center_align
+        ws.cell(row=row, column=1).border = thin_border
+        
+        ws.cell(row=row, column=2).value = batch_name
+        ws.cell(row=row, column=2).font = normal_font
+        ws.cell(row=row, column=2).alignment = center_align
+        ws.cell(row=row, column=2).border = thin_border
+        
+        # Add measured values for each element
+        formatted_row = _format_measured_row(measured_values[i].tolist(), detection_limits, censored_values[i].tolist())
+        for j, col in enumerate(range(3, len(selected_elements) + 3)):
+            formatted_value = formatted_row[j]
+            is_compliant = compliance_status[i, j]
+            
+            ws.cell(row=row, column=col).value = formatted_value
+            ws.cell(row=row, column=col).font = normal_font
+            ws.cell(row=row, column=col).alignment = center_align
+            ws.cell(row=row, column=col).border = thin_border
+            
+            # Apply color coding based on compliance
+            if not is_compliant:
+                ws.cell(row=row, column=col).fill = non_compliant_fill
+    
+    # Add compliance row
+    row += 2
+    ws.cell(row=row, column=1).value = "Element meets ICH Q3D"
+    ws.cell(row=row, column=1).font = header_font
+    ws.cell(row=row, column=1).alignment = center_align
+    ws.cell(row=row, column=1).border = thin_border
+    
+    ws.cell(row=row, column=2).value = ""
+    ws.cell(row=row, column=2).font = normal_font
+    ws.cell(row=row, column=2).alignment = center_align
+    ws.cell(row=row, column=2).border = thin_border
+    
+    for col, element in enumerate(selected_elements, 3):
+        ws.cell(row=row, column=col).value = element
+        ws.cell(row=row, column=col).font = header_font
+        ws.cell(row=row, column=col).alignment = center_align
+        ws.cell(row=row, column=col).border = thin_border
+    
+    row += 1
+    ws.cell(row=row, column=1).value = "Yes" if all_compliant else "No"
+    ws.cell(row=row, column=1).font = normal_font
+    ws.cell(row=row, column=1).alignment = center_align
+    ws.cell(row=row, column=1).border = thin_border
+    
+    ws.cell(row=row, column=2).value = ""
+    ws.cell(row=row, column=2).font = normal_font
+    ws.cell(row=row, column=2).alignment = center_align
+    ws.cell(row=row, column=2).border = thin_border
+    
+    # Check compliance for each element across all batches
+    element_compliance = report_data['element_compliance']
+    for col, element in enumerate(selected_elements, 3):
+        element_compliant = element_compliance[col - 3]
+        ws.cell(row=row, column=col).value = "Yes" if element_compliant else "No"
+        ws.cell(row=row, column=col).font = normal_font
+        ws.cell(row=row, column=col).alignment = center_align
+        ws.cell(row=row, column=col).border = thin_border
+        
+        # Apply color coding
+        if element_compliant:
+            ws.cell(row=row, column=col).fill = compliant_fill
+        else:
+            ws.cell(row=row, column=col).fill = non_compliant_fill
+    
+    # Add Section 3 title
+    row += 2
+    ws.cell(row=row, column=1).value = "Section3 Control strategy decisions"
+    ws.merge_cells(f'A{row}:L{row}')
+    ws.cell(row=row, column=1).font = header_font
+    ws.cell(row=row, column=1).alignment = left_align
+    
+    # Add Section 3 table headers
+    row += 2
+    headers = ["", f"Control Threshold ({control_percentage}% of the PDE) in µg/g"] + selected_elements
+    for col, header in enumerate(headers, 1):
+        ws.cell(row=row, column=col).value = header
+        ws.cell(row=row, column=col).font = header_font
+        ws.cell(row=row, column=col).alignment = center_align
+        ws.cell(row=row, column=col).fill = header_fill
+        ws.cell(row=row, column=col).border = thin_border
+    
+    # Add batch results again for Section 3
+    for i, batch_name in enumerate(batch_names):
+        row += 1
+        ws.cell(row=row, column=1).value = f"PPQ {i+1}"
+        ws.cell(row=row, column=1).font = normal_font
+        ws.cell(row=row, column=1).alignment = center_align
+        ws.cell(row=row, column=1).border = thin_border
+        
+        ws.cell(row=row, column=2).value = batch_name
+        ws.cell(row=row, column=2).font = normal_font
+        ws.cell(row=row, column=2).alignment = center_align
+        ws.cell(row=row, column=2).border = thin_border
+        
+        # Add measured values for each element (same as Section 2)
+        formatted_row = _format_measured_row(measured_values[i].tolist(), detection_limits, censored_values[i].tolist())
+        for j, col in enumerate(range(3, len(selected_elements) + 3)):
+            formatted_value = formatted_row[j]
+            is_compliant = compliance_status[i, j]
+            
+            ws.cell(row=row, column=col).value = formatted_value
+            ws.cell(row=row, column=col).font = normal_font
+            ws.cell(row=row, column=col).alignment = center_align
+            ws.cell(row=row, column=col).border = thin_border
+            
+            # Apply color coding based on compliance
+            if not is_compliant:
+                ws.cell(row=row, column=col).fill = non_compliant_fill
+    
+    # Add control % tiers side by side
+    if report_data['tier_rows']:
+        row += 2
+        for col, header in enumerate(["", "Control % tiers"] + selected_elements, 1):
+            ws.cell(row=row, column=col).value = header
+            ws.cell(row=row, column=col).font = header_font
+            ws.cell(row=row, column=col).alignment = center_align
+            ws.cell(row=row, column=col).fill = header_fill
+            ws.cell(row=row, column=col).border = thin_border
+        for label, cells in report_data['tier_rows']:
+            row += 1
+            for col, value in enumerate(["", label], 1):
+                ws.cell(row=row, column=col).value = value
+                ws.cell(row=row, column=col).font = normal_font
+                ws.cell(row=row, column=col).alignment = center_align
+                ws.cell(row=row, column=col).border = thin_border
+            for col, (value, is_compliant) in enumerate(cells, 3):
+                ws.cell(row=row, column=col).value = value
+                ws.cell(row=row, column=col).font = normal_font
+                ws.cell(row=row, column=col).alignment = center_align
+                ws.cell(row=row, column=col).border = thin_border
+                if is_compliant is not None:
+                    ws.cell(row=row, column=col).fill = compliant_fill if is_compliant else non_compliant_fill
+    
+    # Add conclusion
+    row += 2
+    ws.cell(row=row, column=1).value = "Conclusion"
+    ws.cell(row=row, column=1).font = header_font
+    ws.cell(row=row, column=1).alignment = left_align
+    
+    row += 1
+    if all_compliant:
+        conclusion_text = "No further action required – Existing controls to be considered as adequate"
+    else:
+        conclusion_text = "ACTION REQUIRED – Some elements exceed the control threshold. Further investigation and corrective actions needed."
+    
+    ws.cell(row=row, column=1).value = conclusion_text
+    ws.merge_cells(f'A{row}:L{row}')
+    ws.cell(row=row, column=1).font = normal_font
+    ws.cell(row=row, column=1).alignment = left_align
+    
+    if not all_compliant:
+        ws.cell(row=row, column=1).fill = non_compliant_fill
+    
+    # Add footnote
+    row += 2
+    ws.cell(row=row, column=1).value = f"(2) Control Threshold (µg/g) = {control_percentage/100} x calculated Max permitted concentration (µg/g)"
+    ws.merge_cells(f'A{row}:L{row}')
+    ws.cell(row=row, column=1).font = normal_font
+    ws.cell(row=row, column=1).alignment = left_align
+    
+    # Adjust column widths
+    for col in range(1, len(headers) + 1):
+        if col == 1:
+            ws.column_dimensions[get_column_letter(col)].width = 15
+        elif col == 2:
+            ws.column_dimensions[get_column_letter(col)].width = 30
+        else:
+            ws.column_dimensions[get_column_letter(col)].width = 12
+    
+    # Save to BytesIO
+    excel_buffer = io.BytesIO()
+    wb.save(excel_buffer)
+    excel_buffer.seek(0)
+    return excel_buffer
+
+def create_excel_report_streaming(product_name, daily_dose, route, selected_elements, mpc_data, batch_results,
+                                  control_percentage=30, compliance=None, control_tiers=None):
+    """Create the Excel report with the same layout as create_excel_report, streamed row by row
+
+    Uses xlsxwriter in constant_memory mode so each row is flushed to disk once the next one starts,
+    and registers every cell style once as a shared format.
+    """
+    import xlsxwriter
+    
+    report_data = _prepare_report_data(daily_dose, route, selected_elements, mpc_data, batch_results,
+                                       control_percentage, compliance, control_tiers)
+    compliance = report_data['compliance']
+    measured_values = compliance['measured']
+    censored_values = compliance['missing']
+    compliance_status = compliance['compliant']
+    all_compliant = report_data['all_compliant']
+    detection_limits = report_data['detection_limits']
+    batch_names = compliance['batches']
+    last_column = 11  # Merged rows span A:L
+    
+    excel_buffer = io.BytesIO()
+    wb = xlsxwriter.Workbook(excel_buffer, {'constant_memory': True, 'tmpdir': tempfile.gettempdir()})
+    ws = wb.add_worksheet("Elemental Impurities Report")
+    
+    # Register named formats once
+    base = {'font_name': 'Arial', 'valign': 'vcenter', 'text_wrap': True}
+    formats = {
+        'title': wb.add_format({**base, 'font_size': 12, 'bold': True, 'align': 'left'}),
+        'section': wb.add_format({**base, 'font_size': 11, 'bold': True, 'align': 'left'}),
+        'header': wb.add_format({**base, 'font_size': 11, 'bold': True, 'align': 'center', 'border': 1,
+                                 'bg_color': '#D3D3D3'}),
+        'header_cell': wb.add_format({**base, 'font_size': 11, 'bold': True, 'align': 'center', 'border': 1}),
+        'text': wb.add_format({**base, 'font_size': 10, 'align': 'left'}),
+        'text_non_compliant': wb.add_format({**base, 'font_size': 10, 'align': 'left', 'bg_color': '#FFB6C1'}),
+        'cell': wb.add_format({**base, 'font_size': 10, 'align': 'center', 'border': 1}),
+        'cell_left': wb.add_format({**base, 'font_size': 10, 'align': 'left', 'border': 1}),
+        'cell_compliant': wb.add_format({**base, 'font_size': 10, 'align': 'center', 'border': 1,
+                                         'bg_color': '#90EE90'}),
+        'cell_non_compliant': wb.add_format({**base, 'font_size': 10, 'align': 'center', 'border': 1,
+                                             'bg_color': '#FFB6C1'}),
+    }
+    
+    def write(row, col, value, style):
+        """Write one cell using 1-based row/column numbers like openpyxl"""
+        if isinstance(value, str):
+            ws.write_string(row - 1, col - 1, value, formats[style])
+        else:
+            ws.write(row - 1, col - 1, value.item() if isinstance(value, np.generic) else value, formats[style])
+    
+    def write_merged(row, value, style):
+        ws.merge_range(row - 1, 0, row - 1, last_column, value, formats[style])
+    
+    def write_batch_rows(row):
+        for i, batch_name in enumerate(batch_names):
+            row += 1
+            write(row, 1, f"PPQ {i+1}", 'cell')
+            write(row, 2, batch_name, 'cell')
+            formatted_row = _format_measured_row(measured_values[i].tolist(), detection_limits, censored_values[i].tolist())
+            compliant_row = compliance_status[i].tolist()
+            for col, (formatted_value, is_compliant) in enumerate(zip(formatted_row, compliant_row), 3):
+                write(row, col, formatted_value, 'cell' if is_compliant else 'cell_non_compliant')
+        return row
+    
+    # Adjust column widths
+    ws.set_column(0, 0, 15)
+    ws.set_column(1, 1, 30)
+    if selected_elements:
+        ws.set_column(2, len(selected_elements) + 1, 12)
+    
+    # Title
+    write_merged(1, "Table 8: Summary of (i) The Maximum Permitted Concentration (µg/g) (Section1), (ii) The analytical results (Section2), and (iii) The Control strategy decisions (Section3), regarding the Elemental Impurities examined in the current risk assessment study", 'title')
+    
+    # Section 1
+    row = 3
+    write_merged(row, "Section1 Maximum permitted concentration (µg/g) of each Elemental impurity", 'section')
+    
+    row += 2
+    for col, header in enumerate(["", "Max Daily Amount of MP (g/patient)"] + selected_elements, 1):
+        write(row, col, header, 'header')
+    
+    row += 1
+    write(row, 1, product_name, 'cell_left')
+    write(row, 2, "-", 'cell')
+    for col in range(3, len(selected_elements) + 3):
+        write(row, col, "", 'cell')
+    
+    row += 1
+    write(row, 1, "injectable form", 'cell_left')
+    write(row, 2, f"{daily_dose} g/patient of MP", 'cell')
+    for col, mpc in enumerate(report_data['mpcs'], 3):
+        if mpc is not None:
+            write(row, col, mpc, 'cell')
+    
+    row += 1
+    write(row, 1, "", 'cell_left')
+    write(row, 2, "Permitted Daily Exposure (µg/patient) according to Table A.2.1. in Appendix3", 'cell')
+    for col, pde in enumerate(report_data['pdes'], 3):
+        if pde is not None:
+            write(row, col, pde, 'cell')
+    
+    row += 2
+    write_merged(row, "(1) Calculated Max permitted concentration (µg/g) = Permitted Daily Exposure (µg/day)/ Max Daily Amount of MP (g/day)", 'text')
+    
+    # Section 2
+    row += 2
+    write_merged(row, "Section2 Analytical results (µg/g) and checking of compliance with ICH Q3D", 'section')
+    
+    row += 2
+    for col, header in enumerate(["", ""] + selected_elements, 1):
+        write(row, col, header, 'header')
+    row = write_batch_rows(row)
+    
+    row += 2
+    write(row, 1, "Element meets ICH Q3D", 'header_cell')
+    write(row, 2, "", 'cell')
+    for col, element in enumerate(selected_elements, 3):
+        write(row, col, element, 'header_cell')
+    
+    row += 1
+    write(row, 1, "Yes" if all_compliant else "No", 'cell')
+    write(row, 2, "", 'cell')
+    for col, element_compliant in enumerate(report_data['element_compliance'].tolist(), 3):
+        write(row, col, "Yes" if element_compliant else "No", 'cell_compliant' if element_compliant else 'cell_non_compliant')
+    
+    # Section 3
+    row += 2
+    write_merged(row, "Section3 Control strategy decisions", 'section')
+    
+    row += 2
+    for col, header in enumerate(["", f"Control Threshold ({control_percentage}% of the PDE) in µg/g"] + selected_elements, 1):
+        write(row, col, header, 'header')
+    row = write_batch_rows(row)
+    
+    # Control % tiers side by side
+    if report_data['tier_rows']:
+        row += 2
+        for col, header in enumerate(["", "Control % tiers"] + selected_elements, 1):
+            write(row, col, header, 'header')
+        for label, cells in report_data['tier_rows']:
+            row += 1
+            write(row, 1, "", 'cell')
+            write(row, 2, label, 'cell')
+            for col, (value, is_compliant) in enumerate(cells, 3):
+                style = 'cell' if is_compliant is None else 'cell_compliant' if is_compliant else 'cell_non_compliant'
+                write(row, col, value, style)
+    
+    # Conclusion
+    row += 2
+    write(row, 1, "Conclusion", 'section')
+    
+    row += 1
+    if all_compliant:
+        write_merged(row, "No further action required – Existing controls to be considered as adequate", 'text')
+    else:
+        write_merged(row, "ACTION REQUIRED – Some elements exceed the control threshold. Further investigation and corrective actions needed.", 'text_non_compliant')
+    
+    row += 2
+    write_merged(row, f"(2) Control Threshold (µg/g) = {control_percentage/100} x calculated Max permitted concentration (µg/g)", 'text')
+    
+    wb.close()
+    excel_buffer.seek(0)
+    return excel_buffer
+
+def estimate_report_size(n_batches, n_elements):
+    """Estimate the Excel report dimensions and file size without building it"""
+    rows = 26 + 2 * n_batches  # Fixed rows around the Section 2 and Section 3 batch tables
+    columns = n_elements + 2
+    cells = rows * columns
+    return {
+        'rows': rows,
+        'columns': columns,
+        'cells': cells,
+        'bytes': 6000 + 5 * cells,  # Measured at about 5 compressed bytes per cell
+    }
+
+class ReportCache:
+    """Byte-bounded LRU cache of finished report bytes, with an optional on-disk tier"""
+    
+    def __init__(self, max_bytes=256 * 1024 * 1024, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+    
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.bin")
+    
+    def _store(self, key, data):
+        """Insert into the memory tier and evict least recently used entries over the byte budget"""
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+    
+    def __contains__(self, key):
+        """Whether a key is in the memory tier, without touching the counters or LRU order"""
+        with self._lock:
+            return key in self._entries
+    
+    def get(self, key):
+        """Get cached bytes for a key, or None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.disk_dir and os.path.exists(self._disk_path(key)):
+            with open(self._disk_path(key), 'rb') as f:
+                data = f.read()
+            with self._lock:
+                self._store(key, data)
+                self.disk_hits += 1
+            return data
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def put(self, key, data):
+        """Cache bytes for a key in memory and, if enabled, on disk"""
+        with self._lock:
+            self._store(key, data)
+        if self.disk_dir:
+            temp_path = f"{self._disk_path(key)}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._disk_path(key))
+    
+    def get_or_create(self, key, build):
+        """Get cached bytes for a key, building and caching them with build() on a miss"""
+        data = self.get(key)
+        if data is None:
+            data = build()
+            self.put(key, data)
+        return data
+    
+    def clear(self):
+        """Empty the memory tier (the disk tier is left in place)"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+            }
+
+def report_cache_key(report_kind, product_name, daily_dose, route, control_percentage, selected_elements, batch_results):
+    """Content hash of everything a report depends on, including the reference data version"""
+    selected_elements = list(selected_elements)
+    if isinstance(batch_results, dict):
+        batch_results = BatchResultStore.from_dict(batch_results, selected_elements)
+    values, missing = batch_results.matrix(selected_elements)
+    
+    digest = hashlib.sha256()
+    digest.update(repr((report_kind, product_name, float(daily_dose), route, control_percentage,
+                        selected_elements, pde_reference["version"])).encode())
+    digest.update("\0".join(batch_results.batch_ids).encode())
+    digest.update(np.ascontiguousarray(values).tobytes())
+    digest.update(np.ascontiguousarray(missing).tobytes())
+    return digest.hexdigest()
+
+# Export kinds a worker can build; each returns a BytesIO
+export_writers = {
+    'id_card': create_id_card_document,
+    'excel': create_excel_report,
+    'excel_streaming': create_excel_report_streaming,
+    'word': create_word_document,
+}
+
+_export_events = None
+
+def _warm_export_worker(events):
+    """Worker initializer: import the document libraries and parse the templates before the first job"""
+    import importlib
+    
+    global _export_events
+    _export_events = events
+    for module in ('docx', 'openpyxl', 'xlsxwriter'):
+        importlib.import_module(module)
+    load_docx_template('id_card')
+
+def _export_worker_ready():
+    return os.getpid()
+
+def _run_export_job(job_id, payload):
+    """Build one export in a worker process and return its bytes"""
+    if _export_events is not None:
+        _export_events.put((job_id, time.time()))
+    kind, args, kwargs = pickle.loads(payload)
+    return export_writers[kind](*args, **kwargs).getvalue()
+
+class ExportQueue:
+    """Background document exports on a small pool of pre-warmed worker processes
+
+    submit() snapshots the inputs (they are pickled straight away, so the evaluator's in-place compliance
+    arrays or later batch uploads cannot leak into a queued export) and returns a job id to poll with
+    status() and collect with result(). Jobs submitted with the same key share one export. A job can be
+    cancelled while queued; a job already running finishes in its worker and its result is dropped.
+    Finished jobs are kept until discarded; the least recently used go first beyond max_jobs or once their
+    results add up to more than max_result_bytes (the latest result is always kept).
+    Workers are started with forkserver (spawn where it is not available), never forked from the server's
+    threads and open sockets.
+    """
+    
+    def __init__(self, workers=2, max_jobs=100, max_result_bytes=256 * 1024 * 1024, mp_context=None):
+        import multiprocessing
+        
+        context = mp_context
+        if context is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            context = multiprocessing.get_context(start_method)
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.max_result_bytes = max_result_bytes
+        self._result_bytes = 0
+        self._events = context.SimpleQueue()
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                         initializer=_warm_export_worker, initargs=(self._events,))
+        self._jobs = OrderedDict()
+        self._keys = {}
+        self._seconds = {}
+        self._lock = threading.Lock()
+        # Start the workers now so the first export does not pay for process start-up and imports
+        for _ in range(workers):
+            self._pool.submit(_export_worker_ready)
+    
+    def _drain_events(self):
+        """Mark jobs a worker has picked up as running (caller holds the lock)"""
+        while not self._events.empty():
+            job_id, started = self._events.get()
+            job = self._jobs.get(job_id)
+            if job is not None and job['status'] == 'queued':
+                job['status'] = 'running'
+                job['started'] = started
+    
+    def _finish(self, job_id, future):
+        with self._lock:
+            self._drain_events()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job['finished'] = time.time()
+            job['future'] = None
+            if job['status'] == 'cancelled' or future.cancelled():
+                job['status'] = 'cancelled'
+            elif future.exception() is not None:
+                job['status'] = 'failed'
+                job['error'] = str(future.exception())
+            else:
+                job['status'] = 'done'
+                job['result'] = future.result()
+                self._result_bytes += len(job['result'])
+                # Running average per kind, used to estimate the progress of running jobs
+                seconds = job['finished'] - (job['started'] or job['submitted'])
+                previous = self._seconds.get(job['kind'])
+                self._seconds[job['kind']] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+                self._prune(keep=job_id)
+    
+    def submit(self, kind, *args, key=None, **kwargs):
+        """Queue export_writers[kind](*args, **kwargs) and return its job id"""
+        if kind not in export_writers:
+            raise ValueError(f"Unknown export kind: {kind}")
+        with self._lock:
+            if key is not None and key in self._keys:
+                job = self._jobs[self._keys[key]]
+                if job['status'] not in ('failed', 'cancelled'):
+                    return job['id']
+        payload = pickle.dumps((kind, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {'id': job_id, 'kind': kind, 'key': key, 'status': 'queued', 'submitted': time.time(),
+                                  'started': None, 'finished': None, 'error': None, 'result': None, 'future': None}
+            if key is not None:
+                self._keys[key] = job_id
+            self._prune()
+        future = self._pool.submit(_run_export_job, job_id, payload)
+        with self._lock:
+            if job_id in self._jobs and self._jobs[job_id]['finished'] is None:
+                self._jobs[job_id]['future'] = future
+        future.add_done_callback(functools.partial(self._finish, job_id))
+        return job_id
+    
+    def status(self, job_id):
+        """Status of a job: 'status' (queued, running, done, failed or cancelled), 'progress' (0-1, estimated
+        from earlier jobs of the same kind while running), 'position' in the queue, 'seconds' since it was
+        submitted or until it finished, and 'error'; None for an unknown job"""
+        with self._lock:
+            self._drain_events()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            now = time.time()
+            position = None
+            if job['status'] == 'queued':
+                progress = 0.0
+                position = sum(1 for other in self._jobs.values()
+                               if other['status'] == 'queued' and other['submitted'] < job['submitted'])
+            elif job['status'] == 'running':
+                expected = self._seconds.get(job['kind'])
+                progress = min(0.95, (now - job['started']) / expected) if expected else 0.5
+            else:
+                progress = 1.0 if job['status'] == 'done' else 0.0
+            return {
+                'id': job_id,
+                'kind': job['kind'],
+                'status': job['status'],
+                'progress': progress,
+                'position': position,
+                'seconds': (job['finished'] or now) - job['submitted'],
+                'error': job['error'],
+            }
+    
+    def result(self, job_id):
+        """Bytes of a finished export, or None while it is not done"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            self._jobs.move_to_end(job_id)
+            return job['result']
+    
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns whether it was still active"""
+        with self._lock:
+            self._drain_events()
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] not in ('queued', 'running'):
+                return False
+            job['status'] = 'cancelled'
+            future = job['future']
+        if future is not None:
+            future.cancel()
+        return True
+    
+    def discard(self, job_id):
+        """Forget a job and its result"""
+        with self._lock:
+            self._drop(job_id)
+    
+    def _drop(self, job_id):
+        """Forget a job (caller holds the lock)"""
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            return
+        if job['result'] is not None:
+            self._result_bytes -= len(job['result'])
+        if self._keys.get(job['key']) == job_id:
+            del self._keys[job['key']]
+    
+    def _prune(self, keep=None):
+        """Drop the least recently used finished jobs beyond max_jobs or max_result_bytes, except keep
+        (caller holds the lock)"""
+        finished = [job_id for job_id, job in self._jobs.items() if job['finished'] is not None and job_id != keep]
+        excess_jobs = len(self._jobs) - self.max_jobs
+        for job_id in finished:
+            if excess_jobs <= 0 and self._result_bytes <= self.max_result_bytes:
+                break
+            self._drop(job_id)
+            excess_jobs -= 1
+    
+    def stats(self):
+        with self._lock:
+            self._drain_events()
+            counts = {status: 0 for status in ('queued', 'running', 'done', 'failed', 'cancelled')}
+            for job in self._jobs.values():
+                counts[job['status']] += 1
+            counts['workers'] = self.workers
+            counts['result_bytes'] = self._result_bytes
+            counts['max_result_bytes'] = self.max_result_bytes
+            return counts
+    
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+class BatchResultStore:
+    """Columnar store of batch results
+
+    Batch ids are held in an index, measurements in a contiguous batch × element float array
+    with a matching mask flagging values that were missing or below the limit of detection
+    (stored as 0.0, as the reports expect).
+    """
+    
+    def __init__(self, elements=None, capacity=1024):
+        self.elements = list(pde_reference["elements"] if elements is None else elements)
+        self.element_index = {element: j for j, element in enumerate(self.elements)}
+        self._batch_ids = []
+        self._batch_index = {}
+        self._values = np.zeros((max(capacity, 1), len(self.elements)), dtype=float)
+        self._missing = np.ones((max(capacity, 1), len(self.elements)), dtype=bool)
+        self._row_versions = np.zeros(max(capacity, 1), dtype=np.int64)
+        self.version = 0  # Bumped on every change, so derived results can tell when they are stale
+        self.layout_version = 0  # Bumped when rows move (deletes), which invalidates row positions
+    
+    def __len__(self):
+        return len(self._batch_ids)
+    
+    def __contains__(self, batch_id):
+        return batch_id in self._batch_index
+    
+    @property
+    def batch_ids(self):
+        return self._batch_ids
+    
+    @property
+    def values(self):
+        """Batch × element measurements (view, no copy)"""
+        return self._values[:len(self._batch_ids)]
+    
+    @property
+    def missing(self):
+        """Batch × element missing/below-LOD mask (view, no copy)"""
+        return self._missing[:len(self._batch_ids)]
+    
+    @property
+    def measured_elements(self):
+        """Elements with at least one measured value"""
+        measured = ~self.missing.all(axis=0)
+        return [element for element, is_measured in zip(self.elements, measured) if is_measured]
+    
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.missing.nbytes
+    
+    def _reserve(self, rows):
+        """Grow the buffers geometrically so appends are amortized O(1)"""
+        if rows > self._values.shape[0]:
+            capacity = max(rows, 2 * self._values.shape[0])
+            values = np.zeros((capacity, len(self.elements)), dtype=float)
+            missing = np.ones((capacity, len(self.elements)), dtype=bool)
+            row_versions = np.zeros(capacity, dtype=np.int64)
+            values[:len(self._batch_ids)] = self.values
+            missing[:len(self._batch_ids)] = self.missing
+            row_versions[:len(self._batch_ids)] = self._row_versions[:len(self._batch_ids)]
+            self._values, self._missing, self._row_versions = values, missing, row_versions
+    
+    def _prepare(self, batch_ids, values, missing):
+        """Normalize a block of batches to string ids, float values and a boolean mask
+
+        Values under the mask (including NaN) are zeroed, so every consumer reads missing cells as 0.0.
+        """
+        batch_ids = [str(batch_id) for batch_id in batch_ids]
+        values = np.asarray(values, dtype=float).reshape(len(batch_ids), len(self.elements))
+        missing = np.isnan(values) if missing is None else np.asarray(missing, dtype=bool).reshape(values.shape) | np.isnan(values)
+        return batch_ids, np.where(missing, 0.0, values), missing
+    
+    def append(self, batch_ids, values, missing=None):
+        """Append a block of new batches; values is a batch × element array in store element order"""
+        batch_ids, values, missing = self._prepare(batch_ids, values, missing)
+        if len(set(batch_ids)) != len(batch_ids) or any(batch_id in self._batch_index for batch_id in batch_ids):
+            raise ValueError("Batch ids must be unique, use upsert to overwrite existing batches")
+        start = len(self._batch_ids)
+        self._reserve(start + len(batch_ids))
+        self._values[start:start + len(batch_ids)] = values
+        self._missing[start:start + len(batch_ids)] = missing
+        self._batch_index.update((batch_id, start + k) for k, batch_id in enumerate(batch_ids))
+        self._batch_ids.extend(batch_ids)
+        self.version += 1
+        self._row_versions[start:start + len(batch_ids)] = self.version
+    
+    def upsert(self, batch_ids, values, missing=None):
+        """Insert new batches and overwrite existing ones; the last row wins for repeated ids"""
+        batch_ids, values, missing = self._prepare(batch_ids, values, missing)
+        last_row = {batch_id: k for k, batch_id in enumerate(batch_ids)}
+        existing = [(self._batch_index[batch_id], k) for batch_id, k in last_row.items() if batch_id in self._batch_index]
+        new = [k for batch_id, k in last_row.items() if batch_id not in self._batch_index]
+        if existing:
+            rows, sources = (np.array(indexes, dtype=int) for indexes in zip(*existing))
+            self._values[rows] = values[sources]
+            self._missing[rows] = missing[sources]
+            self.version += 1
+            self._row_versions[rows] = self.version
+        if new:
+            self.append([batch_ids[k] for k in new], values[new], missing[new])
+    
+    def delete(self, batch_ids):
+        """Remove batches, compacting the arrays in place"""
+        rows = [self._batch_index[batch_id] for batch_id in batch_ids if batch_id in self._batch_index]
+        if not rows:
+            return
+        keep = np.ones(len(self._batch_ids), dtype=bool)
+        keep[rows] = False
+        size = int(keep.sum())
+        self._values[:size] = self.values[keep]
+        self._missing[:size] = self.missing[keep]
+        self._missing[size:len(self._batch_ids)] = True
+        self._row_versions[:size] = self._row_versions[:len(self._batch_ids)][keep]
+        self._batch_ids = [batch_id for batch_id, kept in zip(self._batch_ids, keep) if kept]
+        self._batch_index = {batch_id: i for i, batch_id in enumerate(self._batch_ids)}
+        self.version += 1
+        self.layout_version += 1
+    
+    def clear(self):
+        """Remove all batches"""
+        self.delete(list(self._batch_ids))
+    
+    def changed_rows(self, since_version):
+        """Row positions written after the given store version"""
+        return np.flatnonzero(self._row_versions[:len(self._batch_ids)] > since_version)
+    
+    def column(self, element):
+        """Measurements of one element across all batches (view, no copy)"""
+        return self.values[:, self.element_index[element]]
+    
+    def matrix(self, elements=None):
+        """Get (values, missing) for the given elements
+
+        Views of the store arrays when the elements match the store layout, otherwise gathered
+        copies; elements not held by the store read as 0.0 and missing.
+        """
+        if elements is None or list(elements) == self.elements:
+            return self.values, self.missing
+        indexes = np.array([self.element_index.get(element, -1) for element in elements], dtype=int)
+        known = indexes >= 0
+        values = np.zeros((len(self), len(indexes)), dtype=float)
+        missing = np.ones((len(self), len(indexes)), dtype=bool)
+        values[:, known] = self.values[:, indexes[known]]
+        missing[:, known] = self.missing[:, indexes[known]]
+        return values, missing
+    
+    def get(self, batch_id):
+        """Get one batch as {element: value}, omitting missing values"""
+        row = self._batch_index[batch_id]
+        return {element: value for element, value, is_missing
+                in zip(self.elements, self._values[row].tolist(), self._missing[row].tolist()) if not is_missing}
+    
+    def to_dict(self):
+        """Convert to the {batch: {element: value}} layout"""
+        return {batch_id: dict(zip(self.elements, row)) for batch_id, row in zip(self._batch_ids, self.values.tolist())}
+    
+    def to_frame(self, elements=None):
+        """Batch × element DataFrame indexed by batch, missing values shown as NaN"""
+        elements = self.elements if elements is None else list(elements)
+        values, missing = self.matrix(elements)
+        return pd.DataFrame(np.where(missing, np.nan, values), index=pd.Index(self._batch_ids, name='Batch'),
+                            columns=elements)
+    
+    @classmethod
+    def from_dict(cls, batch_results, elements=None):
+        """Build a store from the {batch: {element: value}} layout"""
+        if elements is None:
+            elements = list(pde_reference["elements"])
+            elements += sorted({element for batch_data in batch_results.values() for element in batch_data} - set(elements))
+        store = cls(elements, capacity=len(batch_results))
+        missing = np.array([[element not in batch_data for element in store.elements] for batch_data in batch_results.values()],
+                           dtype=bool).reshape(len(batch_results), len(store.elements))
+        values = np.array([[batch_data.get(element, 0.0) for element in store.elements] for batch_data in batch_results.values()],
+                          dtype=float).reshape(missing.shape)
+        store.upsert(list(batch_results.keys()), values, missing)
+        return store
+
+class IncrementalEvaluator:
+    """Limits and compliance for one batch store, kept up to date by recomputing only what changed
+
+    The batch × element matrices (measured, exposure, ratio, situation) and per-element situation counts are
+    kept for the current route and dose. evaluate() recomputes only the batches written since the last call
+    and the newly selected elements; a new control % only re-classifies the cached exposures, and the
+    per-element worst case and overall situation come from the maintained counts. A new route or dose, or
+    deleted batches, start over. Results match calculate_limits and evaluate_compliance; the returned arrays
+    are the evaluator's own buffers and are updated in place by the next call.
+    """
+    
+    matrix_dtypes = {'measured': float, 'missing': bool, 'exposure': float, 'ratio': float, 'situation': np.int8}
+    
+    def __init__(self, store):
+        self.store = store
+        self._params = None
+        self._layout_version = None
+        self._control_percentage = None
+        self._limit_rows = {}
+        self._reset(0)
+        self.last_update = {'full': True, 'elements': 0, 'rows': 0}
+    
+    def _reset(self, capacity):
+        self._elements = []
+        self._seen_version = self.store.version
+        self._n_rows = len(self.store)
+        self._pde = np.zeros(0)
+        self._counts = np.zeros((0, 4), dtype=np.int64)
+        self._buffers = {key: np.zeros((max(capacity, 1), 0), dtype=dtype, order='F')
+                         for key, dtype in self.matrix_dtypes.items()}
+    
+    def _read(self, elements, rows=None):
+        """Measured values and missing mask of the elements from the store, for all or some rows"""
+        indexes = np.array([self.store.element_index.get(element, -1) for element in elements], dtype=int)
+        known = indexes >= 0
+        n = len(self.store) if rows is None else len(rows)
+        values = np.zeros((n, len(elements)), dtype=float)
+        missing = np.ones((n, len(elements)), dtype=bool)
+        source_values = self.store.values if rows is None else self.store.values[rows]
+        source_missing = self.store.missing if rows is None else self.store.missing[rows]
+        values[:, known] = source_values[:, indexes[known]]
+        missing[:, known] = source_missing[:, indexes[known]]
+        return values, missing
+    
+    @staticmethod
+    def _situations(exposure, pde, control_percentage):
+        """Situation codes with the rules of classify_compliance"""
+        control_threshold = pde * (control_percentage / 100)
+        situation = np.where(exposure > pde, 3, np.where(exposure > control_threshold, 2, 1)).astype(np.int8)
+        situation[:, np.isnan(pde)] = 0
+        return situation
+    
+    @staticmethod
+    def _count(situation):
+        """Per-element counts of each situation code, shaped (elements, 4)"""
+        codes = situation.astype(np.int64) + 4 * np.arange(situation.shape[1])
+        return np.bincount(codes.ravel(), minlength=4 * situation.shape[1]).reshape(situation.shape[1], 4)
+    
+    def _compute(self, elements, route, daily_dose, control_percentage, rows=None):
+        """Fresh matrix blocks for the elements, for all or some rows"""
+        measured, missing = self._read(elements, rows)
+        pde = get_route_pdes(route, elements)
+        exposure = measured * daily_dose
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = exposure / pde
+        situation = self._situations(exposure, pde, control_percentage)
+        return pde, {'measured': measured, 'missing': missing, 'exposure': exposure, 'ratio': ratio,
+                     'situation': situation}
+    
+    def _grow(self, rows):
+        """Make room for appended batches, doubling the row capacity so appends stay amortized O(1)"""
+        capacity = self._buffers['measured'].shape[0]
+        if rows > capacity:
+            capacity = max(rows, 2 * capacity)
+            for key, buffer in self._buffers.items():
+                grown = np.zeros((capacity, buffer.shape[1]), dtype=buffer.dtype, order='F')
+                grown[:self._n_rows] = buffer[:self._n_rows]
+                self._buffers[key] = grown
+    
+    def _refresh_rows(self, rows, route, daily_dose, control_percentage):
+        """Recompute the given rows for the current elements and adjust the situation counts"""
+        previous = rows[rows < self._n_rows]
+        self._counts -= self._count(self._buffers['situation'][previous])
+        _, blocks = self._compute(self._elements, route, daily_dose, control_percentage, rows)
+        for key, block in blocks.items():
+            self._buffers[key][rows] = block
+        self._counts += self._count(blocks['situation'])
+    
+    def _select(self, elements, route, daily_dose, control_percentage):
+        """Rearrange the matrices to the requested elements, computing only the ones not held yet"""
+        n = len(self.store)
+        held = {element: j for j, element in enumerate(self._elements)}
+        kept = [k for k, element in enumerate(elements) if element in held]
+        added = [k for k, element in enumerate(elements) if element not in held]
+        sources = [held[elements[k]] for k in kept]
+        # Column-major buffers, so moving or adding an element copies contiguous columns
+        buffers = {key: np.zeros((max(self._buffers[key].shape[0], n, 1), len(elements)), dtype=dtype, order='F')
+                   for key, dtype in self.matrix_dtypes.items()}
+        pde = np.zeros(len(elements))
+        counts = np.zeros((len(elements), 4), dtype=np.int64)
+        if kept:
+            for key, buffer in buffers.items():
+                for k, source in zip(kept, sources):
+                    buffer[:n, k] = self._buffers[key][:n, source]
+            pde[kept] = self._pde[sources]
+            counts[kept] = self._counts[sources]
+        if added:
+            added_pde, blocks = self._compute([elements[k] for k in added], route, daily_dose, control_percentage)
+            for key, block in blocks.items():
+                for column, k in enumerate(added):
+                    buffers[key][:n, k] = block[:, column]
+            pde[added] = added_pde
+            counts[added] = self._count(blocks['situation'])
+        self._elements, self._buffers, self._pde, self._counts = list(elements), buffers, pde, counts
+        return len(added)
+    
+    def _limits(self, elements, route, daily_dose, control_percentage):
+        """Limit table for the elements, calculating rows only for elements not seen at these settings"""
+        if daily_dose <= 0:
+            return calculate_limits(elements, daily_dose, route, control_percentage)
+        new_elements = [element for element in elements if element not in self._limit_rows]
+        if new_elements:
+            by_element = {row["Element"]: row for row in _limit_rows(new_elements, daily_dose, route, control_percentage)}
+            self._limit_rows.update((element, by_element.get(element)) for element in new_elements)
+        rows = [self._limit_rows[element] for element in elements if self._limit_rows[element] is not None]
+        return pd.DataFrame(_whole_pdes(rows, route))
+    
+    def evaluate(self, route, daily_dose, elements, control_percentage=30):
+        """Return (calculation_data, compliance) as calculate_limits and evaluate_compliance would"""
+        elements = list(elements)
+        store = self.store
+        full = (route, daily_dose) != self._params or store.layout_version != self._layout_version
+        if full:
+            self._params = (route, daily_dose)
+            self._layout_version = store.layout_version
+            self._limit_rows = {}
+            self._reset(len(store))
+        if control_percentage != self._control_percentage:
+            self._limit_rows = {}
+            situation = self._situations(self._buffers['exposure'][:self._n_rows], self._pde, control_percentage)
+            self._buffers['situation'][:self._n_rows] = situation
+            self._counts = self._count(situation)
+            self._control_percentage = control_percentage
+        
+        changed = store.changed_rows(self._seen_version)
+        self._grow(len(store))
+        if changed.size and self._elements:
+            self._refresh_rows(changed, route, daily_dose, control_percentage)
+        self._seen_version = store.version
+        self._n_rows = len(store)
+        
+        added = self._select(elements, route, daily_dose, control_percentage) if elements != self._elements else 0
+        self.last_update = {'full': full, 'elements': added, 'rows': int(changed.size)}
+        
+        n = self._n_rows
+        situation = self._buffers['situation'][:n]
+        # Worst case per element from the maintained situation counts; 0 when the element has no PDE
+        element_situation = np.where(self._counts[:, 3] > 0, 3, np.where(self._counts[:, 2] > 0, 2, 1)).astype(np.int8)
+        element_situation[np.isnan(self._pde)] = 0
+        compliance = {
+            'batches': list(store.batch_ids),
+            'elements': elements,
+            'measured': self._buffers['measured'][:n],
+            'missing': self._buffers['missing'][:n],
+            'exposure': self._buffers['exposure'][:n],
+            'pde': self._pde,
+            'ratio': self._buffers['ratio'][:n],
+            'control_threshold': self._pde * (control_percentage / 100),
+            'situation': situation,
+            'compliant': situation < 2,
+            'element_situation': element_situation,
+            'overall_situation': int(element_situation.max(initial=1)),
+        }
+        return self._limits(elements, route, daily_dose, control_percentage), compliance
+
+class BatchStatistics:
+    """Running per-element statistics of a batch store, kept up to date without rescanning it
+
+    Count, mean and variance are combined block by block (Welford/Chan), so refresh() only reads the batches
+    written since the last call; overwritten batches have their previous contribution taken out first. Each
+    element also keeps its measured values sorted, which gives the maximum and high percentiles by index.
+    Missing and below-LOD results are not counted. Deleted batches, which move rows, start over.
+    """
+    
+    percentiles = (90, 95, 99)
+    
+    def __init__(self, store):
+        self.store = store
+        self._rebuild()
+    
+    def _rebuild(self):
+        elements = len(self.store.elements)
+        self._layout_version = self.store.layout_version
+        self._seen_version = 0
+        self._n_rows = 0
+        self._values = np.full((max(len(self.store), 1), elements), np.nan)  # What each row contributed
+        self._count = np.zeros(elements, dtype=np.int64)
+        self._mean = np.zeros(elements)
+        self._m2 = np.zeros(elements)
+        self._sorted = [np.zeros(0) for _ in range(elements)]
+        self.last_update = {'full': True, 'rows': 0}
+    
+    @staticmethod
+    def _moments(values):
+        """Per-column (count, mean, M2) of a block, ignoring NaN"""
+        measured = ~np.isnan(values)
+        count = measured.sum(axis=0)
+        with np.errstate(invalid='ignore'):
+            mean = np.where(count > 0, np.nansum(values, axis=0) / count, 0.0)
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+        return count, mean, m2
+    
+    def _add(self, values):
+        count, mean, m2 = self._moments(values)
+        total = self._count + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self._mean
+            self._mean = np.where(total > 0, self._mean + delta * count / total, 0.0)
+            self._m2 = np.where(total > 0, self._m2 + m2 + delta ** 2 * self._count * count / total, 0.0)
+        self._count = total
+        for j in np.flatnonzero(count):
+            column = values[:, j]
+            column = np.sort(column[~np.isnan(column)])
+            self._sorted[j] = np.insert(self._sorted[j], np.searchsorted(self._sorted[j], column), column)
+    
+    def _remove(self, values):
+        count, mean, m2 = self._moments(values)
+        remaining = self._count - count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new_mean = np.where(remaining > 0, (self._count * self._mean - count * mean) / remaining, 0.0)
+            delta = mean - new_mean
+            new_m2 = self._m2 - m2 - delta ** 2 * remaining * count / self._count
+        self._mean = new_mean
+        self._m2 = np.where(remaining > 0, np.maximum(new_m2, 0.0), 0.0)
+        self._count = remaining
+        for j in np.flatnonzero(count):
+            column = values[:, j]
+            column = np.sort(column[~np.isnan(column)])
+            # Equal values sit next to each other, so the k-th copy of a value is k places after the first
+            first = np.searchsorted(self._sorted[j], column)
+            run_start = np.flatnonzero(np.r_[True, column[1:] != column[:-1]])
+            rank = np.arange(len(column)) - np.repeat(run_start, np.diff(np.r_[run_start, len(column)]))
+            self._sorted[j] = np.delete(self._sorted[j], first + rank)
+    
+    def refresh(self):
+        """Fold the batches written since the last call into the statistics"""
+        store = self.store
+        if store.layout_version != self._layout_version or len(store.elements) != len(self._count):
+            self._rebuild()
+        full = self._seen_version == 0
+        rows = store.changed_rows(self._seen_version)
+        if len(store) > self._values.shape[0]:
+            values = np.full((max(len(store), 2 * self._values.shape[0]), len(store.elements)), np.nan)
+            values[:self._n_rows] = self._values[:self._n_rows]
+            self._values = values
+        if rows.size:
+            old = rows[rows < self._n_rows]
+            if old.size:
+                self._remove(self._values[old])
+            new = np.where(store.missing[rows], np.nan, store.values[rows])
+            self._add(new)
+            self._values[rows] = new
+        self._seen_version = store.version
+        self._n_rows = len(store)
+        self.last_update = {'full': full, 'rows': int(rows.size)}
+        return self
+    
+    def _percentile(self, j, q):
+        """Percentile of one element's measured values, interpolated linearly like np.percentile"""
+        values = self._sorted[j]
+        if not len(values):
+            return np.nan
+        position = (len(values) - 1) * q / 100
+        low = int(np.floor(position))
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
+    
+    def summary(self, calculation_data, control_percentage=30, elements=None):
+        """Per-element statistics frame with Cpk against the control strategy limit of calculate_limits
+
+        Cpk is one-sided, (control limit - mean) / 3σ, using the sample standard deviation.
+        """
+        self.refresh()
+        if elements is None:
+            elements = calculation_data['Element'].tolist() if not calculation_data.empty else []
+        limits = _index_by_element(calculation_data)
+        limit_column = f'Control Strategy Limit ({control_percentage}%) µg/g'
+        indexes = [self.store.element_index.get(element) for element in elements]
+        count = np.array([self._count[j] if j is not None else 0 for j in indexes], dtype=np.int64)
+        mean = np.array([self._mean[j] if j is not None else 0.0 for j in indexes])
+        m2 = np.array([self._m2[j] if j is not None else 0.0 for j in indexes])
+        limit = np.array([limits.at[element, limit_column] if element in limits.index else np.nan
+                          for element in elements], dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(count > 1, np.sqrt(m2 / (count - 1)), np.nan)
+            cpk = (limit - mean) / (3 * std)
+        maximum = np.array([self._sorted[j][-1] if j is not None and len(self._sorted[j]) else np.nan
+                            for j in indexes])
+        summary = pd.DataFrame({
+            'Element': elements,
+            'Measured batches': count,
+            'Mean µg/g': np.where(count > 0, mean, np.nan),
+            'Std µg/g': std,
+            'Max µg/g': maximum,
+        })
+        for q in self.percentiles:
+            summary[f'P{q} µg/g'] = [self._percentile(j, q) if j is not None else np.nan for j in indexes]
+        summary[f'Control limit ({control_percentage}%) µg/g'] = limit
+        with np.errstate(invalid='ignore', divide='ignore'):
+            summary['Max % of control limit'] = maximum / limit * 100
+        summary['Cpk'] = np.where(np.isfinite(cpk), cpk, np.nan)
+        return summary
+
+class BatchRepository:
+    """Local SQLite repository of batch measurements keyed by product, batch and element
+
+    Batches keep their insertion order per product; missing values are simply not stored. Every write runs
+    in one transaction, and each call opens its own connection so the repository can be shared across threads.
+    """
+    
+    schema = """
+        CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY,
+            product TEXT NOT NULL,
+            batch TEXT NOT NULL,
+            saved_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (product, batch)
+        );
+        CREATE INDEX IF NOT EXISTS idx_batches_batch ON batches (batch);
+        CREATE TABLE IF NOT EXISTS measurements (
+            batch_id INTEGER NOT NULL REFERENCES batches (id) ON DELETE CASCADE,
+            element TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (batch_id, element)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get('EI_BATCH_DB') or os.path.join(os.path.expanduser('~'), '.elemental_impurities',
+                                                                  'batch_results.sqlite3')
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # An in-memory database only lives as long as its connection, so keep that one open
+        self._memory_connection = self._open() if path == ':memory:' else None
+        with self._connect() as conn:
+            conn.executescript(self.schema)
+    
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+    
+    @contextmanager
+    def _connect(self):
+        """Connection for one call, committed on success and rolled back on error"""
+        conn = self._memory_connection or self._open()
+        try:
+            with conn:
+                yield conn
+        finally:
+            if conn is not self._memory_connection:
+                conn.close()
+    
+    def products(self):
+        """Saved products with their batch counts"""
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT product, COUNT(*) FROM batches GROUP BY product ORDER BY product"))
+    
+    def batch_ids(self, product):
+        """Saved batch ids of a product in insertion order"""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT batch FROM batches WHERE product = ? ORDER BY id", (product,))]
+    
+    def find_batch(self, batch):
+        """Products holding a batch id"""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT product FROM batches WHERE batch = ? ORDER BY product", (batch,))]
+    
+    def save_store(self, product, store, elements=None):
+        """Save the batches of a store for a product, replacing the stored measurements of batches already saved"""
+        elements = store.elements if elements is None else list(elements)
+        values, missing = store.matrix(elements)
+        batch_ids = list(store.batch_ids)
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO batches (product, batch) VALUES (?, ?)",
+                             [(product, batch_id) for batch_id in batch_ids])
+            ids = dict(conn.execute("SELECT batch, id FROM batches WHERE product = ?", (product,)))
+            row_ids = [ids[batch_id] for batch_id in batch_ids]
+            conn.executemany("DELETE FROM measurements WHERE batch_id = ?", [(row_id,) for row_id in row_ids])
+            rows, columns = np.nonzero(~missing)
+            conn.executemany("INSERT INTO measurements (batch_id, element, value) VALUES (?, ?, ?)",
+                             zip([row_ids[i] for i in rows.tolist()], [elements[j] for j in columns.tolist()],
+                                 values[rows, columns].tolist()))
+        return len(batch_ids)
+    
+    def load_store(self, product, store=None, elements=None):
+        """Load a product's batches into a BatchResultStore (a new one by default), ready for evaluation"""
+        if store is None:
+            store = BatchResultStore(elements)
+        with self._connect() as conn:
+            batches = conn.execute("SELECT id, batch FROM batches WHERE product = ? ORDER BY id", (product,)).fetchall()
+            measurements = conn.execute(
+                "SELECT m.batch_id, m.element, m.value FROM measurements m JOIN batches b ON b.id = m.batch_id "
+                "WHERE b.product = ?", (product,)).fetchall()
+        if not batches:
+            return store
+        ids, batch_ids = zip(*batches)
+        values = np.zeros((len(batches), len(store.elements)), dtype=float)
+        missing = np.ones((len(batches), len(store.elements)), dtype=bool)
+        if measurements:
+            row_ids, element_names, measured = zip(*measurements)
+            rows = np.searchsorted(np.array(ids), np.array(row_ids))
+            columns = np.array([store.element_index.get(element, -1) for element in element_names], dtype=int)
+            known = columns >= 0
+            values[rows[known], columns[known]] = np.array(measured, dtype=float)[known]
+            missing[rows[known], columns[known]] = False
+        store.upsert(batch_ids, values, missing)
+        return store
+    
+    def delete_batches(self, product, batch_ids):
+        """Delete some batches of a product"""
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM batches WHERE product = ? AND batch = ?",
+                             [(product, batch_id) for batch_id in batch_ids])
+    
+    def delete_product(self, product):
+        """Delete every batch of a product"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM batches WHERE product = ?", (product,))
+
+# "<0.05", "< LOQ", "≤0.1", "ND", "n.d.", "not detected", "BLQ", "BDL", "LOD"... (case-insensitive)
+censored_value_pattern = re.compile(r'^\s*(?:<=?|≤|&lt;|below\b|n\.?\s*d\.?$|not\s+detected$|b(?:lq|ql|dl)$|lo[dq]$)',
+                                    re.IGNORECASE)
+_censored_limit_pattern = re.compile(r'(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)')
+
+def parse_censored_values(column):
+    """Split a results column into (values, censored) arrays
+
+    Numbers parse as floats. Censored results such as "<0.05", "ND" or "<LOQ" are flagged, with their stated
+    limit as the value where there is one (NaN otherwise). Empty and unparseable cells are NaN and not
+    flagged. Cells are parsed once per distinct value, so repeated "ND" cells cost nothing extra.
+    """
+    if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+        values = column.to_numpy(dtype=float, na_value=np.nan)
+        return values, np.zeros(len(values), dtype=bool)
+    codes, uniques = pd.factorize(column)
+    uniques = pd.Series(uniques, dtype=object)
+    unique_values = np.array(pd.to_numeric(uniques, errors='coerce'), dtype=float)
+    unique_censored = np.zeros(len(uniques), dtype=bool)
+    text = np.flatnonzero(np.isnan(unique_values))
+    if len(text):
+        texts = uniques.iloc[text].map(str).str.strip()
+        is_censored = texts.str.match(censored_value_pattern).to_numpy(dtype=bool)
+        limits = pd.to_numeric(texts.str.extract(_censored_limit_pattern, expand=False),
+                               errors='coerce').to_numpy(dtype=float)
+        unique_values[text[is_censored]] = limits[is_censored]
+        unique_censored[text] = is_censored
+    # factorize gives -1 for empty cells; the appended slot reads as NaN and not censored
+    unique_values = np.append(unique_values, np.nan)
+    unique_censored = np.append(unique_censored, False)
+    return unique_values[codes], unique_censored[codes]
+
+def blank_cells(element_data):
+    """Batch × element mask of cells holding no result: empty cells and text that is only whitespace"""
+    blank = np.empty(element_data.shape, dtype=bool)
+    for j, element in enumerate(element_data.columns):
+        column = element_data[element]
+        if pd.api.types.is_numeric_dtype(column):
+            blank[:, j] = column.isna().to_numpy()
+            continue
+        codes, uniques = pd.factorize(column)
+        blank_unique = np.array([isinstance(value, str) and not value.strip() for value in uniques] + [True], dtype=bool)
+        blank[:, j] = blank_unique[codes]
+    return blank
+
+def parse_censored_frame(element_data):
+    """Parse every column of an element-column frame into (values, censored) batch × element arrays"""
+    values = np.empty(element_data.shape, dtype=float)
+    censored = np.zeros(element_data.shape, dtype=bool)
+    for j, element in enumerate(element_data.columns):
+        values[:, j], censored[:, j] = parse_censored_values(element_data[element])
+    return values, censored
+
+def _expand_to_store(store, element_data, parsed=None):
+    """Expand an element-column frame to (values, missing) arrays in the store element layout
+
+    Censored results are stored like other below-LOD results: 0.0 and flagged in the missing mask.
+    parsed is the frame's parse_censored_frame result when the caller already has it.
+    """
+    values = np.zeros((len(element_data), len(store.elements)), dtype=float)
+    missing = np.ones((len(element_data), len(store.elements)), dtype=bool)
+    columns = [store.element_index[element] for element in element_data.columns]
+    measured, censored = parsed if parsed is not None else parse_censored_frame(element_data)
+    unmeasured = np.isnan(measured) | censored
+    values[:, columns] = np.where(unmeasured, 0.0, measured)
+    missing[:, columns] = unmeasured
+    return values, missing
+
+_xlsx_namespaces = {
+    'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+    'rel': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+    'pkg': 'http://schemas.openxmlformats.org/package/2006/relationships',
+}
+_xlsx_text_pattern = re.compile(rb'<t(?:\s[^>]*)?>([^<]*)</t>')
+# Cell start tags in any attribute order and quoting, and every cell tag: blocks where the two counts differ
+# (cells without an r attribute...) go to openpyxl instead of losing rows
+_xlsx_any_cell_pattern = re.compile(rb'<c\b[^>]*?\sr=["\']([A-Z]+)(\d+)["\']')
+_xlsx_cell_tag_pattern = re.compile(rb'<c[\s/>]')
+_xlsx_style_pattern = re.compile(rb'\ss="(\d+)"')
+
+def _xlsx_cell_pattern(column_letters, any_layout=False):
+    """Regex matching the cells of the given columns in worksheet XML, capturing the attributes before r,
+    column, row, the attributes after r, value and inline string
+
+    The default pattern only follows the usual <c r="A1" ...> layout, which is much faster to scan; any_layout
+    also takes other attribute orders and single quotes.
+    """
+    letters = b'|'.join(letter.encode() for letter in column_letters)
+    start = rb'<c((?:\s[^>]*?)?)\sr=["\'](' + letters + rb')(\d+)["\']' if any_layout else \
+        rb'<c() r="(' + letters + rb')(\d+)"'
+    return re.compile(start + rb'([^>]*?)(?:/>|>(?:<f[^>]*?(?:/>|>.*?</f>))?'
+                      rb'(?:<v>([^<]*)</v>|<is>(.*?)</is>)?.*?</c>)', re.DOTALL)
+
+def _xlsx_cell_layout(data, start, end):
+    """'usual' when every <c...> tag in data[start:end] is a <c r="A1" ...> cell, 'other' when all cells still
+    have an r attribute, None when some cell can't be located by the patterns above"""
+    if data.count(b'<c', start, end) == data.count(b'<c r="', start, end):
+        return 'usual'
+    if len(_xlsx_cell_tag_pattern.findall(data, start, end)) == len(_xlsx_any_cell_pattern.findall(data, start, end)):
+        return 'other'
+    return None
+
+def _xlsx_sheet_paths(archive):
+    """(name, path) of every worksheet inside an xlsx archive, in workbook order"""
+    from xml.etree import ElementTree
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {relationship.get('Id'): relationship.get('Target')
+               for relationship in relationships.findall('pkg:Relationship', _xlsx_namespaces)}
+    sheets = []
+    for sheet in workbook.findall('main:sheets/main:sheet', _xlsx_namespaces):
+        target = targets.get(sheet.get(f"{{{_xlsx_namespaces['rel']}}}id"))
+        if target is not None and 'worksheets/' in target:  # Chart sheets have no cells
+            sheets.append((sheet.get('name'), target.lstrip('/') if target.startswith('/') else 'xl/' + target))
+    if not sheets:
+        raise ValueError("Workbook has no worksheet")
+    return sheets
+
+def xlsx_sheet_names(uploaded_file):
+    """Worksheet names of an xlsx file, in workbook order"""
+    import zipfile
+    
+    if hasattr(uploaded_file, 'seek'):
+        uploaded_file.seek(0)
+    with zipfile.ZipFile(uploaded_file) as archive:
+        return [name for name, _ in _xlsx_sheet_paths(archive)]
+
+def _xlsx_shared_strings(archive):
+    """Shared string table of an xlsx archive, leaving out phonetic runs"""
+    from xml.etree import ElementTree
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+    t_tag, r_tag, si_tag = (f"{{{_xlsx_namespaces['main']}}}{tag}" for tag in ('t', 'r', 'si'))
+    strings = []
+    with archive.open('xl/sharedStrings.xml') as f:
+        for _, element in ElementTree.iterparse(f):
+            if element.tag == si_tag:
+                strings.append(''.join(child.text or '' if child.tag == t_tag else child.findtext(t_tag) or ''
+                                       for child in element if child.tag in (t_tag, r_tag)))
+                element.clear()
+    return strings
+
+def _xlsx_date_styles(archive):
+    """Cell format indexes (the s attribute of a cell) whose number format shows a date or time"""
+    from xml.etree import ElementTree
+    from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+    if 'xl/styles.xml' not in archive.namelist():
+        return frozenset()
+    styles = ElementTree.fromstring(archive.read('xl/styles.xml'))
+    number_formats = dict(BUILTIN_FORMATS)
+    for number_format in styles.findall('main:numFmts/main:numFmt', _xlsx_namespaces):
+        number_formats[int(number_format.get('numFmtId'))] = number_format.get('formatCode')
+    cell_formats = styles.findall('main:cellXfs/main:xf', _xlsx_namespaces)
+    return frozenset(i for i, cell_format in enumerate(cell_formats)
+                     if is_date_format(number_formats.get(int(cell_format.get('numFmtId', 0))) or ''))
+
+def _xlsx_epoch(archive):
+    """Date system of an xlsx workbook, for converting date serial numbers"""
+    from xml.etree import ElementTree
+    from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900
+    properties = ElementTree.fromstring(archive.read('xl/workbook.xml')).find('main:workbookPr', _xlsx_namespaces)
+    date1904 = properties is not None and properties.get('date1904') in ('1', 'true')
+    return CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+
+def _xlsx_cell_value(attributes, value, inline, shared_strings, date_styles=frozenset(), epoch=None):
+    """Decode one matched cell to a float, a string, a bool, a datetime or None, as openpyxl would"""
+    if b"'" in attributes:
+        attributes = attributes.replace(b"'", b'"')
+    if value is not None:
+        if b't="s"' in attributes:
+            return shared_strings[int(value)]
+        if b't="str"' in attributes or b't="e"' in attributes:
+            return xml_unescape(value.decode('utf-8'))
+        if b't="b"' in attributes:
+            return value.strip() in (b'1', b'true')
+        if b't="d"' in attributes:
+            return pd.Timestamp(value.decode('utf-8')).to_pydatetime() if value else None
+        if not value:
+            return None
+        number = float(value)
+        if date_styles:
+            style = _xlsx_style_pattern.search(attributes)
+            if style is not None and int(style.group(1)) in date_styles:
+                from openpyxl.utils.datetime import from_excel
+                return from_excel(number, epoch)
+        return number
+    if inline is not None:
+        return xml_unescape(b''.join(_xlsx_text_pattern.findall(inline)).decode('utf-8'))
+    return None
+
+def _header_names(header_values):
+    """Column names from header cells, named and de-duplicated the way pandas does"""
+    names, seen = [], {}
+    for position, value in enumerate(header_values):
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            name = f"Unnamed: {position}"
+        elif isinstance(value, float) and value.is_integer():
+            name = str(int(value))
+        else:
+            name = str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+def _cells_to_frame(names, cells, first_row, stop_row):
+    """Assemble {name: (rows, values)} cell lists into a frame covering rows first_row..stop_row - 1
+
+    Columns holding only numbers become float arrays; 'Batch' is always text.
+    """
+    n = max(stop_row - first_row, 0)
+    data = {}
+    for name in names:
+        rows, values = cells[name]
+        positions = np.asarray(rows, dtype=np.int64) - first_row
+        if name == 'Batch':
+            column = np.full(n, None, dtype=object)
+            column[positions] = np.array([_batch_text(value) for value in values], dtype=object)
+        elif all(isinstance(value, float) for value in values):
+            column = np.full(n, np.nan)
+            column[positions] = np.asarray(values, dtype=float)
+        else:
+            column = np.full(n, np.nan, dtype=object)
+            column[positions] = np.array(values, dtype=object)
+        data[name] = column
+    return pd.DataFrame(data, columns=names)
+
+def _batch_text(value):
+    """Batch names as text, with whole numbers written without a decimal point"""
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else str(value)
+    return value if isinstance(value, str) else str(value)
+
+def read_xlsx_columns(uploaded_file, columns=None, block_size=4 * 1024 * 1024, sheet=0):
+    """Stream one worksheet (the first by default; an index or name) of an xlsx file, yielding frames holding
+    only the requested columns
+
+    The header row is resolved once; after that the worksheet XML is decompressed in blocks and only cells
+    of the requested columns are decoded, so auxiliary columns cost a regex skip instead of a parsed cell.
+    Cells decode as openpyxl reads them (numbers in a date format as datetimes, booleans as bools).
+    'Batch' is read as text and columns with only numbers as float. Requested columns missing from the file
+    are left out, and columns=None reads every column. Always yields at least one (possibly empty) frame.
+    Workbooks whose XML is not laid out the usual way fall back to openpyxl's read-only reader.
+    """
+    import zipfile
+    
+    if hasattr(uploaded_file, 'seek'):
+        uploaded_file.seek(0)
+    with zipfile.ZipFile(uploaded_file) as archive:
+        sheets = _xlsx_sheet_paths(archive)
+        paths = dict(sheets)
+        if not isinstance(sheet, str):
+            sheet = sheets[sheet][0]
+        elif sheet not in paths:
+            raise ValueError(f"Workbook has no sheet named '{sheet}'")
+        shared_strings = _xlsx_shared_strings(archive)
+        date_styles = _xlsx_date_styles(archive)
+        epoch = _xlsx_epoch(archive)
+        with archive.open(paths[sheet]) as sheet_file:
+            data = b''
+            header_end = -1
+            while header_end < 0:  # The header: the first row holding cells
+                block = sheet_file.read(block_size)
+                if not block:
+                    break
+                data += block
+                header_end = data.find(b'</row>')
+            header_stop = header_end if header_end >= 0 else len(data)
+            first = _xlsx_any_cell_pattern.search(data, 0, header_stop)
+            # Namespace-prefixed worksheets (<x:c>) are left to openpyxl altogether
+            if first is None or b'<sheetData' not in data or _xlsx_cell_layout(data, 0, header_stop) is None:
+                if not re.search(rb'<(?:\w+:)?c[\s/>]', data):
+                    yield pd.DataFrame(columns=[])  # Empty worksheet
+                    return
+                yield from _read_xlsx_columns_openpyxl(uploaded_file, columns, sheet=sheet)
+                return
+            header_row = int(first.group(2))
+            header_cells = {}
+            for match in _xlsx_cell_pattern(['[A-Z]+'], any_layout=True).finditer(data, 0, header_stop):
+                before, column_letters, row, after, value, inline = match.groups()
+                if int(row) == header_row:
+                    header_cells[column_letters.decode()] = _xlsx_cell_value(before + after, value, inline,
+                                                                             shared_strings, date_styles, epoch)
+            letters = _xlsx_column_range(max(header_cells, key=lambda letter: (len(letter), letter)))
+            name_by_letter = dict(zip(letters, _header_names([header_cells.get(letter) for letter in letters])))
+            if columns is not None:
+                name_by_letter = {letter: name for letter, name in name_by_letter.items() if name in columns}
+            names = list(name_by_letter.values())
+            if not names:
+                yield pd.DataFrame(columns=[])
+                return
+            
+            patterns = {layout: _xlsx_cell_pattern(name_by_letter, any_layout=layout == 'other')
+                        for layout in ('usual', 'other')}
+            data = data[header_end + len(b'</row>'):]
+            next_row = header_row + 1
+            yielded = False
+            while True:
+                block = sheet_file.read(block_size)
+                data += block
+                # Only complete rows are decoded; the tail is carried over to the next block
+                end = data.rfind(b'</row>') if block else len(data)
+                if end < 0:
+                    continue
+                cut = end + len(b'</row>') if block else end
+                layout = _xlsx_cell_layout(data, 0, cut)
+                if layout is None:
+                    # Carry on with openpyxl from the first row not yielded yet
+                    yield from _read_xlsx_columns_openpyxl(uploaded_file, columns, sheet=sheet, header_row=header_row,
+                                                           first_row=next_row)
+                    return
+                cells = {name: ([], []) for name in names}
+                for match in patterns[layout].finditer(data, 0, cut):
+                    before, column_letters, row, after, value, inline = match.groups()
+                    value = _xlsx_cell_value(before + after, value, inline, shared_strings, date_styles, epoch)
+                    if value is not None:
+                        rows, values = cells[name_by_letter[column_letters.decode()]]
+                        rows.append(int(row))
+                        values.append(value)
+                last_row = max([rows[-1] for rows, _ in cells.values() if rows], default=next_row - 1)
+                data = data[cut:]
+                if last_row >= next_row:
+                    yield _cells_to_frame(names, cells, next_row, last_row + 1)
+                    yielded = True
+                    next_row = last_row + 1
+                if not block:
+                    break
+            if not yielded:
+                yield _cells_to_frame(names, {name: ([], []) for name in names}, next_row, next_row)
+
+def _xlsx_column_range(last_letters):
+    """Column letters A, B, ... up to and including last_letters"""
+    from openpyxl.utils import column_index_from_string, get_column_letter
+    return [get_column_letter(i) for i in range(1, column_index_from_string(last_letters) + 1)]
+
+def _read_xlsx_columns_openpyxl(uploaded_file, columns=None, chunksize=50000, sheet=0, header_row=None, first_row=None):
+    """read_xlsx_columns through openpyxl's read-only reader, for workbooks the XML scan can't follow
+
+    The header is the first row unless header_row is given; first_row resumes a partly streamed sheet.
+    """
+    import itertools
+    import openpyxl
+    
+    uploaded_file.seek(0)
+    workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if isinstance(sheet, str) else workbook.worksheets[sheet]
+        rows = worksheet.iter_rows(values_only=True)
+        if header_row is not None:
+            rows = worksheet.iter_rows(min_row=header_row, max_row=header_row, values_only=True)
+        names = _header_names(next(rows, None) or ())
+        if first_row is not None:
+            rows = worksheet.iter_rows(min_row=first_row, values_only=True)
+        positions = [i for i, name in enumerate(names) if columns is None or name in columns]
+        names = [names[i] for i in positions]
+        if not positions:
+            yield pd.DataFrame(columns=[])
+            return
+        width = positions[-1] + 1
+        while True:
+            block = [row + (None,) * (width - len(row)) for row in itertools.islice(rows, chunksize)]
+            cells = {name: ([], []) for name in names}
+            for i, row in enumerate(block):
+                for name, position in zip(names, positions):
+                    value = row[position]
+                    if value is not None:
+                        cells[name][0].append(i)
+                        is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                        cells[name][1].append(float(value) if is_number else value)
+            yield _cells_to_frame(names, cells, 0, len(block))
+            if len(block) < chunksize:
+                break
+    finally:
+        workbook.close()
+
+def stream_batch_upload_file(uploaded_file, selected_elements, store=None, chunksize=50000):
+    """Stream a CSV or Excel batch file into a columnar results store in bounded chunks
+
+    Only the 'Batch' column and the selected element columns are read, with 'Batch' as text.
+    CSV and xlsx files are read chunk by chunk (see read_xlsx_columns); .xls files in one pass
+    restricted to those columns.
+    Each chunk gets the row checks of validate_batch_data: rows with non-numeric or negative results,
+    and repeats of a batch id earlier in the file, are skipped and reported in results['errors'].
+    Batch ids already in the store from other uploads are overwritten. Returns (store, results, error)
+    where results has the same layout as process_batch_data.
+    """
+    results = {
+        "added": 0,
+        "skipped": 0,
+        "errors": [],
+        "processed_batches": []
+    }
+    if store is None:
+        store = BatchResultStore()
+    
+    wanted_columns = set(selected_elements) | {'Batch'}
+    dtypes = {'Batch': str}  # Element columns may hold censored strings like "<0.05", see parse_censored_values
+    seen_batches = set()
+    duplicates = []
+    non_numeric_rows = {}
+    negative_elements = []
+    rejected = 0
+    row_offset = 2  # File row of the first data row, after the header
+    
+    try:
+        if hasattr(uploaded_file, 'seek'):
+            uploaded_file.seek(0)
+        file_extension = uploaded_file.name.split('.')[-1].lower()
+        
+        if file_extension == 'csv':
+            chunks = pd.read_csv(uploaded_file, usecols=lambda column: column in wanted_columns,
+                                 dtype=dtypes, chunksize=chunksize)
+        elif file_extension == 'xlsx':
+            chunks = read_xlsx_columns(uploaded_file, wanted_columns)
+        elif file_extension == 'xls':
+            chunks = [pd.read_excel(uploaded_file, usecols=lambda column: column in wanted_columns, dtype=dtypes)]
+        else:
+            return store, results, "Unsupported file format. Please upload CSV or Excel files only."
+        
+        for chunk in chunks:
+            if 'Batch' not in chunk.columns:
+                return store, results, "Missing required 'Batch' column in the file."
+            
+            element_columns = [element for element in selected_elements
+                               if element in chunk.columns and element in store.element_index]
+            if not element_columns:
+                return store, results, f"No matching element columns found. Your file should include columns for some of these elements: {', '.join(selected_elements)}."
+            
+            batch_names = chunk['Batch'].map(str)
+            valid = np.array(chunk['Batch'].notna() & (batch_names != '') & (batch_names != 'nan'), dtype=bool)
+            skipped = int((~valid).sum())
+            if skipped:
+                results["skipped"] += skipped
+                results["errors"].append(f"Skipped {skipped} row(s) with missing batch name")
+            
+            element_data = chunk[element_columns]
+            measured, censored = parse_censored_frame(element_data)
+            non_numeric = ~blank_cells(element_data) & np.isnan(measured) & ~censored
+            with np.errstate(invalid='ignore'):
+                negative = (measured < 0) & ~censored
+            names = batch_names.tolist()
+            earlier = np.fromiter(map(seen_batches.__contains__, names), dtype=bool, count=len(names))
+            repeated = valid & (batch_names.duplicated().to_numpy() | earlier)
+            bad = valid & (non_numeric.any(axis=1) | negative.any(axis=1) | repeated)
+            if bad.any():
+                rejected += int(bad.sum())
+                duplicates.extend(batch_names[repeated].tolist())
+                for j, element in enumerate(element_columns):
+                    rows = np.flatnonzero(valid & non_numeric[:, j])
+                    if len(rows):
+                        non_numeric_rows.setdefault(element, []).extend((rows + row_offset).tolist())
+                    if (valid & negative[:, j]).any() and element not in negative_elements:
+                        negative_elements.append(element)
+                valid = valid & ~bad
+            row_offset += len(chunk)
+            
+            batch_names = batch_names[valid].tolist()
+            seen_batches.update(batch_names)
+            store.upsert(batch_names, *_expand_to_store(store, element_data[valid], (measured[valid], censored[valid])))
+            results["added"] += len(batch_names)
+            results["processed_batches"].extend(batch_names)
+        
+        if rejected:
+            results["skipped"] += rejected
+            results["errors"].append(f"Skipped {rejected} row(s) with invalid results")
+            if duplicates:
+                results["errors"].append(f"Duplicate batch names found: {_name_list(duplicates)}")
+            for element in [element for element in selected_elements
+                            if element in non_numeric_rows or element in negative_elements]:
+                if element in non_numeric_rows:
+                    results["errors"].append(f"Column '{element}' contains non-numeric values in rows: "
+                                             f"{_name_list(non_numeric_rows[element])}")
+                if element in negative_elements:
+                    results["errors"].append(f"Negative values found for {element}")
+        return store, results, None
+    
+    except Exception as e:
+        return store, results, f"Error parsing file: {str(e)}"
+
+def _read_batch_frame(uploaded_file):
+    """Read an uploaded CSV or Excel file into a frame, returning (df, error)"""
+    try:
+        file_extension = uploaded_file.name.split('.')[-1].lower()
+        
+        if file_extension == 'csv':
+            df = pd.read_csv(uploaded_file)
+        elif file_extension in ['xlsx', 'xls']:
+            df = pd.read_excel(uploaded_file)
+        else:
+            return None, "Unsupported file format. Please upload CSV or Excel files only."
+        return df, None
+        
+    except Exception as e:
+        return None, f"Error parsing file: {str(e)}"
+
+def _check_batch_frame(df, selected_elements, numeric=True):
+    """Check a parsed frame has a Batch column and numeric columns for some selected elements, returning (df, error)
+
+    With numeric=False non-numeric cells are left for diagnose_batch_data to report row by row.
+    """
+    try:
+        # Basic validation
+        if 'Batch' not in df.columns:
+            return None, "Missing required 'Batch' column in the file."
+        
+        element_columns = [col for col in df.columns if col in selected_elements]
+        if not element_columns:
+            return None, f"No matching element columns found. Your file should include columns for some of these elements: {', '.join(selected_elements)}."
+        
+        for col in element_columns if numeric else []:
+            values, censored = parse_censored_values(df[col])
+            if (~blank_cells(df[[col]])[:, 0] & np.isnan(values) & ~censored).any():
+                return None, f"Column '{col}' contains non-numeric values."
+        
+        return df, None
+        
+    except Exception as e:
+        return None, f"Error parsing file: {str(e)}"
+
+def parse_batch_upload_file(uploaded_file, selected_elements):
+    """Parse uploaded CSV or Excel file containing batch results"""
+    df, error = _read_batch_frame(uploaded_file)
+    if df is None:
+        return None, error
+    return _check_batch_frame(df, selected_elements)
+
+def upload_content_hash(uploaded_file):
+    """SHA-256 of an uploaded file's bytes"""
+    if hasattr(uploaded_file, 'getvalue'):
+        return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    uploaded_file.seek(0)
+    digest = hashlib.sha256()
+    for block in iter(lambda: uploaded_file.read(1024 * 1024), b''):
+        digest.update(block)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+class ParseCache:
+    """Entry- and byte-bounded LRU cache of parsed upload frames and their validation results"""
+    
+    def __init__(self, max_entries=32, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Get a cached value for a key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, value, nbytes=0):
+        """Cache a value whose in-memory size is about nbytes, evicting least recently used entries over budget"""
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self._size += nbytes
+            while self._size > self.max_bytes or len(self._entries) > self.max_entries:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._size -= evicted_bytes
+                self.evictions += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+            }
+
+def parse_and_validate_upload(uploaded_file, selected_elements, cache=None, content_hash=None):
+    """Parse and validate an uploaded batch file, reusing cached results for the same content and element set
+
+    The parsed frame is cached by content hash alone and the check results by content hash and element
+    selection, so changing the selection only re-runs the checks. Returns a dict with 'df', 'parse_error',
+    'validation_errors', 'warnings' and the row-level 'diagnostics' table; the cached frame is shared and
+    must not be modified.
+    """
+    if cache is None:
+        cache = ParseCache(max_entries=2)
+    if content_hash is None:
+        content_hash = upload_content_hash(uploaded_file)
+    file_extension = uploaded_file.name.split('.')[-1].lower()
+    
+    frame_key = ('frame', content_hash, file_extension)
+    frame = cache.get(frame_key)
+    if frame is None:
+        if hasattr(uploaded_file, 'seek'):
+            uploaded_file.seek(0)
+        frame = _read_batch_frame(uploaded_file)
+        nbytes = int(frame[0].memory_usage(index=True, deep=True).sum()) if frame[0] is not None else 0
+        cache.put(frame_key, frame, nbytes)
+    df, parse_error = frame
+    
+    # Check results hold no reference to the frame; only their diagnostics table adds to the byte budget
+    checked_key = ('checked', content_hash, file_extension, tuple(selected_elements))
+    checked = cache.get(checked_key)
+    if checked is None:
+        if df is not None:
+            parse_error = _check_batch_frame(df, selected_elements, numeric=False)[1]
+        if parse_error is None:
+            diagnostics = diagnose_batch_data(df, selected_elements)
+        else:
+            diagnostics = pd.DataFrame(columns=diagnostic_columns)
+        validation_errors, warnings = summarize_diagnostics(diagnostics, df.columns if df is not None else None)
+        checked = {'parse_error': parse_error, 'validation_errors': validation_errors, 'warnings': warnings,
+                   'diagnostics': diagnostics}
+        cache.put(checked_key, checked, int(diagnostics.memory_usage(index=True, deep=True).sum()))
+    return dict(checked, df=df if checked['parse_error'] is None else None)
+
+def process_batch_data(df, selected_elements, store=None):
+    """Process parsed batch data and add to a batch results store (a new one by default)"""
+    results = {
+        "added": 0,
+        "skipped": 0,
+        "errors": [],
+        "processed_batches": []
+    }
+    if store is None:
+        store = BatchResultStore()
+    
+    try:
+        batch_names = df['Batch'].map(str)
+        valid = df['Batch'].notna() & (batch_names != '') & (batch_names != 'nan')
+        
+        results["skipped"] = int((~valid).sum())
+        results["errors"].extend(["Skipped row with missing batch name"] * results["skipped"])
+        
+        element_columns = [element for element in selected_elements
+                           if element in df.columns and element in store.element_index]
+        batch_names = batch_names[valid].tolist()
+        store.upsert(batch_names, *_expand_to_store(store, df.loc[valid, element_columns]))
+        
+        results["added"] = len(batch_names)
+        results["processed_batches"] = batch_names
+        return results
+        
+    except Exception as e:
+        results["errors"].append(f"Error processing batch data: {str(e)}")
+        return results
+
+batch_conflict_policies = {
+    'last': "Keep the result from the last file",
+    'first': "Keep the result from the first file",
+    'reject': "Reject batches found in more than one file",
+}
+
+def _upload_sources(uploaded_file):
+    """Split one uploaded file into ingest jobs: one per worksheet of a workbook, one for a CSV file"""
+    data = uploaded_file.getvalue() if hasattr(uploaded_file, 'getvalue') else uploaded_file.read()
+    file_extension = uploaded_file.name.split('.')[-1].lower()
+    if file_extension == 'xlsx':
+        sheets = xlsx_sheet_names(io.BytesIO(data))
+    elif file_extension == 'xls':
+        sheets = pd.ExcelFile(io.BytesIO(data)).sheet_names
+    else:
+        sheets = [None]
+    return [{'file': uploaded_file.name, 'sheet': sheet, 'extension': file_extension, 'data': data,
+             'other_sheets': len(sheets) > 1} for sheet in sheets]
+
+def _ingest_source(source, selected_elements):
+    """Read and validate one file or worksheet, keeping only the Batch and selected element columns"""
+    start = time.perf_counter()
+    report = {'file': source['file'], 'sheet': source['sheet'], 'rows': 0, 'df': None, 'parse_error': None,
+              'skipped': False, 'unnamed': 0, 'validation_errors': [], 'warnings': [],
+              'diagnostics': pd.DataFrame(columns=diagnostic_columns)}
+    wanted_columns = set(selected_elements) | {'Batch'}
+    try:
+        if source.get('error'):
+            raise ValueError(source['error'])
+        data = io.BytesIO(source['data'])
+        if source['extension'] == 'csv':
+            df = pd.read_csv(data, usecols=lambda column: column in wanted_columns, dtype={'Batch': str})
+        elif source['extension'] == 'xlsx':
+            df = pd.concat(list(read_xlsx_columns(data, wanted_columns, sheet=source['sheet'])), ignore_index=True)
+        elif source['extension'] == 'xls':
+            df = pd.read_excel(data, sheet_name=source['sheet'], usecols=lambda column: column in wanted_columns,
+                               dtype={'Batch': str})
+        else:
+            df, report['parse_error'] = None, "Unsupported file format. Please upload CSV or Excel files only."
+        # Worksheets of a multi-sheet workbook without a Batch column (notes, QC...) are skipped, not errors
+        report['skipped'] = df is not None and 'Batch' not in df.columns and source.get('other_sheets', False)
+        if df is not None:
+            df, report['parse_error'] = _check_batch_frame(df, selected_elements, numeric=False)
+        if df is not None:
+            report['rows'] = len(df)
+            report['diagnostics'] = diagnose_batch_data(df, selected_elements)
+            report['validation_errors'], report['warnings'] = summarize_diagnostics(report['diagnostics'], df.columns)
+            report['df'] = df
+    except Exception as e:
+        report['parse_error'] = source.get('error') or f"Error parsing file: {str(e)}"
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+def ingest_batch_files(uploaded_files, selected_elements, store=None, conflict='last', workers=None, progress=None):
+    """Parse and validate many batch files, every worksheet of each workbook, concurrently and merge them
+
+    Files and worksheets are read in a thread pool; progress(done, total, report) is called from the calling
+    thread as each one finishes. Sources with parse or validation errors are left out. The rest are merged
+    in upload order (then worksheet order), whatever order they finished in, and a batch id found in more
+    than one source is resolved by the conflict policy (see batch_conflict_policies). The merged batches are
+    added to the store like process_batch_data does.
+
+    Rows without a batch name are counted per source ('unnamed' in its report) and in 'skipped'.
+    Returns the process_batch_data results plus 'sources' (one report per file or worksheet, with timings),
+    'conflicts' (a frame of the repeated batch ids and where they came from), 'diagnostics' (all sources,
+    with a 'source' column) and 'seconds'.
+    """
+    if conflict not in batch_conflict_policies:
+        raise ValueError(f"Unknown conflict policy: {conflict}")
+    start = time.perf_counter()
+    sources = []
+    for uploaded_file in uploaded_files:
+        try:
+            sources.extend(_upload_sources(uploaded_file))
+        except Exception as e:
+            sources.append({'file': uploaded_file.name, 'sheet': None, 'error': f"Error parsing file: {str(e)}"})
+    
+    reports = [None] * len(sources)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_ingest_source, source, selected_elements): k for k, source in enumerate(sources)}
+        for finished, future in enumerate(as_completed(futures), 1):
+            reports[futures[future]] = future.result()
+            if progress is not None:
+                progress(finished, len(sources), reports[futures[future]])
+    
+    def source_name(report):
+        return report['file'] if report['sheet'] is None else f"{report['file']} [{report['sheet']}]"
+    
+    frames = []
+    for k, report in enumerate(reports):
+        if report['df'] is not None and not report['validation_errors']:
+            frame = report['df']
+            names = frame['Batch'].map(str)
+            named = frame['Batch'].notna() & (names != '') & (names != 'nan')
+            report['unnamed'] = int((~named).sum())
+            frame = frame.loc[named]
+            frames.append(frame.assign(_batch=names[frame.index], _source=k))
+    merged = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['Batch', '_batch', '_source'])
+    
+    repeated = merged['_batch'].duplicated(keep=False).to_numpy()
+    if conflict == 'reject':
+        keep = ~repeated
+    else:
+        keep = ~merged['_batch'].duplicated(keep=conflict).to_numpy()
+    
+    # One row per repeated batch id, in order of first appearance, listing its sources in upload order
+    source_names = np.array([source_name(report) for report in reports] + [None], dtype=object)
+    codes, conflict_batches = pd.factorize(merged['_batch'].to_numpy(dtype=object)[repeated])
+    sources = merged['_source'].to_numpy(dtype=np.int64)[repeated]
+    order = np.lexsort((sources, codes))
+    codes, sources = codes[order], sources[order]
+    first = np.ones(len(codes), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (sources[1:] != sources[:-1])
+    codes, sources = codes[first], sources[first]
+    groups = np.split(source_names[sources], np.flatnonzero(np.diff(codes)) + 1) if len(codes) else []
+    kept = np.full(len(conflict_batches), -1, dtype=np.int64)
+    kept_rows = repeated & keep
+    kept[pd.Index(conflict_batches).get_indexer(merged['_batch'].to_numpy(dtype=object)[kept_rows])] = \
+        merged['_source'].to_numpy(dtype=np.int64)[kept_rows]
+    conflicts = pd.DataFrame({
+        'batch': conflict_batches,
+        'sources': ['; '.join(names) for names in groups],
+        'kept': source_names[kept],
+    })
+    
+    element_columns = [element for element in selected_elements if element in merged.columns]
+    results = process_batch_data(merged.loc[keep, ['Batch'] + element_columns], selected_elements, store)
+    if conflict == 'reject' and len(conflicts):
+        results["errors"].append(f"Rejected {len(conflicts)} batch id(s) found in more than one file")
+    for report in reports:
+        if report['skipped']:
+            continue
+        for error in ([report['parse_error']] if report['parse_error'] else []) + report['validation_errors']:
+            results["errors"].append(f"{source_name(report)}: {error}")
+        if report['unnamed']:
+            results["skipped"] += report['unnamed']
+            results["errors"].append(f"{source_name(report)}: Skipped {report['unnamed']} row(s) with missing batch name")
+    
+    results["sources"] = [{key: value for key, value in report.items() if key not in ('df', 'diagnostics')}
+                          for report in reports]
+    results["conflicts"] = conflicts
+    results["diagnostics"] = pd.concat(
+        [report['diagnostics'].assign(source=source_name(report)) for report in reports if len(report['diagnostics'])],
+        ignore_index=True
+    ) if any(len(report['diagnostics']) for report in reports) else pd.DataFrame(columns=['source'] + diagnostic_columns)
+    results["seconds"] = time.perf_counter() - start
+    return results
+
+def generate_template_file(selected_elements, file_type="csv"):
+    """Generate a template file for batch uploads"""
+    from io import StringIO
+    
+    columns = ["Batch"] + selected_elements
+    df = pd.DataFrame(columns=columns)
+    
+    sample_data = [
+        {"Batch": "SAMPLE_BATCH_001", **{element: 0.0 for element in selected_elements}},
+        {"Batch": "SAMPLE_BATCH_002", **{element: 0.0 for element in selected_elements}},
+        {"Batch": "SAMPLE_BATCH_003", **{element: 0.0 for element in selected_elements}}
+    ]
+    
+    df = pd.concat([df, pd.DataFrame(sample_data)], ignore_index=True)
+    
+    if file_type == "csv":
+        buffer = StringIO()
+        df.to_csv(buffer, index=False)
+        buffer.seek(0)
+        return buffer.getvalue(), "text/csv"
+    else:
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+            df.to_excel(writer, index=False, sheet_name='Batch Results')
+        buffer.seek(0)
+        return buffer, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+extreme_value_limit = 1000  # ppm; higher results are flagged as likely unit or transcription errors
+sparse_column_fraction = 0.5  # element columns with more empty cells than this are flagged
+diagnostic_columns = ['row', 'file_row', 'batch', 'column', 'check', 'severity', 'value', 'message']
+
+def diagnose_batch_data(df, selected_elements):
+    """Run every upload check over all element columns at once, returning one diagnostics row per finding
+
+    Cell findings carry the frame row index and the row number in the uploaded file (header on row 1);
+    column findings leave both empty. Severity is 'error' (blocks processing), 'warning' or 'info'.
+    """
+    n = len(df)
+    parts = []
+    index_values = df.index.to_numpy()
+    if 'Batch' in df.columns:
+        batch = df['Batch']
+    else:
+        batch = pd.Series(np.full(n, None, dtype=object), index=df.index)
+    batch_values = batch.to_numpy(dtype=object)
+    
+    def add(rows, column, check, severity, values, message):
+        if len(rows):
+            parts.append(pd.DataFrame({
+                'row': index_values[rows], 'file_row': rows + 2, 'batch': batch_values[rows], 'column': column,
+                'check': check, 'severity': severity, 'value': values, 'message': message
+            }))
+    
+    def add_column(column, check, severity, value, message):
+        parts.append(pd.DataFrame({
+            'row': [None], 'file_row': [None], 'batch': [None], 'column': [column],
+            'check': [check], 'severity': [severity], 'value': [value], 'message': [message]
+        }))
+    
+    missing = (batch.isna() | batch.isin(['', 'nan'])).to_numpy()
+    rows = np.flatnonzero(missing)
+    add(rows, 'Batch', 'missing_batch', 'warning', batch_values[rows], "Row has no batch name and will be skipped")
+    rows = np.flatnonzero(batch.duplicated().to_numpy() & ~missing)
+    add(rows, 'Batch', 'duplicate_batch', 'error', batch_values[rows], "Batch name already used by an earlier row")
+    
+    element_columns = [col for col in df.columns if col in selected_elements]
+    values, censored = parse_censored_frame(df[element_columns])
+    empty = blank_cells(df[element_columns])
+    non_numeric = ~empty & np.isnan(values) & ~censored
+    values[censored] = np.nan  # Stated detection limits are not results
+    columns = np.array(element_columns, dtype=object)
+    
+    rows, cols = np.nonzero(non_numeric)
+    if len(rows):
+        add(rows, columns[cols], 'non_numeric', 'error', df[element_columns].to_numpy(dtype=object)[rows, cols],
+            "Value is not a number")
+    with np.errstate(invalid='ignore'):
+        rows, cols = np.nonzero(values < 0)
+        add(rows, columns[cols], 'negative', 'error', values[rows, cols], "Negative result")
+        rows, cols = np.nonzero(values > extreme_value_limit)
+        add(rows, columns[cols], 'extreme', 'warning', values[rows, cols],
+            f"Result above {extreme_value_limit} ppm, check units")
+    
+    if n:
+        empty_fraction = empty.mean(axis=0)
+        for element, fraction in zip(element_columns, empty_fraction):
+            if fraction > sparse_column_fraction:
+                add_column(element, 'sparse_column', 'warning', round(float(fraction), 4),
+                           f"{fraction:.0%} of cells are empty")
+    
+    for col in df.columns:
+        if col == 'Batch' or col in selected_elements:
+            continue
+        if col in elements_table:
+            add_column(col, 'unselected_column', 'info', None, "Element is not selected and will be ignored")
+        else:
+            add_column(col, 'unknown_column', 'warning', None, "Not a known element column and will be ignored")
+    
+    if not parts:
+        return pd.DataFrame(columns=diagnostic_columns)
+    diagnostics = pd.concat(parts, ignore_index=True)
+    if pd.api.types.is_integer_dtype(df.index):
+        diagnostics['row'] = diagnostics['row'].astype('Int64')
+    diagnostics['file_row'] = diagnostics['file_row'].astype('Int64')
+    return diagnostics[diagnostic_columns]
+
+def _name_list(values, limit=20):
+    """Comma separated names, shortened after limit names"""
+    names = [str(value) for value in values[:limit]]
+    if len(values) > limit:
+        names.append(f"and {len(values) - limit} more")
+    return ', '.join(names)
+
+def summarize_diagnostics(diagnostics, columns=None):
+    """Turn a diagnostics table into (validation_errors, warnings) messages, per element in columns order if given"""
+    validation_errors = []
+    warnings = []
+    by_check = {check: group for check, group in diagnostics.groupby('check', sort=False)}
+    
+    if 'duplicate_batch' in by_check:
+        validation_errors.append(f"Duplicate batch names found: {_name_list(by_check['duplicate_batch']['value'].tolist())}")
+    
+    element_columns = diagnostics.loc[diagnostics['check'].isin(['non_numeric', 'negative', 'extreme', 'sparse_column']),
+                                      'column'].unique().tolist()
+    if columns is not None:
+        element_columns = [col for col in columns if col in element_columns]
+    grouped = {check: dict(tuple(by_check[check].groupby('column', sort=False)))
+               for check in ['non_numeric', 'negative', 'extreme', 'sparse_column'] if check in by_check}
+    for element in element_columns:
+        non_numeric = grouped.get('non_numeric', {}).get(element)
+        if non_numeric is not None:
+            validation_errors.append(f"Column '{element}' contains non-numeric values in rows: "
+                                     f"{_name_list(non_numeric['file_row'].tolist())}")
+        extreme = grouped.get('extreme', {}).get(element)
+        if extreme is not None:
+            warnings.append(f"Extreme values (>{extreme_value_limit}) for {element} in batches: "
+                            f"{_name_list(extreme['batch'].tolist())}")
+        if element in grouped.get('negative', {}):
+            validation_errors.append(f"Negative values found for {element}")
+        sparse = grouped.get('sparse_column', {}).get(element)
+        if sparse is not None:
+            warnings.append(f"Column '{element}' is {sparse['value'].iloc[0]:.0%} empty")
+    
+    if 'missing_batch' in by_check:
+        warnings.append(f"{len(by_check['missing_batch'])} row(s) without a batch name will be skipped")
+    if 'unknown_column' in by_check:
+        warnings.append(f"Unknown columns will be ignored: {_name_list(by_check['unknown_column']['column'].tolist())}")
+    return validation_errors, warnings
+
+def validate_batch_data(df, selected_elements):
+    """Validate batch data before processing"""
+    return summarize_diagnostics(diagnose_batch_data(df, selected_elements), df.columns)
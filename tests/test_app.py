@@ -0,0 +1,36 @@
+"""Streamlit page smoke tests with AppTest"""
+import os
+
+import pytest
+
+pytest.importorskip("streamlit.testing.v1")
+from streamlit.testing.v1 import AppTest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "elemental_impuritites.py")
+
+
+def run_with_batches(configure):
+    at = AppTest.from_file(APP, default_timeout=60)
+    at.run()
+    store = at.session_state["batch_results"]
+    store.upsert(["B1", "B2"], [[0.1 * (i + 1)] * len(store.elements) for i in range(2)])
+    configure(at)
+    at.run()
+    return at
+
+
+def test_batch_page_renders():
+    at = run_with_batches(lambda at: None)
+    assert not at.exception
+
+
+def test_batch_page_without_pde_elements():
+    def only_iron_oral(at):
+        at.selectbox(key="calc_route").set_value("oral")
+        for checkbox in at.checkbox:
+            if checkbox.key and checkbox.key.startswith("calc_element_"):
+                checkbox.set_value(checkbox.key == "calc_element_Fe")
+    
+    at = run_with_batches(only_iron_oral)
+    assert not at.exception
+    assert any("No selected element has a PDE" in info.value for info in at.info)
@@ -0,0 +1,46 @@
+"""Censored result parsing and blank cell handling"""
+import numpy as np
+import pandas as pd
+
+import ei_core
+
+
+def test_parse_censored_values():
+    column = pd.Series(["0.12", "<0.05", "< 0.5", "≤0.2", "&lt;0.1", "ND", "n.d.", "<LOQ", "BLQ", "abc", None, 3])
+    values, censored = ei_core.parse_censored_values(column)
+    np.testing.assert_array_equal(censored, [False, True, True, True, True, True, True, True, True, False, False, False])
+    np.testing.assert_allclose(values[:5], [0.12, 0.05, 0.5, 0.2, 0.1])
+    assert np.isnan(values[5:10]).all()
+    assert np.isnan(values[10])
+    assert values[11] == 3
+
+
+def test_parse_censored_values_numeric_fast_path():
+    values, censored = ei_core.parse_censored_values(pd.Series([0.1, np.nan, 2.0]))
+    np.testing.assert_array_equal(values[[0, 2]], [0.1, 2.0])
+    assert not censored.any()
+
+
+def test_censored_cells_are_stored_as_missing():
+    df = pd.DataFrame({"Batch": ["A", "B"], "Cd": ["<0.05", "0.2"], "Pb": ["ND", ""]})
+    store = ei_core.BatchResultStore()
+    results = ei_core.process_batch_data(df, ["Cd", "Pb"], store)
+    assert results["added"] == 2
+    values, missing = store.matrix(["Cd", "Pb"])
+    np.testing.assert_array_equal(missing, [[True, True], [False, True]])
+    np.testing.assert_array_equal(values, [[0.0, 0.0], [0.2, 0.0]])
+
+
+def test_blank_cells():
+    frame = pd.DataFrame({"Cd": ["0.1", "", "  ", None], "Pb": [1.0, np.nan, 2.0, 3.0]}, dtype=object)
+    np.testing.assert_array_equal(ei_core.blank_cells(frame),
+                                  [[False, False], [True, True], [True, False], [True, False]])
+
+
+def test_blank_cells_are_not_non_numeric():
+    df = pd.DataFrame({"Batch": ["A", "B", "C"], "Cd": ["0.1", "", " "], "Pb": ["<0.05", "x", None]})
+    diagnostics = ei_core.diagnose_batch_data(df, ["Cd", "Pb"])
+    non_numeric = diagnostics[diagnostics["check"] == "non_numeric"]
+    assert non_numeric[["batch", "column"]].values.tolist() == [["B", "Pb"]]
+    errors, _ = ei_core.validate_batch_data(df, ["Cd", "Pb"])
+    assert errors == ["Column 'Pb' contains non-numeric values in rows: 3"]
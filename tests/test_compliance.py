@@ -0,0 +1,94 @@
+"""Limits and Situation parity with the original per-cell implementation"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import ei_core
+
+
+def reference_limits(elements, daily_dose, route, control_percentage):
+    """calculate_limits as it was before the vectorized engine"""
+    rows = []
+    for element, properties in elements.items():
+        pde = properties.get(f"PDE_{route}")
+        if pde is None:
+            continue
+        mpc = pde / daily_dose
+        control_limit = mpc * (control_percentage / 100)
+        digits = 2 if mpc < 1 else 1 if mpc < 10 else None
+        mpc_rounded, control_rounded = round(mpc, digits), round(control_limit, digits)
+        rows.append({
+            "Element": element,
+            "Class": properties["Class"],
+            f"PDE ({route}) µg/day": pde,
+            "MPC µg/g": mpc_rounded,
+            f"Control Strategy Limit ({control_percentage}%) µg/g": control_rounded,
+            "MPC ng/mL": mpc_rounded * 1000,
+            f"Control Strategy Limit ({control_percentage}%) ng/mL": control_rounded * 1000,
+        })
+    return pd.DataFrame(rows)
+
+
+def reference_situation(batch_results, calculation_data, route, daily_dose, control_percentage):
+    """Per-cell Situation and flagged elements as the original loops computed them"""
+    situation, above_threshold, above_pde = 1, set(), set()
+    pdes = dict(zip(calculation_data['Element'], calculation_data[f'PDE ({route}) µg/day']))
+    for batch_data in batch_results.values():
+        for element, measured in batch_data.items():
+            if element not in pdes:
+                continue
+            exposure = measured * daily_dose
+            if exposure > pdes[element]:
+                situation = 3
+                above_pde.add(element)
+            elif exposure > pdes[element] * (control_percentage / 100):
+                situation = max(situation, 2)
+                above_threshold.add(element)
+    return situation, above_threshold, above_pde
+
+
+def random_batches(seed, elements, n_batches=15):
+    rng = np.random.default_rng(seed)
+    return {f"B{i:03d}": {element: float(round(rng.choice([0.0, rng.uniform(0, 2.0)]), 4)) for element in elements}
+            for i in range(n_batches)}
+
+
+@pytest.mark.parametrize("route", ["oral", "parenteral", "inhalation", "cutaneous"])
+@pytest.mark.parametrize("daily_dose", [0.05, 1.0, 10.0, 36.6])
+@pytest.mark.parametrize("control_percentage", [30, 50])
+def test_limits_match_reference(route, daily_dose, control_percentage):
+    elements = {element: ei_core.elements_table[element] for element in ["Cd", "Pb", "As", "Hg", "Co", "V", "Ni", "Li", "Fe"]}
+    expected = reference_limits(elements, daily_dose, route, control_percentage)
+    actual = ei_core.calculate_limits(elements, daily_dose, route, control_percentage)
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected, check_dtype=False)
+
+
+def test_limits_empty_for_non_positive_dose():
+    assert ei_core.calculate_limits({"Cd": ei_core.elements_table["Cd"]}, 0, "oral").empty
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("route", ["oral", "parenteral"])
+def test_situation_matches_reference(seed, route):
+    elements = ["Cd", "Pb", "As", "Hg", "Co", "V", "Ni", "Li"]
+    batch_results = random_batches(seed, elements)
+    daily_dose = [0.5, 2.0, 10.0][seed % 3]
+    calculation_data = ei_core.calculate_limits({e: ei_core.elements_table[e] for e in elements}, daily_dose, route, 30)
+    situation, above_threshold, above_pde = reference_situation(batch_results, calculation_data, route, daily_dose, 30)
+
+    assert ei_core.determine_compliance_situation(batch_results, calculation_data, route, daily_dose, 30) == situation
+    assert set(ei_core.get_elements_above_pde(batch_results, calculation_data, route, daily_dose)) == above_pde
+    # An element can be above the threshold in one batch and above the PDE in another
+    threshold = set(ei_core.get_elements_above_threshold(batch_results, calculation_data, route, daily_dose, 30))
+    assert threshold == above_threshold
+
+
+def test_store_and_dict_inputs_agree():
+    elements = ["Cd", "Pb", "As"]
+    batch_results = random_batches(1, elements)
+    calculation_data = ei_core.calculate_limits({e: ei_core.elements_table[e] for e in elements}, 10, "oral", 30)
+    store = ei_core.BatchResultStore.from_dict(batch_results, elements)
+    from_dict = ei_core.evaluate_compliance(batch_results, calculation_data, "oral", 10, 30)
+    from_store = ei_core.evaluate_compliance(store, calculation_data, "oral", 10, 30)
+    np.testing.assert_array_equal(from_dict['situation'], from_store['situation'])
+    assert from_dict['overall_situation'] == from_store['overall_situation']
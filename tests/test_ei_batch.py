@@ -0,0 +1,96 @@
+"""Headless batch mode: per-product errors never stop the run"""
+import csv
+import json
+import os
+
+import ei_batch
+
+
+def write_batches(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Batch", "Cd", "Pb"])
+        writer.writerows(rows)
+
+
+def run(tmp_path, products):
+    batch_dir = tmp_path / "batches"
+    batch_dir.mkdir()
+    write_batches(batch_dir / "good.csv", [["B1", 0.01, 0.02], ["B2", 0.02, 0.01]])
+    write_batches(batch_dir / "warn.csv", [["B1", 0.2, 0.0]])
+    manifest = tmp_path / "products.json"
+    manifest.write_text(json.dumps(products))
+    out_dir = tmp_path / "reports"
+    code = ei_batch.main([str(manifest), str(batch_dir), "-o", str(out_dir), "-w", "1"])
+    with open(out_dir / "summary.csv", newline="") as f:
+        return code, list(csv.DictReader(f))
+
+
+def test_malformed_rows_only_fail_their_product(tmp_path):
+    products = [
+        {"product_name": "P1", "daily_dose": "abc", "route": "oral", "batch_file": "good.csv"},
+        {"product_name": "P2", "daily_dose": 0, "route": "oral", "batch_file": "good.csv"},
+        {"product_name": "P3", "daily_dose": -1, "route": "oral", "batch_file": "good.csv"},
+        {"product_name": "P4", "daily_dose": 1, "route": "nasal", "batch_file": "good.csv"},
+        {"product_name": "P5", "daily_dose": 1, "route": None, "control_percentage": "x", "batch_file": "good.csv"},
+        {"product_name": "P6", "daily_dose": 1, "elements": "Cd Xx", "batch_file": "good.csv"},
+        {"product_name": "P7", "daily_dose": 1},
+        {"daily_dose": 1, "batch_file": "good.csv"},
+        {"product_name": "Good", "daily_dose": 1, "route": "oral", "elements": "Cd,Pb", "batch_file": "good.csv"},
+    ]
+    code, summary = run(tmp_path, products)
+    assert code == 1
+    assert [row["row"] for row in summary] == [str(i) for i in range(1, 10)]
+    errors = [row["error"] for row in summary]
+    assert errors[0].startswith("Invalid daily_dose")
+    assert errors[1].startswith("daily_dose must be greater than 0")
+    assert errors[2].startswith("daily_dose must be greater than 0")
+    assert errors[3].startswith("Unknown route")
+    assert errors[4].startswith("Invalid control_percentage")
+    assert errors[5] == "Unknown elements: Xx"
+    assert errors[6].startswith("No batch results file found")
+    assert errors[7] == "Missing product_name"
+    assert errors[8] == ""
+    assert summary[8]["situation"] == "1" and summary[8]["compliant"] == "True"
+    assert os.path.exists(summary[8]["excel_report"]) and os.path.exists(summary[8]["id_card"])
+
+
+def test_compliant_matches_report_definition(tmp_path):
+    products = [{"product_name": "Warn", "daily_dose": 10, "route": "oral", "elements": "Cd", "batch_file": "warn.csv"}]
+    code, summary = run(tmp_path, products)
+    assert code == 0
+    assert summary[0]["situation"] == "2" and summary[0]["compliant"] == "False"
+
+
+def test_colliding_names_get_their_own_files(tmp_path):
+    products = [
+        {"product_name": "Prod A", "daily_dose": 1, "route": "oral", "batch_file": "good.csv"},
+        {"product_name": "Prod_A", "daily_dose": 1, "route": "oral", "batch_file": "good.csv"},
+        {"product_name": "Prod A", "daily_dose": 2, "route": "oral", "batch_file": "good.csv"},
+    ]
+    code, summary = run(tmp_path, products)
+    assert code == 0
+    reports = [row["excel_report"] for row in summary]
+    assert len(set(reports)) == 3
+    assert [os.path.basename(path) for path in reports] == [
+        "ICHQ3DReport_Prod_A.xlsx", "ICHQ3DReport_Prod_A_2.xlsx", "ICHQ3DReport_Prod_A_3.xlsx"]
+
+
+def test_invalid_batch_rows_fail_the_product(tmp_path):
+    batch_dir = tmp_path / "batches"
+    batch_dir.mkdir()
+    write_batches(batch_dir / "bad.csv", [["B1", 0.01, 0.02], ["B2", -0.1, 0.01], ["B3", 0.01, "x"],
+                                          ["B1", 0.02, 0.02], ["", 0.01, 0.01]])
+    manifest = tmp_path / "products.json"
+    manifest.write_text(json.dumps([{"product_name": "P1", "daily_dose": 1, "route": "oral", "elements": "Cd,Pb",
+                                     "batch_file": "bad.csv"}]))
+    out_dir = tmp_path / "reports"
+    assert ei_batch.main([str(manifest), str(batch_dir), "-o", str(out_dir), "-w", "1"]) == 1
+    with open(out_dir / "summary.csv", newline="") as f:
+        summary = list(csv.DictReader(f))[0]
+    assert summary["skipped"] == "4"
+    assert "Negative values found for Cd" in summary["error"]
+    assert "non-numeric" in summary["error"] and "Duplicate batch names found: B1" in summary["error"]
+    assert "missing batch name" in summary["error"]
+    assert summary["excel_report"] == "" and summary["id_card"] == ""
+    assert [name for name in os.listdir(out_dir) if name != "summary.csv"] == []
@@ -0,0 +1,76 @@
+"""ExportQueue: background exports in worker processes"""
+import time
+
+import pytest
+
+import ei_core
+
+FORM = {key: "" for key in ("requestor_site", "requestor_name", "requestor_phone", "requestor_email", "request_date",
+                            "actime_code", "product_form", "batch_number", "sample_quantity", "sample_unit",
+                            "number_of_vials", "safety_risk", "shipment_conditions", "storage_conditions",
+                            "gmp_analysis", "gmp_purpose", "analysis_type", "method_reference")}
+FORM.update(product_name="Test product", elements={"Cd": True, "Pb": False}, ichq3d_analysis=True, daily_dose=1.0,
+            route_of_administration="oral")
+
+
+def wait(queue, job_id, timeout=60):
+    deadline = time.time() + timeout
+    while queue.status(job_id)["status"] in ("queued", "running"):
+        assert time.time() < deadline, "export did not finish"
+        time.sleep(0.05)
+    return queue.status(job_id)
+
+
+@pytest.fixture
+def queue():
+    queue = ei_core.ExportQueue(workers=1)
+    yield queue
+    queue.shutdown()
+
+
+def test_workers_are_not_forked(queue):
+    assert queue._pool._mp_context.get_start_method() in ("forkserver", "spawn")
+
+
+def test_submit_and_result(queue):
+    job_id = queue.submit("word", FORM)
+    assert wait(queue, job_id)["status"] == "done"
+    assert queue.result(job_id)[:2] == b"PK"
+    assert queue.stats()["result_bytes"] == len(queue.result(job_id))
+    with pytest.raises(ValueError):
+        queue.submit("pdf", FORM)
+
+
+def test_same_key_shares_one_export(queue):
+    first = queue.submit("word", FORM, key="k")
+    assert queue.submit("word", FORM, key="k") == first
+    wait(queue, first)
+    queue.discard(first)
+    assert queue.status(first) is None
+    assert queue.submit("word", FORM, key="k") != first
+    assert queue.stats()["result_bytes"] == 0
+
+
+def test_results_are_evicted_beyond_the_byte_budget():
+    queue = ei_core.ExportQueue(workers=1, max_result_bytes=1)
+    try:
+        first = queue.submit("word", FORM)
+        wait(queue, first)
+        # The latest result is kept even when it alone is over the budget
+        assert queue.status(first)["status"] == "done"
+        second = queue.submit("word", dict(FORM, product_name="Other"))
+        wait(queue, second)
+        assert queue.status(first) is None
+        assert queue.result(second) is not None
+        assert queue.stats()["result_bytes"] == len(queue.result(second))
+    finally:
+        queue.shutdown()
+
+
+def test_cancel_queued_job(queue):
+    running = queue.submit("word", FORM)
+    queued = queue.submit("word", dict(FORM, product_name="Other"))
+    assert queue.cancel(queued)
+    assert wait(queue, queued)["status"] == "cancelled"
+    assert not queue.cancel(queued)
+    assert wait(queue, running)["status"] == "done"
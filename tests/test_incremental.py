@@ -0,0 +1,56 @@
+"""IncrementalEvaluator agrees with a full recompute after every kind of change"""
+import numpy as np
+import pytest
+
+import ei_core
+
+ELEMENTS = ["Cd", "Pb", "As", "Hg", "Co", "V", "Ni", "Li", "Cu", "Fe", "Sb"]
+KEYS = ["measured", "missing", "exposure", "situation", "compliant", "control_threshold", "pde", "ratio"]
+
+
+def assert_matches_full_recompute(evaluator, store, route, daily_dose, elements, control_percentage):
+    calculation_data, compliance = evaluator.evaluate(route, daily_dose, elements, control_percentage)
+    expected_data = ei_core.calculate_limits(elements, daily_dose, route, control_percentage)
+    expected = ei_core.evaluate_compliance(store, expected_data, route, daily_dose, control_percentage, elements)
+    assert calculation_data.equals(expected_data)
+    assert compliance["batches"] == expected["batches"]
+    assert compliance["overall_situation"] == expected["overall_situation"]
+    for key in KEYS:
+        np.testing.assert_array_equal(compliance[key], expected[key], err_msg=key)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_random_edits(seed):
+    rng = np.random.default_rng(seed)
+    store = ei_core.BatchResultStore()
+    evaluator = ei_core.IncrementalEvaluator(store)
+    route, daily_dose, control_percentage = "oral", 1.0, 30
+    for step in range(200):
+        action = rng.integers(0, 9)
+        if action in (0, 1, 6):
+            batch_ids = [f"B{rng.integers(0, 80)}" for _ in range(rng.integers(1, 5))]
+            values = rng.uniform(0, 0.6, (len(batch_ids), len(store.elements)))
+            values[rng.random(values.shape) < 0.2] = np.nan
+            store.upsert(batch_ids, values)
+        elif action == 2 and len(store):
+            store.delete([store.batch_ids[rng.integers(0, len(store))]])
+        elif action == 3:
+            route = ["oral", "parenteral", "inhalation"][rng.integers(0, 3)]
+        elif action == 4:
+            daily_dose = [1.0, 2.5, 36.6][rng.integers(0, 3)]
+        elif action == 5:
+            control_percentage = int(rng.choice([30, 40, 50]))
+        elements = list(rng.choice(ELEMENTS, rng.integers(0, len(ELEMENTS)), replace=False))
+        assert_matches_full_recompute(evaluator, store, route, daily_dose, elements, control_percentage)
+
+
+def test_unchanged_inputs_are_not_recomputed():
+    store = ei_core.BatchResultStore()
+    store.upsert([f"B{i}" for i in range(20)], np.full((20, len(store.elements)), 0.1))
+    evaluator = ei_core.IncrementalEvaluator(store)
+    evaluator.evaluate("oral", 10, ["Cd", "Pb"], 30)
+    evaluator.evaluate("oral", 10, ["Cd", "Pb"], 30)
+    assert not evaluator.last_update["full"]
+    store.upsert(["B3"], np.full((1, len(store.elements)), 0.4))
+    assert_matches_full_recompute(evaluator, store, "oral", 10, ["Cd", "Pb"], 30)
+    assert not evaluator.last_update["full"]
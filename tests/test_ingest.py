@@ -0,0 +1,63 @@
+"""Batch file ingest: streaming reader and multi-file ingest"""
+import io
+
+import numpy as np
+import pandas as pd
+
+import ei_core
+
+
+def upload(name, data):
+    uploaded = io.BytesIO(data if isinstance(data, bytes) else data.encode())
+    uploaded.name = name
+    return uploaded
+
+
+def test_streaming_matches_process_batch_data():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"Batch": [f"B{i}" for i in range(250)], "Cd": rng.random(250).round(4),
+                       "Pb": rng.random(250).round(4), "Fe": rng.random(250).round(4)})
+    df["Pb"] = df["Pb"].astype(object)
+    df.loc[::7, "Pb"] = "<0.05"
+    df.loc[::11, "Cd"] = np.nan
+    store, results, error = ei_core.stream_batch_upload_file(upload("b.csv", df.to_csv(index=False)), ["Cd", "Pb"],
+                                                             chunksize=40)
+    assert error is None
+    assert results["added"] == 250 and results["skipped"] == 0 and results["errors"] == []
+    expected = ei_core.BatchResultStore()
+    ei_core.process_batch_data(df, ["Cd", "Pb"], expected)
+    assert store.batch_ids == expected.batch_ids
+    np.testing.assert_array_equal(store.matrix(["Cd", "Pb"])[0], expected.matrix(["Cd", "Pb"])[0])
+    np.testing.assert_array_equal(store.matrix(["Cd", "Pb"])[1], expected.matrix(["Cd", "Pb"])[1])
+
+
+def test_streaming_skips_and_reports_invalid_rows():
+    csv = "Batch,Cd,Pb\nA,0.1,0.2\nB,-1,0.2\nA,0.3,0.1\nC,x,<0.05\n,0.1,0.1\nD, ,0.4\nE,0.2,0.2\n"
+    store, results, error = ei_core.stream_batch_upload_file(upload("b.csv", csv), ["Cd", "Pb"], chunksize=3)
+    assert error is None
+    assert results["processed_batches"] == ["A", "D", "E"]
+    assert results["skipped"] == 4
+    assert "Duplicate batch names found: A" in results["errors"]
+    assert "Column 'Cd' contains non-numeric values in rows: 5" in results["errors"]
+    assert "Negative values found for Cd" in results["errors"]
+    # The first A is kept, the repeat in a later chunk is not
+    assert store.get("A")["Cd"] == 0.1
+
+
+def test_streaming_reports_missing_batch_column():
+    _, _, error = ei_core.stream_batch_upload_file(upload("b.csv", "Lot,Cd\nA,0.1\n"), ["Cd"])
+    assert error == "Missing required 'Batch' column in the file."
+
+
+def test_ingest_counts_rows_without_batch_name():
+    files = [upload("a.csv", "Batch,Cd\nA1,0.1\n,0.2\n,0.3\nA2,0.1\n"),
+             upload("b.csv", "Batch,Cd\nB1,0.1\n,0.2\n"),
+             upload("c.csv", "Batch,Cd\nC1,0.1\n")]
+    store = ei_core.BatchResultStore()
+    results = ei_core.ingest_batch_files(files, ["Cd"], store=store)
+    assert store.batch_ids == ["A1", "A2", "B1", "C1"]
+    assert results["skipped"] == 3
+    assert [source["unnamed"] for source in results["sources"]] == [2, 1, 0]
+    assert "a.csv: Skipped 2 row(s) with missing batch name" in results["errors"]
+    assert "b.csv: Skipped 1 row(s) with missing batch name" in results["errors"]
+    assert not any(error.startswith("c.csv") for error in results["errors"])
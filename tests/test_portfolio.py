@@ -0,0 +1,35 @@
+"""Portfolio evaluation agrees with the per-product compliance engine"""
+import numpy as np
+import pandas as pd
+
+import ei_core
+
+
+def test_portfolio_matches_evaluate_compliance():
+    rng = np.random.default_rng(3)
+    elements = ["Cd", "Pb", "As", "Ni"]
+    products = pd.DataFrame({"product": ["P1", "P2", "P3"], "daily_dose": [1.0, 10.0, 40.0],
+                             "route": ["oral", "parenteral", "oral"], "control_percentage": [30, 50, 30]})
+    measurements = pd.DataFrame([(product, f"B{b}", element, round(float(rng.uniform(0, 0.6)), 4))
+                                 for product in products["product"] for b in range(5) for element in elements],
+                                columns=["product", "batch", "element", "value"])
+    summary = ei_core.evaluate_portfolio(products, measurements)["products"].set_index("product")
+
+    for product in products.itertuples():
+        rows = measurements[measurements["product"] == product.product]
+        batch_results = {batch: dict(zip(group["element"], group["value"])) for batch, group in rows.groupby("batch")}
+        calculation_data = ei_core.calculate_limits({e: ei_core.elements_table[e] for e in elements},
+                                                    product.daily_dose, product.route, product.control_percentage)
+        compliance = ei_core.evaluate_compliance(batch_results, calculation_data, product.route, product.daily_dose,
+                                                 product.control_percentage)
+        assert summary.at[product.product, "overall_situation"] == compliance["overall_situation"]
+        assert summary.at[product.product, "compliant"] == bool(compliance["compliant"].all())
+        assert summary.at[product.product, "below_pde"] == (compliance["overall_situation"] < 3)
+
+
+def test_situation_2_is_not_compliant():
+    products = pd.DataFrame({"product": ["P"], "daily_dose": [10.0], "route": ["oral"]})
+    measurements = pd.DataFrame({"product": ["P"], "batch": ["B1"], "element": ["Cd"], "value": [0.2]})
+    summary = ei_core.evaluate_portfolio(products, measurements)["products"]
+    assert summary.loc[0, "overall_situation"] == 2
+    assert not summary.loc[0, "compliant"] and summary.loc[0, "below_pde"]
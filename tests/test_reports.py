@@ -0,0 +1,47 @@
+"""Excel report writers"""
+import io
+
+import openpyxl
+import pytest
+
+import ei_core
+
+ELEMENTS = ["Cd", "Pb", "As", "Fe"]
+BATCHES = {"B1": {"Cd": 0.01, "Pb": 0.3, "As": 0.0}, "B2": {"Cd": 0.2, "Pb": 0.01, "As": 3.0}}
+
+
+def sheet_values(data):
+    ws = openpyxl.load_workbook(io.BytesIO(data)).active
+    return [[cell.value for cell in row] for row in ws.iter_rows()]
+
+
+def build(writer, control_tiers=None):
+    calculation_data = ei_core.calculate_limits({e: ei_core.elements_table[e] for e in ELEMENTS}, 10, "oral", 30)
+    return writer("Prod", 10, "oral", ELEMENTS, calculation_data, BATCHES, 30, control_tiers=control_tiers).getvalue()
+
+
+@pytest.mark.parametrize("writer", [ei_core.create_excel_report, ei_core.create_excel_report_streaming])
+def test_tier_table(writer):
+    rows = sheet_values(build(writer, [50, 30]))
+    labels = [row[1] for row in rows]
+    start = labels.index("Control % tiers")
+    assert rows[start][2:6] == ELEMENTS
+    assert labels[start + 1:start + 4] == ["Max % of PDE", "Situation at 30% of the PDE", "Situation at 50% of the PDE"]
+    # Cd: 0.2 µg/g × 10 g = 2 µg of a 5 µg PDE = 40 %; Fe has no oral PDE
+    assert rows[start + 1][2] == "40.0%" and rows[start + 1][5] == "-"
+    assert rows[start + 2][2] == "2" and rows[start + 3][2] == "1"
+    assert rows[start + 2][5] == "-"
+
+
+@pytest.mark.parametrize("writer", [ei_core.create_excel_report, ei_core.create_excel_report_streaming])
+def test_no_tier_table_by_default(writer):
+    rows = sheet_values(build(writer))
+    assert "Control % tiers" not in [row[1] for row in rows if len(row) > 1]
+
+
+def test_writers_agree():
+    # openpyxl does not store empty strings, xlsxwriter does
+    def normalized(rows):
+        return [[None if value == "" else value for value in row] for row in rows]
+    assert normalized(sheet_values(build(ei_core.create_excel_report, [30, 50]))) == \
+        normalized(sheet_values(build(ei_core.create_excel_report_streaming, [30, 50])))
@@ -0,0 +1,61 @@
+"""BatchStatistics agrees with statistics recomputed from the whole store"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import ei_core
+
+ELEMENTS = ["Cd", "Pb", "As", "Hg", "Fe"]
+
+
+def assert_matches_full_recompute(statistics, store, control_percentage=30):
+    calculation_data = ei_core.calculate_limits(ELEMENTS, 10, "oral", control_percentage)
+    summary = statistics.summary(calculation_data, control_percentage, ELEMENTS)
+    frame = store.to_frame(ELEMENTS)
+    limits = calculation_data.set_index("Element")[f"Control Strategy Limit ({control_percentage}%) µg/g"]
+    for i, element in enumerate(ELEMENTS):
+        column = frame[element].dropna().to_numpy(dtype=float) if element in frame else np.zeros(0)
+        n = len(column)
+        std = column.std(ddof=1) if n > 1 else np.nan
+        limit = limits.get(element, np.nan)
+        expected = [n, column.mean() if n else np.nan, std, column.max() if n else np.nan] + \
+            [np.percentile(column, q) if n else np.nan for q in statistics.percentiles] + \
+            [limit, column.max() / limit * 100 if n else np.nan]
+        got = summary.iloc[i, 1:10].to_numpy(dtype=float)
+        np.testing.assert_allclose(got, np.array(expected, dtype=float), rtol=1e-9, atol=1e-9, err_msg=element)
+        cpk = (limit - column.mean()) / (3 * std) if n > 1 and std > 0 else np.nan
+        assert np.isclose(summary["Cpk"].iloc[i], cpk, equal_nan=True, rtol=1e-9)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_random_edits(seed):
+    rng = np.random.default_rng(seed)
+    store = ei_core.BatchResultStore()
+    statistics = ei_core.BatchStatistics(store)
+    for step in range(150):
+        action = rng.integers(0, 10)
+        if action < 7 or len(store) < 5:
+            batch_ids = [f"B{rng.integers(0, 100)}" for _ in range(rng.integers(1, 15))]
+            values = np.round(rng.random((len(batch_ids), len(store.elements))) * 3, 2)  # Rounded for ties
+            store.upsert(batch_ids, values, rng.random(values.shape) < 0.3)
+        else:
+            store.delete(list(rng.choice(store.batch_ids, 3, replace=False)))
+        assert_matches_full_recompute(statistics, store)
+
+
+def test_only_changed_batches_are_folded_in():
+    rng = np.random.default_rng(0)
+    store = ei_core.BatchResultStore()
+    store.upsert([f"B{i}" for i in range(500)], rng.random((500, len(store.elements))))
+    statistics = ei_core.BatchStatistics(store)
+    assert_matches_full_recompute(statistics, store)
+    store.upsert(["B5", "B600"], rng.random((2, len(store.elements))))
+    assert_matches_full_recompute(statistics, store, 40)
+    assert statistics.last_update == {"full": False, "rows": 2}
+
+
+def test_empty_store_and_no_limits():
+    statistics = ei_core.BatchStatistics(ei_core.BatchResultStore())
+    summary = statistics.summary(pd.DataFrame(), 30, ["Fe"])
+    assert summary["Measured batches"].tolist() == [0]
+    assert summary["Cpk"].isna().all()
@@ -0,0 +1,84 @@
+"""BatchResultStore upsert and missing-mask semantics"""
+import numpy as np
+import pytest
+
+import ei_core
+
+
+def make_store(elements=("Cd", "Pb", "As")):
+    return ei_core.BatchResultStore(list(elements), capacity=2)
+
+
+def test_values_under_mask_are_zeroed():
+    store = make_store()
+    store.upsert(["X"], [[5.0, 5.0, 5.0]], [[True, False, True]])
+    values, missing = store.matrix()
+    np.testing.assert_array_equal(values, [[0.0, 5.0, 0.0]])
+    np.testing.assert_array_equal(missing, [[True, False, True]])
+    assert store.get("X") == {"Pb": 5.0}
+
+
+def test_masked_value_does_not_change_compliance():
+    store = ei_core.BatchResultStore(["Cd"])
+    store.upsert(["X"], [[5.0]], [[True]])
+    calculation_data = ei_core.calculate_limits({"Cd": ei_core.elements_table["Cd"]}, 10, "oral", 30)
+    compliance = ei_core.evaluate_compliance(store, calculation_data, "oral", 10, 30)
+    assert compliance["overall_situation"] == 1
+    assert compliance["measured"][0, 0] == 0.0
+
+
+def test_nan_is_missing():
+    store = make_store()
+    store.append(["A"], [[np.nan, 0.2, 0.0]])
+    values, missing = store.matrix()
+    np.testing.assert_array_equal(values, [[0.0, 0.2, 0.0]])
+    np.testing.assert_array_equal(missing, [[True, False, False]])
+
+
+def test_upsert_overwrites_and_last_row_wins():
+    store = make_store()
+    store.upsert(["A", "B"], [[0.1, 0.2, 0.3], [1.0, 1.0, 1.0]])
+    version = store.version
+    store.upsert(["B", "C", "B"], [[2.0, 2.0, 2.0], [3.0, 3.0, 3.0], [4.0, np.nan, 4.0]])
+    assert store.batch_ids == ["A", "B", "C"]
+    assert store.get("B") == {"Cd": 4.0, "As": 4.0}
+    np.testing.assert_array_equal(store.changed_rows(version), [1, 2])
+
+
+def test_append_rejects_existing_ids():
+    store = make_store()
+    store.append(["A"], [[0.1, 0.2, 0.3]])
+    with pytest.raises(ValueError):
+        store.append(["A"], [[0.1, 0.2, 0.3]])
+    with pytest.raises(ValueError):
+        store.append(["B", "B"], [[0.1, 0.2, 0.3]] * 2)
+
+
+def test_growth_and_delete_keep_rows_aligned():
+    store = make_store()
+    rng = np.random.default_rng(0)
+    values = rng.random((50, 3))
+    store.append([f"B{i}" for i in range(50)], values)
+    layout = store.layout_version
+    store.delete(["B0", "B10", "missing"])
+    assert len(store) == 48 and "B10" not in store and store.layout_version == layout + 1
+    np.testing.assert_array_equal(store.matrix()[0], np.delete(values, [0, 10], axis=0))
+    store.clear()
+    assert len(store) == 0 and store.missing.shape == (0, 3)
+
+
+def test_matrix_reads_unknown_elements_as_missing():
+    store = make_store()
+    store.append(["A"], [[0.1, 0.2, 0.3]])
+    values, missing = store.matrix(["As", "Zz", "Cd"])
+    np.testing.assert_array_equal(values, [[0.3, 0.0, 0.1]])
+    np.testing.assert_array_equal(missing, [[False, True, False]])
+
+
+def test_dict_round_trip():
+    batch_results = {"A": {"Cd": 0.1, "Pb": 0.0}, "B": {"As": 0.5}}
+    store = ei_core.BatchResultStore.from_dict(batch_results, ["Cd", "Pb", "As"])
+    assert store.get("A") == {"Cd": 0.1, "Pb": 0.0}
+    assert store.to_dict()["B"] == {"Cd": 0.0, "Pb": 0.0, "As": 0.5}
+    frame = store.to_frame()
+    assert np.isnan(frame.at["B", "Cd"]) and frame.at["A", "Pb"] == 0.0
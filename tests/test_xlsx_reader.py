@@ -0,0 +1,204 @@
+"""Streaming xlsx reader against pandas/openpyxl"""
+import datetime
+import io
+import zipfile
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+
+import ei_core
+
+
+def save(workbook):
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def read_streaming(data, columns=None, **kwargs):
+    return pd.concat(list(ei_core.read_xlsx_columns(io.BytesIO(data), columns, **kwargs)), ignore_index=True)
+
+
+def read_fallback(data, columns=None):
+    return pd.concat(list(ei_core._read_xlsx_columns_openpyxl(io.BytesIO(data), columns, chunksize=3)),
+                     ignore_index=True)
+
+
+def assert_same_as_pandas(frame, data, columns=None):
+    expected = pd.read_excel(io.BytesIO(data))
+    if columns is not None:
+        expected = expected[[column for column in expected.columns if column in columns]]
+    assert list(frame.columns) == [str(column) for column in expected.columns]
+    assert len(frame) == len(expected)
+    for name, column in zip(frame.columns, expected.columns):
+        for got, want in zip(frame[name].tolist(), expected[column].tolist()):
+            if pd.isna(got) and pd.isna(want):
+                continue
+            if name == "Batch":
+                want = str(want)
+            if isinstance(want, pd.Timestamp):
+                want = want.to_pydatetime()
+            if isinstance(want, (int, np.integer)) and not isinstance(want, (bool, np.bool_)):
+                want = float(want)
+            assert got == want, (name, got, want)
+
+
+def mixed_workbook():
+    workbook = openpyxl.Workbook()
+    ws = workbook.active
+    ws.append(["Batch", "Cd", None, "Pb", "aux & <x>", "Cd", "Sampled", "Released"])
+    ws.append([101, 0.1, "q", "<0.05", "a&b", 3, datetime.datetime(2024, 1, 2), True])
+    ws.append(["B2", "=1+1", None, "ND", None, None, datetime.datetime(2024, 3, 4, 5, 6), False])
+    ws.append([])
+    ws.append(["B<3>", None, 1, 0.25, True, 4, None, None])
+    ws.append([datetime.datetime(2023, 12, 31), 0.5, None, 0.1, None, None, None, None])
+    return save(workbook)
+
+
+@pytest.mark.parametrize("columns", [None, {"Batch", "Cd", "Pb", "Sampled", "Released", "Hg"}])
+def test_matches_pandas(columns):
+    data = mixed_workbook()
+    assert_same_as_pandas(read_streaming(data, columns, block_size=200), data, columns)
+    assert_same_as_pandas(read_fallback(data, columns), data, columns)
+
+
+def test_dates_and_booleans():
+    frame = read_streaming(mixed_workbook())
+    assert frame["Sampled"].tolist()[:2] == [datetime.datetime(2024, 1, 2), datetime.datetime(2024, 3, 4, 5, 6)]
+    assert frame["Released"].tolist()[:2] == [True, False]
+    assert frame["Batch"].tolist()[-1] == "2023-12-31 00:00:00"
+
+
+@pytest.mark.parametrize("engine", ["openpyxl", "xlsxwriter"])
+def test_pandas_written_files(engine):
+    df = pd.DataFrame({"Batch": ["A", "B", "C", None], "x": [1, 2, 3, 4], "Cd": [0.1, "<0.05", np.nan, "ND"],
+                       "Pb": [1.5, 2, 3, 4]})
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False, engine=engine)
+    data = buffer.getvalue()
+    assert_same_as_pandas(read_streaming(data, block_size=64), data)
+    assert_same_as_pandas(read_streaming(data, {"Batch", "Cd"}), data, {"Batch", "Cd"})
+
+
+def handmade_workbook(sheet_rows, prefix=""):
+    """Minimal xlsx with the given <row> XML, for cell types and layouts openpyxl never writes"""
+    main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    relationships = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+    package = "http://schemas.openxmlformats.org/package/2006/relationships"
+    files = {
+        "[Content_Types].xml":
+            '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>',
+        "_rels/.rels":
+            f'<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="{package}">'
+            f'<Relationship Id="rId1" Type="{relationships}/officeDocument" Target="xl/workbook.xml"/></Relationships>',
+        "xl/workbook.xml":
+            f'<?xml version="1.0" encoding="UTF-8"?><workbook xmlns="{main}" xmlns:r="{relationships}">'
+            '<sheets><sheet name="Results" sheetId="1" r:id="rId1"/></sheets></workbook>',
+        "xl/_rels/workbook.xml.rels":
+            f'<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="{package}">'
+            f'<Relationship Id="rId1" Type="{relationships}/worksheet" Target="worksheets/sheet1.xml"/></Relationships>',
+        "xl/worksheets/sheet1.xml":
+            f'<?xml version="1.0" encoding="UTF-8"?><{prefix}worksheet xmlns{":" + prefix[:-1] if prefix else ""}="{main}">'
+            f'<{prefix}sheetData>{sheet_rows}</{prefix}sheetData></{prefix}worksheet>',
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def test_inline_strings_iso_dates_and_booleans():
+    data = handmade_workbook(
+        '<row r="1"><c r="A1" t="inlineStr"><is><t>Batch</t></is></c><c r="B1" t="inlineStr"><is><t>Cd</t></is></c>'
+        '<c r="C1" t="inlineStr"><is><t>Date</t></is></c><c r="D1" t="inlineStr"><is><t>Ok</t></is></c></row>'
+        '<row r="2"><c r="A2" t="inlineStr"><is><t>B&amp;1</t></is></c><c r="B2"><v>0.5</v></c>'
+        '<c r="C2" t="d"><v>2024-05-06T07:08:09</v></c><c r="D2" t="b"><v>1</v></c></row>'
+        '<row r="3"><c r="A3" t="inlineStr"><is><t>B2</t></is></c><c r="B3" t="inlineStr"><is><t>&lt;0.1</t></is></c>'
+        '<c r="D3" t="b"><v>0</v></c></row>'
+    )
+    frame = read_streaming(data)
+    assert frame["Batch"].tolist() == ["B&1", "B2"]
+    assert frame["Cd"].tolist() == [0.5, "<0.1"]
+    assert frame["Date"].tolist()[0] == datetime.datetime(2024, 5, 6, 7, 8, 9)
+    assert frame["Ok"].tolist() == [True, False]
+    assert_same_as_pandas(frame, data)
+
+
+def layout_rows(cell, rows=40):
+    """Header row in the usual layout, then data rows whose cells are written by cell(reference, value_xml)"""
+    header = ('<row r="1"><c r="A1" t="inlineStr"><is><t>Batch</t></is></c>'
+              '<c r="B1" t="inlineStr"><is><t>Cd</t></is></c></row>')
+    data = "".join(f'<row r="{i}">' + cell(f"A{i}", f'<is><t>B{i}</t></is>', "inlineStr") +
+                   cell(f"B{i}", f"<v>{i / 100}</v>", None) + "</row>" for i in range(2, rows + 2))
+    return header + data
+
+
+def expected_layout_frame(rows=40):
+    return pd.DataFrame({"Batch": [f"B{i}" for i in range(2, rows + 2)], "Cd": [i / 100 for i in range(2, rows + 2)]})
+
+
+def type_attribute(kind, quote='"'):
+    return f" t={quote}{kind}{quote}" if kind else ""
+
+
+@pytest.mark.parametrize("cell", [
+    lambda ref, value, kind: f'<c s="0" r="{ref}"{type_attribute(kind)}>{value}</c>',
+    lambda ref, value, kind: f'<c{type_attribute(kind)} r="{ref}">{value}</c>',
+    lambda ref, value, kind: f"<c r='{ref}'{type_attribute(kind, chr(39))}>{value}</c>",
+    lambda ref, value, kind: f"<c\n  r='{ref}' s='0'{type_attribute(kind, chr(39))}>{value}</c>",
+], ids=["style-first", "type-first", "single-quotes", "newline"])
+def test_other_cell_layouts(cell):
+    data = handmade_workbook(layout_rows(cell))
+    frame = read_streaming(data, block_size=256)
+    pd.testing.assert_frame_equal(frame, expected_layout_frame())
+    assert_same_as_pandas(frame, data)
+
+
+def test_cells_without_reference_fall_back_to_openpyxl():
+    # The first rows stream; from row 30 on the cells have no r attribute, which only openpyxl can place
+    def cell(ref, value, kind):
+        row = int(ref[1:])
+        reference = f' r="{ref}"' if row < 30 else ""
+        return f'<c{reference}{type_attribute(kind)}>{value}</c>'
+    data = handmade_workbook(layout_rows(cell))
+    frame = read_streaming(data, block_size=256)
+    pd.testing.assert_frame_equal(frame, expected_layout_frame())
+    assert_same_as_pandas(frame, data)
+
+
+def test_prefixed_worksheet_falls_back_to_openpyxl():
+    rows = layout_rows(lambda ref, value, kind: f'<c r="{ref}"{type_attribute(kind)}>{value}</c>')
+    for tag in ("row", "c", "is", "t", "v"):
+        rows = rows.replace(f"<{tag}>", f"<x:{tag}>").replace(f"<{tag} ", f"<x:{tag} ").replace(f"</{tag}>", f"</x:{tag}>")
+    data = handmade_workbook(rows, prefix="x:")
+    pd.testing.assert_frame_equal(read_streaming(data), expected_layout_frame())
+
+
+def test_sheet_selection_and_missing_sheet():
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["Notes"])
+    second = workbook.create_sheet("Lot 2")
+    second.append(["Batch", "Cd"])
+    second.append(["B1", 0.2])
+    data = save(workbook)
+    assert ei_core.xlsx_sheet_names(io.BytesIO(data)) == ["Sheet", "Lot 2"]
+    assert read_streaming(data, sheet="Lot 2")["Cd"].tolist() == [0.2]
+    assert read_streaming(data, sheet=1)["Batch"].tolist() == ["B1"]
+    with pytest.raises(ValueError):
+        read_streaming(data, sheet="Missing")
+
+
+def test_preview_path_uses_pandas():
+    upload = io.BytesIO(mixed_workbook())
+    upload.name = "results.xlsx"
+    df, error = ei_core._read_batch_frame(upload)
+    assert error is None
+    pd.testing.assert_frame_equal(df, pd.read_excel(io.BytesIO(mixed_workbook())))